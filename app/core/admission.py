@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import time
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# Concurrent streams per signed-in user / share viewer and per client IP.
+_MAX_PER_USER = max(1, _env_int("STREAM_MAX_PER_USER", 6))
+_MAX_PER_IP = max(1, _env_int("STREAM_MAX_PER_IP", 10))
+# Attachment downloads per user/IP; download managers open many ranges.
+_MAX_DOWNLOADS_PER_VIEWER = max(1, _env_int("STREAM_MAX_DOWNLOADS_PER_VIEWER", 2))
+# Streams server-wide; downloads may only take this share of them so
+# playback always has room.
+_MAX_ACTIVE = max(1, _env_int("STREAM_MAX_ACTIVE", 120))
+_DOWNLOAD_SHARE = min(1.0, max(0.0, _env_float("STREAM_DOWNLOAD_SHARE", 0.5)))
+# Outbound stream bandwidth in MB/s (0 = unlimited).
+_BANDWIDTH_MBPS = max(0.0, _env_float("STREAM_BANDWIDTH_MBPS", 0.0))
+_RETRY_AFTER_SEC = 5
+
+
+class _Bucket:
+    """Shared byte budget. Playback may run the bucket into debt; downloads
+    wait until it is back above `reserve`, so they only get what playback
+    leaves over."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.burst = rate
+        self.reserve = rate * 0.5
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.waiting_downloads = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, nbytes: int, inline: bool) -> None:
+        self._refill()
+        if not inline:
+            self.waiting_downloads += 1
+            try:
+                while self.tokens < self.reserve:
+                    await asyncio.sleep((self.reserve - self.tokens) / self.rate)
+                    self._refill()
+            finally:
+                self.waiting_downloads -= 1
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+_bucket = _Bucket(_BANDWIDTH_MBPS * 1024 * 1024) if _BANDWIDTH_MBPS > 0 else None
+_counts: dict[str, int] = {}
+_download_counts: dict[str, int] = {}
+_totals = {"active": 0, "downloads": 0, "rejected": 0}
+
+
+def _inc(table: dict[str, int], key: str, delta: int) -> None:
+    value = table.get(key, 0) + delta
+    if value > 0:
+        table[key] = value
+    else:
+        table.pop(key, None)
+
+
+def _reject(status: int, detail: str) -> HTTPException:
+    _totals["rejected"] += 1
+    logger.debug("Stream rejected (%s): %s", status, detail)
+    return HTTPException(status, detail, headers={"Retry-After": str(_RETRY_AFTER_SEC)})
+
+
+class Ticket:
+    """One admitted stream; released when its StreamPlan closes."""
+
+    def __init__(self, keys: list[str], inline: bool):
+        self.keys = keys
+        self.inline = inline
+        self.released = False
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        for key in self.keys:
+            _inc(_counts, key, -1)
+            if not self.inline:
+                _inc(_download_counts, key, -1)
+        _totals["active"] -= 1
+        if not self.inline:
+            _totals["downloads"] -= 1
+
+    async def _close(self) -> None:
+        self.release()
+
+    async def throttle(self, nbytes: int) -> None:
+        if _bucket is not None:
+            await _bucket.take(nbytes, self.inline)
+
+    def attach(self, plan) -> None:
+        plan.add_closer(self._close)
+        if _bucket is not None:
+            plan.shaper = self.throttle
+
+
+def admit_stream(request: Request, user_key: str | None = None, inline: bool = True) -> Ticket:
+    """Admit a stream or raise 429 (this viewer has too many) / 503 (server full).
+
+    `user_key` must be a server-side identity (the signed-in user). The IP is
+    the real client only when uvicorn trusts the proxy (FORWARDED_ALLOW_IPS).
+    """
+    ip = request.client.host if request.client else ""
+    keys = []
+    if user_key:
+        keys.append(f"user:{user_key}")
+    if ip:
+        keys.append(f"ip:{ip}")
+    for key in keys:
+        limit = _MAX_PER_USER if key.startswith("user:") else _MAX_PER_IP
+        if _counts.get(key, 0) >= limit:
+            raise _reject(429, "Too many concurrent streams.")
+        if not inline and _download_counts.get(key, 0) >= _MAX_DOWNLOADS_PER_VIEWER:
+            raise _reject(429, "Too many concurrent downloads.")
+    if _totals["active"] >= _MAX_ACTIVE:
+        raise _reject(503, "Server is busy.")
+    if not inline and _totals["downloads"] >= max(1, int(_MAX_ACTIVE * _DOWNLOAD_SHARE)):
+        raise _reject(503, "Too many downloads in progress.")
+
+    for key in keys:
+        _inc(_counts, key, 1)
+        if not inline:
+            _inc(_download_counts, key, 1)
+    _totals["active"] += 1
+    if not inline:
+        _totals["downloads"] += 1
+    return Ticket(keys, inline)
+
+
+def snapshot() -> dict:
+    return {
+        "active": _totals["active"],
+        "downloads": _totals["downloads"],
+        "rejected": _totals["rejected"],
+        "max_active": _MAX_ACTIVE,
+        "bandwidth_mbps": _BANDWIDTH_MBPS or None,
+        "bucket_mb": round(_bucket.tokens / 1024 / 1024, 2) if _bucket else None,
+        "waiting_downloads": _bucket.waiting_downloads if _bucket else 0,
+        "top_viewers": sorted(_counts.items(), key=lambda kv: -kv[1])[:20],
+    }
@@ -1,12 +1,15 @@
 import asyncio
 import logging
+import mmap
 import os
 import shutil
+import struct
 import tempfile
 from pathlib import Path
 from typing import AsyncGenerator, Optional
 
 from app.core.config import settings
+from app.core.rate_limit import is_throttled
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +17,12 @@ _cache_root: Path | None = None
 _cache_tasks: dict[str, asyncio.Task] = {}
 _cache_lock = asyncio.Lock()
 _trim_lock = asyncio.Lock()
+_chunk_maps: dict[str, "ChunkMap"] = {}
+_chunk_maps_lock = asyncio.Lock()
+_BITMAP_HEADER = struct.Struct("<QI")
+# Chunk bitmaps are saved at most this often per item. A bitmap that lags
+# behind the data file only costs refetching the newest chunks.
+_BITMAP_FLUSH_SEC = 1.0
 
 
 def cache_enabled() -> bool:
@@ -76,6 +85,18 @@ def file_cache_path(item_id: str) -> Path:
     return files_root() / f"{item_id}.bin"
 
 
+def sparse_cache_path(item_id: str) -> Path:
+    return files_root() / f"{item_id}.sparse"
+
+
+def chunk_bitmap_path(item_id: str) -> Path:
+    return files_root() / f"{item_id}.chunks"
+
+
+def sparse_cache_enabled() -> bool:
+    return cache_enabled() and bool(getattr(settings, "CACHE_SPARSE_CHUNKS", True))
+
+
 def is_file_cached(item_id: str, size: Optional[int]) -> bool:
     path = file_cache_path(item_id)
     if not path.exists():
@@ -119,6 +140,217 @@ async def iter_file_range(
             yield data
 
 
+async def iter_file_mapped(
+    path: Path, start: int, end: int, chunk_size: int = 1024 * 1024
+) -> AsyncGenerator[memoryview, None]:
+    """Yield a byte range of a finished cache file as views of a memory map.
+
+    Pages come straight from the page cache: nothing is copied in Python and
+    no thread-pool slot is held, so the only copy is the kernel's into the
+    socket. The next window is advised WILLNEED so the kernel reads it ahead
+    instead of faulting on the event loop. Falls back to iter_file_range
+    where the file cannot be mapped.
+    """
+    if end < start:
+        return
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+    except (OSError, ValueError):
+        mm = None
+    if mm is None:
+        async for chunk in iter_file_range(path, start, end, chunk_size):
+            yield chunk
+        return
+
+    # The map is not closed explicitly: the transport may still hold views
+    # of it after the last yield, and it is unmapped once they are released.
+    view = memoryview(mm)
+    end = min(end, len(mm) - 1)
+    if hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    pos = start
+    while pos <= end:
+        n = min(chunk_size, end - pos + 1)
+        ahead = pos + n
+        if hasattr(mm, "madvise") and ahead <= end:
+            page = ahead - ahead % mmap.PAGESIZE
+            mm.madvise(mmap.MADV_WILLNEED, page, min(chunk_size, len(mm) - page))
+        yield view[pos:pos + n]
+        pos += n
+
+
+class ChunkMap:
+    """Presence bitmap for one item's sparse cache file.
+
+    The file is split into fixed-size chunks aligned to multiples of
+    `chunk_size`; bit N is set once chunk N has been written in full.
+    """
+
+    def __init__(self, item_id: str, size: int, chunk_size: int, bits: bytearray | None = None):
+        self.item_id = item_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.count = (size + chunk_size - 1) // chunk_size
+        self.bits = bits if bits is not None else bytearray((self.count + 7) // 8)
+        self.present = sum(bin(b).count("1") for b in self.bits)
+        self.path = sparse_cache_path(item_id)
+        self.valid = True
+        self._lock = asyncio.Lock()
+        self._dirty = False
+        self._flush_task: asyncio.Task | None = None
+
+    def has(self, idx: int) -> bool:
+        return bool(self.bits[idx >> 3] & (1 << (idx & 7)))
+
+    def is_complete(self) -> bool:
+        return self.present >= self.count
+
+    def runs(self, first: int, last: int) -> list[tuple[int, int, bool]]:
+        """Split chunks first..last into (first, last, present) runs."""
+        out: list[tuple[int, int, bool]] = []
+        last = min(last, self.count - 1)
+        idx = first
+        while idx <= last:
+            present = self.has(idx)
+            run_end = idx
+            while run_end + 1 <= last and self.has(run_end + 1) == present:
+                run_end += 1
+            out.append((idx, run_end, present))
+            idx = run_end + 1
+        return out
+
+    def chunk_length(self, idx: int) -> int:
+        return min(self.chunk_size, self.size - idx * self.chunk_size)
+
+    async def read(self, start: int, end: int) -> AsyncGenerator[bytes, None]:
+        touch_path(self.path)
+        async for chunk in iter_file_range(self.path, start, end):
+            yield chunk
+
+    async def write(self, idx: int, data: bytes) -> None:
+        if not self.valid or self.has(idx) or len(data) != self.chunk_length(idx):
+            return
+        try:
+            await asyncio.to_thread(self._write_sync, idx * self.chunk_size, data)
+        except Exception as e:
+            logger.warning(f"Chunk cache write failed for {self.item_id}: {e}")
+            self.valid = False
+            return
+        async with self._lock:
+            if not self.has(idx):
+                self.bits[idx >> 3] |= 1 << (idx & 7)
+                self.present += 1
+            complete = self.is_complete()
+        if complete:
+            await _finalize_chunk_map(self)
+            return
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        # One task per map saves the bitmap, so saves never overlap and
+        # chunks written in the meantime share a single write.
+        while self._dirty and self.valid:
+            await asyncio.sleep(_BITMAP_FLUSH_SEC)
+            if not self.valid:
+                return
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self._save_bitmap_sync, bytes(self.bits))
+            except Exception as e:
+                logger.warning(f"Chunk bitmap save failed for {self.item_id}: {e}")
+
+    def _write_sync(self, offset: int, data: bytes) -> None:
+        with open(self.path, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+
+    def _save_bitmap_sync(self, bits: bytes) -> None:
+        path = chunk_bitmap_path(self.item_id)
+        # Unique temp name: another worker process may save the same item.
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_BITMAP_HEADER.pack(self.size, self.chunk_size))
+                f.write(bits)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+
+def _load_chunk_map_sync(item_id: str, size: int, chunk_size: int) -> ChunkMap:
+    data_path = sparse_cache_path(item_id)
+    bitmap_path = chunk_bitmap_path(item_id)
+    if data_path.exists() and bitmap_path.exists():
+        try:
+            raw = bitmap_path.read_bytes()
+            saved_size, saved_chunk = _BITMAP_HEADER.unpack_from(raw)
+            if saved_size == size and saved_chunk == chunk_size:
+                bits = bytearray(raw[_BITMAP_HEADER.size:])
+                if len(bits) == ((size + chunk_size - 1) // chunk_size + 7) // 8:
+                    return ChunkMap(item_id, size, chunk_size, bits)
+        except Exception:
+            pass
+    data_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(data_path, "wb") as f:
+        # truncate() leaves a hole, so only written chunks take disk space
+        f.truncate(size)
+    cmap = ChunkMap(item_id, size, chunk_size)
+    cmap._save_bitmap_sync(bytes(cmap.bits))
+    return cmap
+
+
+async def get_chunk_map(item_id: str, size: int) -> Optional[ChunkMap]:
+    """Return the sparse chunk cache for an item, creating it if needed."""
+    if not sparse_cache_enabled() or size <= 0 or size > _cache_max_bytes():
+        return None
+    if is_file_cached(item_id, size):
+        return None
+    existing = _chunk_maps.get(item_id)
+    if existing and existing.valid and existing.size == size:
+        return existing
+    async with _chunk_maps_lock:
+        existing = _chunk_maps.get(item_id)
+        if existing and existing.valid and existing.size == size:
+            return existing
+        created = not sparse_cache_path(item_id).exists()
+        if created:
+            await trim_cache()
+        try:
+            cmap = await asyncio.to_thread(_load_chunk_map_sync, item_id, size, _chunk_bytes())
+        except Exception as e:
+            logger.warning(f"Chunk cache unavailable for {item_id}: {e}")
+            return None
+        _chunk_maps[item_id] = cmap
+        return cmap
+
+
+def discard_chunk_map(item_id: str) -> None:
+    cmap = _chunk_maps.pop(item_id, None)
+    if cmap:
+        cmap.valid = False
+    for path in (sparse_cache_path(item_id), chunk_bitmap_path(item_id)):
+        try:
+            path.unlink(missing_ok=True)
+        except Exception:
+            pass
+
+
+async def _finalize_chunk_map(cmap: ChunkMap) -> None:
+    # Every chunk is present: promote the sparse file to a regular cache entry.
+    try:
+        await asyncio.to_thread(os.replace, cmap.path, file_cache_path(cmap.item_id))
+        touch_path(file_cache_path(cmap.item_id))
+    except Exception as e:
+        logger.warning(f"Chunk cache finalize failed for {cmap.item_id}: {e}")
+        return
+    discard_chunk_map(cmap.item_id)
+
+
 def get_cache_task(item_id: str) -> Optional[asyncio.Task]:
     return _cache_tasks.get(item_id)
 
@@ -144,30 +376,37 @@ async def trim_cache() -> None:
     if not cache_enabled():
         return
     async with _trim_lock:
-        await asyncio.to_thread(_trim_cache_sync)
+        removed = await asyncio.to_thread(_trim_cache_sync)
+    for item_id in removed:
+        cmap = _chunk_maps.pop(item_id, None)
+        if cmap:
+            cmap.valid = False
 
 
-def _trim_cache_sync() -> None:
+def _trim_cache_sync() -> list[str]:
+    removed_sparse: list[str] = []
     max_bytes = _cache_max_bytes()
     if max_bytes <= 0:
-        return
+        return removed_sparse
     root = get_cache_root()
     files = []
     total = 0
     for dirpath, _, filenames in os.walk(root):
         for name in filenames:
-            if name.endswith(".part"):
+            if name.endswith((".part", ".chunks", ".tmp")):
                 continue
             path = Path(dirpath) / name
             try:
                 stat = path.stat()
             except Exception:
                 continue
-            total += stat.st_size
-            files.append((stat.st_mtime, stat.st_size, path))
+            # Sparse files only occupy the blocks that were actually written.
+            size = stat.st_blocks * 512 if name.endswith(".sparse") else stat.st_size
+            total += size
+            files.append((stat.st_mtime, size, path))
 
     if total <= max_bytes:
-        return
+        return removed_sparse
 
     files.sort(key=lambda x: x[0])
     for _, size, path in files:
@@ -175,9 +414,13 @@ def _trim_cache_sync() -> None:
             path.unlink(missing_ok=True)
         except Exception:
             continue
+        if path.suffix == ".sparse":
+            chunk_bitmap_path(path.stem).unlink(missing_ok=True)
+            removed_sparse.append(path.stem)
         total -= size
         if total <= max_bytes:
             break
+    return removed_sparse
 
 
 async def warm_cache_for_item(item, chat_id: int | str, user_session_string: Optional[str] = None) -> None:
@@ -269,6 +512,7 @@ async def _download_full_file(item, chat_id: int | str, user_session_string: Opt
         try:
             os.replace(tmp_path, final_path)
             touch_path(final_path)
+            discard_chunk_map(item_id)
         except Exception as e:
             logger.error(f"Cache warm rename failed: {e}")
     await trim_cache()
@@ -316,6 +560,8 @@ async def _download_parallel_pyrogram(item, chat_id: int | str, dest_path: Path)
 
     usable = []
     for client in unique:
+        if is_throttled(client):
+            continue
         try:
             if await ensure_peer_access(client, chat_id):
                 usable.append(client)
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import time
+import weakref
+from typing import Optional
+
+from pyrogram import Client
+
+from app.core.rate_limit import flood_remaining, flood_wait_seconds, note_flood
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# Concurrent stripe downloads one client may run across all streams.
+_SLOTS_PER_CLIENT = max(1, _env_int("STREAM_CLIENT_SLOTS", 2))
+# Throughput assumed for a client before it has finished a stripe.
+_PRIOR_BPS = 2.0 * 1024 * 1024
+_EWMA_ALPHA = 0.3
+
+
+def _client_label(client: Client) -> str:
+    return getattr(client, "name", None) or str(id(client))
+
+
+def _is_connected(client: Client) -> bool:
+    value = getattr(client, "is_connected", False)
+    try:
+        return bool(value() if callable(value) else value)
+    except Exception:
+        return False
+
+
+class ClientStats:
+    def __init__(self, client: Client):
+        self.client_ref = weakref.ref(client)
+        self.label = _client_label(client)
+        self.inflight = 0
+        self.bps = _PRIOR_BPS
+        self.error_rate = 0.0
+        self.bytes_total = 0
+        self.stripes = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.last_used = 0.0
+
+    def throttled(self) -> bool:
+        client = self.client_ref()
+        return client is not None and flood_remaining(client) > 0
+
+    def expected_wait(self) -> float:
+        # Time until a new stripe would finish, relative to other clients,
+        # inflated by recent errors so flaky clients get less work.
+        speed = max(self.bps, 64 * 1024) * (1.0 - min(self.error_rate, 0.9))
+        return (self.inflight + 1) / speed
+
+
+class ClientScheduler:
+    """Hands pool clients to stripe downloads in proportion to their speed.
+
+    Every stream may use every client; each client runs at most
+    STREAM_CLIENT_SLOTS stripes at once. A caller gets the free client
+    whose next stripe should finish soonest (rolling throughput, error
+    rate, current load), and clients under a FloodWait are skipped until
+    it expires (see app.core.rate_limit).
+    """
+
+    def __init__(self, slots_per_client: int = _SLOTS_PER_CLIENT):
+        self.slots_per_client = slots_per_client
+        self._stats: dict[int, ClientStats] = {}
+        self._cond = asyncio.Condition()
+
+    def stats_for(self, client: Client) -> ClientStats:
+        key = id(client)
+        stats = self._stats.get(key)
+        if stats is None or stats.client_ref() is not client:
+            stats = ClientStats(client)
+            self._stats[key] = stats
+        return stats
+
+    def _free(self, client: Client) -> bool:
+        stats = self.stats_for(client)
+        return (
+            _is_connected(client)
+            and not stats.throttled()
+            and stats.inflight < self.slots_per_client
+        )
+
+    def rank(self, clients: list[Client]) -> list[Client]:
+        """Clients ordered best-first, throttled ones last."""
+        return sorted(
+            clients,
+            key=lambda c: (self.stats_for(c).throttled(), self.stats_for(c).expected_wait()),
+        )
+
+    def _pick(self, clients: list[Client]) -> Optional[Client]:
+        best = None
+        best_wait = 0.0
+        for client in clients:
+            if not self._free(client):
+                continue
+            wait = self.stats_for(client).expected_wait()
+            if best is None or wait < best_wait:
+                best = client
+                best_wait = wait
+        return best
+
+    def try_acquire_idle(self, clients: list[Client], exclude: Client | None = None) -> Optional[Client]:
+        """Take a free slot on another client without waiting, preferring idle ones."""
+        now = time.monotonic()
+        best = None
+        best_wait = (0, 0.0)
+        for client in clients:
+            if client is exclude or not self._free(client):
+                continue
+            stats = self.stats_for(client)
+            wait = (stats.inflight, stats.expected_wait())
+            if best is None or wait < best_wait:
+                best = client
+                best_wait = wait
+        if best is not None:
+            stats = self.stats_for(best)
+            stats.inflight += 1
+            stats.last_used = now
+        return best
+
+    def _next_wakeup(self, clients: list[Client]) -> float:
+        delays = [flood_remaining(c) for c in clients if flood_remaining(c) > 0]
+        return max(0.05, min(delays)) if delays else 1.0
+
+    async def acquire(self, clients: list[Client], timeout: float | None = None) -> Client:
+        if not clients:
+            raise RuntimeError("No clients available for stripe download.")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        async with self._cond:
+            while True:
+                client = self._pick(clients)
+                if client is not None:
+                    stats = self.stats_for(client)
+                    stats.inflight += 1
+                    stats.last_used = time.monotonic()
+                    return client
+                wait = self._next_wakeup(clients)
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError("No pool client became free in time.")
+                    wait = min(wait, remaining)
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(
+        self,
+        client: Client,
+        nbytes: int = 0,
+        elapsed: float = 0.0,
+        error: BaseException | None = None,
+    ) -> None:
+        stats = self.stats_for(client)
+        stats.inflight = max(0, stats.inflight - 1)
+        if error is None and nbytes > 0 and elapsed > 0:
+            stats.bps = (1 - _EWMA_ALPHA) * stats.bps + _EWMA_ALPHA * (nbytes / elapsed)
+            stats.error_rate *= (1 - _EWMA_ALPHA)
+            stats.bytes_total += nbytes
+            stats.stripes += 1
+        elif error is not None and not isinstance(error, asyncio.CancelledError):
+            stats.errors += 1
+            stats.error_rate = (1 - _EWMA_ALPHA) * stats.error_rate + _EWMA_ALPHA
+            wait = flood_wait_seconds(error)
+            if wait is not None:
+                note_flood(client, wait)
+        async with self._cond:
+            self._cond.notify_all()
+
+    def penalize(self, client: Client, nbytes: int, elapsed: float) -> None:
+        """Fold in a lower bound for a stripe that lost a hedge race.
+
+        The loser is cancelled before it reports, so without this a
+        straggling client would keep its old throughput estimate.
+        """
+        if nbytes <= 0 or elapsed <= 0:
+            return
+        stats = self.stats_for(client)
+        bound = nbytes / elapsed
+        if bound < stats.bps:
+            stats.bps = (1 - _EWMA_ALPHA) * stats.bps + _EWMA_ALPHA * bound
+
+    def snapshot(self) -> list[dict]:
+        rows = []
+        for stats in self._stats.values():
+            client = stats.client_ref()
+            if client is None:
+                continue
+            rows.append({
+                "label": stats.label,
+                "inflight": stats.inflight,
+                "mb_per_s": round(stats.bps / 1024 / 1024, 2),
+                "error_rate": round(stats.error_rate, 3),
+                "flood_wait_sec": round(flood_remaining(client), 1),
+                "stripes": stats.stripes,
+                "errors": stats.errors,
+                "hedges": stats.hedges,
+                "hedge_wins": stats.hedge_wins,
+                "bytes": stats.bytes_total,
+            })
+        rows.sort(key=lambda r: r["label"])
+        return rows
+
+
+scheduler = ClientScheduler()
@@ -0,0 +1,446 @@
+import bisect
+import struct
+from typing import Awaitable, Callable
+
+# Where a player looks before it can start: the MP4 `moov` box or the
+# Matroska `Cues` element (plus the file head that points at them).
+
+Reader = Callable[[int, int], Awaitable[bytes]]
+
+_HEAD_BYTES = 64 * 1024
+_MAX_BOXES = 64
+# Indexes larger than this are left to the normal stream path.
+_MAX_INDEX_BYTES = 64 * 1024 * 1024
+
+_EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+_MKV_SEGMENT = 0x18538067
+_MKV_SEEKHEAD = 0x114D9B74
+_MKV_SEEK = 0x4DBB
+_MKV_SEEK_ID = 0x53AB
+_MKV_SEEK_POS = 0x53AC
+_MKV_CUES = 0x1C53BB6B
+_MKV_CLUSTER = 0x1F43B675
+_MKV_INFO = 0x1549A966
+_MKV_TIMECODE_SCALE = 0x2AD7B1
+_MKV_DURATION = 0x4489
+_MKV_TRACKS = 0x1654AE6B
+_MKV_TRACK_ENTRY = 0xAE
+_MKV_TRACK_NUMBER = 0xD7
+_MKV_TRACK_TYPE = 0x83
+_MKV_CUE_POINT = 0xBB
+_MKV_CUE_TIME = 0xB3
+_MKV_CUE_TRACK_POSITIONS = 0xB7
+_MKV_CUE_TRACK = 0xF7
+
+
+class _Buffered:
+    """Serve small reads from the file head, the rest from `read`."""
+
+    def __init__(self, read: Reader, head: bytes):
+        self.read_source = read
+        self.head = head
+
+    async def read(self, offset: int, length: int) -> bytes:
+        if offset + length <= len(self.head):
+            return self.head[offset:offset + length]
+        return await self.read_source(offset, length)
+
+
+async def find_index_ranges(read: Reader, size: int) -> list[tuple[int, int]]:
+    """Byte ranges holding the file head and its seek index, or [] if unknown.
+
+    `read(offset, length)` returns up to `length` bytes at `offset`.
+    """
+    if size <= 0:
+        return []
+    head = bytes(await read(0, min(size, _HEAD_BYTES)))
+    reader = _Buffered(read, head)
+    if len(head) >= 8 and head[4:8] == b"ftyp":
+        index = await _mp4_moov(reader, size)
+    elif head.startswith(_EBML_MAGIC):
+        index = await _mkv_cues(reader, size)
+    else:
+        return []
+    ranges = [(0, len(head) - 1)]
+    if index and index[1] - index[0] < _MAX_INDEX_BYTES:
+        ranges.append(index)
+    return ranges
+
+
+async def _mp4_moov(reader: _Buffered, size: int) -> tuple[int, int] | None:
+    offset = 0
+    for _ in range(_MAX_BOXES):
+        if offset + 8 > size:
+            return None
+        header = await reader.read(offset, 16)
+        if len(header) < 8:
+            return None
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        if box_size == 1:
+            if len(header) < 16:
+                return None
+            box_size = struct.unpack(">Q", header[8:16])[0]
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < 8:
+            return None
+        if box_type == b"moov":
+            return offset, min(size, offset + box_size) - 1
+        offset += box_size
+    return None
+
+
+def _ebml_id(buf: bytes, pos: int) -> tuple[int, int] | None:
+    if pos >= len(buf):
+        return None
+    first = buf[pos]
+    length = 1
+    mask = 0x80
+    while length <= 4 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 4 or pos + length > len(buf):
+        return None
+    return int.from_bytes(buf[pos:pos + length], "big"), length
+
+
+def _ebml_size(buf: bytes, pos: int) -> tuple[int | None, int] | None:
+    if pos >= len(buf):
+        return None
+    first = buf[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(buf):
+        return None
+    value = first & (mask - 1)
+    for b in buf[pos + 1:pos + length]:
+        value = (value << 8) | b
+    if value == (1 << (7 * length)) - 1:
+        return None, length  # unknown size
+    return value, length
+
+
+def _ebml_element(buf: bytes, pos: int) -> tuple[int, int, int | None] | None:
+    """(id, data offset, data size) of the element at `pos`."""
+    ident = _ebml_id(buf, pos)
+    if ident is None:
+        return None
+    size = _ebml_size(buf, pos + ident[1])
+    if size is None:
+        return None
+    return ident[0], pos + ident[1] + size[1], size[0]
+
+
+def _mkv_top_level(head: bytes) -> tuple[int, list[tuple[int, int, int, int]]] | None:
+    """Segment data offset and (id, pos, data, size) of the Segment children in
+    `head`, up to the first Cluster."""
+    element = _ebml_element(head, 0)
+    if element is None or element[2] is None:
+        return None
+    segment = _ebml_element(head, element[1] + element[2])
+    if segment is None or segment[0] != _MKV_SEGMENT:
+        return None
+    segment_start = segment[1]
+    children = []
+    pos = segment_start
+    for _ in range(_MAX_BOXES):
+        child = _ebml_element(head, pos)
+        if child is None or child[2] is None:
+            break
+        ident, data, length = child
+        if ident == _MKV_CLUSTER:
+            # Media data starts here; nothing ahead of it points at Cues.
+            break
+        children.append((ident, pos, data, length))
+        pos = data + length
+    return segment_start, children
+
+
+async def _mkv_cues(reader: _Buffered, size: int) -> tuple[int, int] | None:
+    head = reader.head
+    top = _mkv_top_level(head)
+    if top is None:
+        return None
+    segment_start, children = top
+    cues_pos = None
+    for ident, pos, data, length in children:
+        if ident == _MKV_CUES:
+            cues_pos = pos
+            break
+        if ident == _MKV_SEEKHEAD:
+            cues_pos = _seekhead_cues(head[data:data + length], segment_start)
+            if cues_pos is not None:
+                break
+    if cues_pos is None or cues_pos >= size:
+        return None
+    header = await reader.read(cues_pos, 12)
+    cues = _ebml_element(header, 0)
+    if cues is None or cues[0] != _MKV_CUES or cues[2] is None:
+        return None
+    return cues_pos, min(size, cues_pos + cues[1] + cues[2]) - 1
+
+
+def _seekhead_cues(buf: bytes, segment_start: int) -> int | None:
+    pos = 0
+    while pos < len(buf):
+        seek = _ebml_element(buf, pos)
+        if seek is None or seek[2] is None:
+            return None
+        ident, data, length = seek
+        if ident == _MKV_SEEK:
+            target = None
+            position = None
+            inner = data
+            while inner < data + length:
+                field = _ebml_element(buf, inner)
+                if field is None or field[2] is None:
+                    break
+                fid, fdata, flen = field
+                value = buf[fdata:fdata + flen]
+                if fid == _MKV_SEEK_ID:
+                    target = int.from_bytes(value, "big")
+                elif fid == _MKV_SEEK_POS:
+                    position = int.from_bytes(value, "big")
+                inner = fdata + flen
+            if target == _MKV_CUES and position is not None:
+                return segment_start + position
+        pos = data + length
+    return None
+
+
+# --- Keyframes -----------------------------------------------------------
+# Just-in-time HLS cuts segments at video keyframes. Their times come from
+# the same index a player reads: stss/stts in the MP4 moov box (shifted to
+# presentation time by ctts and the edit list), or the Matroska Cues (with
+# Info for the timescale and duration).
+
+async def find_keyframes(read: Reader, size: int) -> tuple[list[float], float] | None:
+    """Video keyframe times and the duration in seconds, or None if unknown."""
+    if size <= 0:
+        return None
+    head = bytes(await read(0, min(size, _HEAD_BYTES)))
+    reader = _Buffered(read, head)
+    if len(head) >= 8 and head[4:8] == b"ftyp":
+        moov = await _mp4_moov(reader, size)
+        if not moov or moov[1] - moov[0] >= _MAX_INDEX_BYTES:
+            return None
+        return _mp4_keyframes(bytes(await reader.read(moov[0], moov[1] - moov[0] + 1)))
+    if head.startswith(_EBML_MAGIC):
+        return await _mkv_keyframes(reader, size)
+    return None
+
+
+def _mp4_boxes(buf: bytes, start: int, end: int):
+    pos = start
+    while pos + 8 <= end:
+        box_size, box_type = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if box_size == 1:
+            if pos + 16 > end:
+                return
+            box_size = struct.unpack_from(">Q", buf, pos + 8)[0]
+            header = 16
+        elif box_size == 0:
+            box_size = end - pos
+        if box_size < header or pos + box_size > end:
+            return
+        yield box_type, pos + header, pos + box_size
+        pos += box_size
+
+
+def _mp4_find(buf: bytes, start: int, end: int, *path: bytes) -> tuple[int, int] | None:
+    """Payload (start, end) of the box at `path` below [start, end)."""
+    for name in path:
+        for box_type, payload, box_end in _mp4_boxes(buf, start, end):
+            if box_type == name:
+                start, end = payload, box_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def _mp4_composition_offsets(moov: bytes, ctts: tuple[int, int] | None) -> Callable[[int], int]:
+    """Sample number (1-based) -> ctts offset, 0 without a ctts box."""
+    if not ctts:
+        return lambda sample: 0
+    count = struct.unpack_from(">I", moov, ctts[0] + 4)[0]
+    if ctts[0] + 8 + count * 8 > ctts[1]:
+        return lambda sample: 0
+    # Offsets are signed in version 1 and, in practice, in version 0 too.
+    runs = struct.unpack_from(">" + "Ii" * count, moov, ctts[0] + 8)
+    firsts, offsets = [], []
+    sample = 1
+    for idx in range(count):
+        firsts.append(sample)
+        offsets.append(runs[idx * 2 + 1])
+        sample += runs[idx * 2]
+    return lambda sample: offsets[bisect.bisect_right(firsts, sample) - 1] if sample >= 1 and firsts else 0
+
+
+def _mp4_edit(moov: bytes, elst: tuple[int, int] | None) -> tuple[int, int, int | None]:
+    """(empty lead-in in movie units, media start in track units, edit
+    duration in movie units) from the first edits of an elst box."""
+    lead_in, media_time, duration = 0, 0, None
+    if not elst:
+        return lead_in, media_time, duration
+    version = moov[elst[0]]
+    count = struct.unpack_from(">I", moov, elst[0] + 4)[0]
+    fmt, entry_size = (">Qq", 20) if version == 1 else (">Ii", 12)
+    pos = elst[0] + 8
+    for _ in range(count):
+        if pos + entry_size > elst[1]:
+            break
+        segment_duration, entry_media_time = struct.unpack_from(fmt, moov, pos)
+        pos += entry_size
+        if entry_media_time == -1:
+            lead_in += segment_duration
+            continue
+        media_time, duration = entry_media_time, segment_duration or None
+        break
+    return lead_in, media_time, duration
+
+
+def _mp4_keyframes(moov: bytes) -> tuple[list[float], float] | None:
+    if len(moov) < 8:
+        return None
+    payload = 16 if struct.unpack_from(">I", moov, 0)[0] == 1 else 8
+    movie_timescale = 0
+    mvhd = _mp4_find(moov, payload, len(moov), b"mvhd")
+    if mvhd:
+        movie_timescale = struct.unpack_from(">I", moov, mvhd[0] + (20 if moov[mvhd[0]] == 1 else 12))[0]
+    for box_type, start, end in _mp4_boxes(moov, payload, len(moov)):
+        if box_type != b"trak":
+            continue
+        hdlr = _mp4_find(moov, start, end, b"mdia", b"hdlr")
+        if not hdlr or moov[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+            continue
+        mdhd = _mp4_find(moov, start, end, b"mdia", b"mdhd")
+        stbl = _mp4_find(moov, start, end, b"mdia", b"minf", b"stbl")
+        if not mdhd or not stbl:
+            return None
+        timescale_at = mdhd[0] + (20 if moov[mdhd[0]] == 1 else 12)
+        timescale = struct.unpack_from(">I", moov, timescale_at)[0]
+        stts = _mp4_find(moov, *stbl, b"stts")
+        if not timescale or not stts:
+            return None
+        count = struct.unpack_from(">I", moov, stts[0] + 4)[0]
+        if stts[0] + 8 + count * 8 > stts[1]:
+            return None
+        deltas = struct.unpack_from(f">{count * 2}I", moov, stts[0] + 8)
+        stss = _mp4_find(moov, *stbl, b"stss")
+        sync = None
+        if stss:
+            sync_count = struct.unpack_from(">I", moov, stss[0] + 4)[0]
+            if stss[0] + 8 + sync_count * 4 > stss[1]:
+                return None
+            sync = struct.unpack_from(f">{sync_count}I", moov, stss[0] + 8)
+        offset = _mp4_composition_offsets(moov, _mp4_find(moov, *stbl, b"ctts"))
+        lead_in, media_time, edit_duration = _mp4_edit(moov, _mp4_find(moov, start, end, b"edts", b"elst"))
+        lead_in_sec = lead_in / movie_timescale if movie_timescale else 0.0
+
+        def pts(sample: int, dts: int) -> float:
+            return (dts + offset(sample) - media_time) / timescale + lead_in_sec
+
+        # Presentation times of the sync samples (every sample without stss).
+        times: list[float] = []
+        sample = 1
+        dts = 0
+        idx = 0
+        for run in range(count):
+            run_count, delta = deltas[run * 2], deltas[run * 2 + 1]
+            if sync is None:
+                times.extend(pts(sample + n, dts + n * delta) for n in range(run_count))
+            else:
+                while idx < len(sync) and sync[idx] < sample + run_count:
+                    times.append(pts(sync[idx], dts + (sync[idx] - sample) * delta))
+                    idx += 1
+            sample += run_count
+            dts += run_count * delta
+        if not times or not dts:
+            # Fragmented MP4 keeps its samples in moof boxes.
+            return None
+        if edit_duration and movie_timescale:
+            duration = (lead_in + edit_duration) / movie_timescale
+        else:
+            duration = (dts - media_time) / timescale + lead_in_sec
+        # Keyframes before the edit start are shown from 0.
+        return sorted({max(0.0, t) for t in times}), duration
+    return None
+
+
+def _ebml_uint(buf: bytes, data: int, length: int) -> int:
+    return int.from_bytes(buf[data:data + length], "big")
+
+
+def _ebml_children(buf: bytes, start: int, end: int):
+    pos = start
+    while pos < end:
+        element = _ebml_element(buf, pos)
+        if element is None or element[2] is None or element[1] + element[2] > end:
+            return
+        yield element
+        pos = element[1] + element[2]
+
+
+async def _mkv_keyframes(reader: _Buffered, size: int) -> tuple[list[float], float] | None:
+    head = reader.head
+    top = _mkv_top_level(head)
+    if top is None:
+        return None
+    _, children = top
+    scale = 1_000_000
+    duration = None
+    video_tracks: set[int] = set()
+    for ident, _, data, length in children:
+        if data + length > len(head):
+            continue
+        if ident == _MKV_INFO:
+            for fid, fdata, flen in _ebml_children(head, data, data + length):
+                if fid == _MKV_TIMECODE_SCALE:
+                    scale = _ebml_uint(head, fdata, flen) or scale
+                elif fid == _MKV_DURATION and flen in (4, 8):
+                    duration = struct.unpack(">f" if flen == 4 else ">d", head[fdata:fdata + flen])[0]
+        elif ident == _MKV_TRACKS:
+            for tid, tdata, tlen in _ebml_children(head, data, data + length):
+                if tid != _MKV_TRACK_ENTRY:
+                    continue
+                number = kind = None
+                for fid, fdata, flen in _ebml_children(head, tdata, tdata + tlen):
+                    if fid == _MKV_TRACK_NUMBER:
+                        number = _ebml_uint(head, fdata, flen)
+                    elif fid == _MKV_TRACK_TYPE:
+                        kind = _ebml_uint(head, fdata, flen)
+                if kind == 1 and number is not None:
+                    video_tracks.add(number)
+    if not duration:
+        return None
+    cues_range = await _mkv_cues(reader, size)
+    if not cues_range or cues_range[1] - cues_range[0] >= _MAX_INDEX_BYTES:
+        return None
+    cues = bytes(await reader.read(cues_range[0], cues_range[1] - cues_range[0] + 1))
+    element = _ebml_element(cues, 0)
+    if element is None or element[2] is None:
+        return None
+    times = []
+    for pid, pdata, plen in _ebml_children(cues, element[1], min(len(cues), element[1] + element[2])):
+        if pid != _MKV_CUE_POINT:
+            continue
+        cue_time = None
+        tracks = set()
+        for fid, fdata, flen in _ebml_children(cues, pdata, pdata + plen):
+            if fid == _MKV_CUE_TIME:
+                cue_time = _ebml_uint(cues, fdata, flen)
+            elif fid == _MKV_CUE_TRACK_POSITIONS:
+                for tid, tdata, tlen in _ebml_children(cues, fdata, fdata + flen):
+                    if tid == _MKV_CUE_TRACK:
+                        tracks.add(_ebml_uint(cues, tdata, tlen))
+        if cue_time is None or (video_tracks and tracks and not tracks & video_tracks):
+            continue
+        times.append(cue_time * scale / 1e9)
+    if not times:
+        return None
+    return sorted(set(times)), duration * scale / 1e9
@@ -0,0 +1,295 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from contextlib import suppress
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# ffmpeg processes allowed at once; the rest wait in priority order.
+_WORKERS = max(1, _env_int("HLS_FFMPEG_WORKERS", 1))
+# Stream-copy remuxes (just-in-time HLS segments) get their own slots so a
+# viewer's next segment never waits behind a full transcode.
+_REMUX_WORKERS = max(1, _env_int("HLS_REMUX_WORKERS", 4))
+# Niceness for ffmpeg so transcodes yield CPU to the web process.
+_NICE = max(0, min(19, _env_int("HLS_FFMPEG_NICE", 10)))
+_FINISHED_KEEP_SEC = 3600.0
+
+# Lower runs first.
+PRIORITY_PLAYER = 0
+PRIORITY_BACKGROUND = 10
+
+
+class Job:
+    """Progress of one HLS build, possibly spanning several ffmpeg runs."""
+
+    def __init__(self, job_id: str, label: str, priority: int):
+        self.id = job_id
+        self.label = label
+        self.priority = priority
+        self.state = "queued"  # queued | downloading | waiting | running | done | failed
+        self.step = ""
+        self.duration: float | None = None
+        self.out_time = 0.0
+        self.speed: float | None = None
+        self.size = 0
+        self.downloaded = 0
+        self.created = time.time()
+        self.started: float | None = None
+        self.run_started: float | None = None
+        self.finished: float | None = None
+        self.error = ""
+
+    def bump(self, priority: int) -> None:
+        if priority < self.priority:
+            self.priority = priority
+            _gate.wake()
+            _remux_gate.wake()
+
+    @property
+    def percent(self) -> float | None:
+        if self.state == "done":
+            return 100.0
+        if not self.duration:
+            return None
+        return round(min(100.0, self.out_time * 100 / self.duration), 1)
+
+    @property
+    def eta(self) -> float | None:
+        if self.state != "running" or not self.duration or self.out_time <= 0 or not self.run_started:
+            return None
+        elapsed = time.time() - self.run_started
+        return round(max(0.0, elapsed * (self.duration - self.out_time) / self.out_time), 1)
+
+    def finish(self, ok: bool, error: str = "") -> None:
+        self.state = "done" if ok else "failed"
+        self.error = error[:300]
+        self.finished = time.time()
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "label": self.label,
+            "state": self.state,
+            "step": self.step,
+            "priority": self.priority,
+            "percent": self.percent,
+            "eta_sec": self.eta,
+            "speed": self.speed,
+            "duration_sec": self.duration,
+            "downloaded": self.downloaded,
+            "size": self.size,
+            "queued_sec": round((self.started or time.time()) - self.created, 1),
+            "error": self.error,
+        }
+
+
+class _Gate:
+    """Counting slot pool that hands free slots to the best-priority waiter."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.running = 0
+        self.waiters: list[tuple[int, Job, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    async def acquire(self, job: Job) -> None:
+        if self.running < self.slots and not self.waiters:
+            self.running += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        entry = (next(self._seq), job, fut)
+        self.waiters.append(entry)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+            elif fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.running -= 1
+        self.wake()
+
+    def wake(self) -> None:
+        while self.running < self.slots and self.waiters:
+            entry = min(self.waiters, key=lambda e: (e[1].priority, e[0]))
+            self.waiters.remove(entry)
+            if entry[2].done():
+                continue
+            self.running += 1
+            entry[2].set_result(None)
+
+
+_gate = _Gate(_WORKERS)
+_remux_gate = _Gate(_REMUX_WORKERS)
+_jobs: dict[str, Job] = {}
+
+
+def get_job(job_id: str) -> Job | None:
+    return _jobs.get(job_id)
+
+
+def new_job(job_id: str, label: str, priority: int = PRIORITY_BACKGROUND) -> Job:
+    now = time.time()
+    for key, job in list(_jobs.items()):
+        if job.finished and now - job.finished > _FINISHED_KEEP_SEC:
+            _jobs.pop(key, None)
+    job = Job(job_id, label, priority)
+    _jobs[job_id] = job
+    return job
+
+
+def _lower_priority() -> None:
+    try:
+        os.nice(_NICE)
+    except Exception:
+        pass
+
+
+def _parse_progress(job: Job, line: str) -> None:
+    key, _, value = line.partition("=")
+    value = value.strip()
+    if key in ("out_time_us", "out_time_ms"):
+        # Both are microseconds in practice (out_time_ms is misnamed).
+        try:
+            job.out_time = max(job.out_time, int(value) / 1_000_000)
+        except ValueError:
+            pass
+    elif key == "speed" and value.endswith("x"):
+        try:
+            job.speed = float(value[:-1])
+        except ValueError:
+            pass
+
+
+async def _drain(stream: asyncio.StreamReader, tail: deque) -> None:
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        tail.append(line.decode(errors="replace"))
+
+
+async def _pump(feed: AsyncIterator[bytes], proc: asyncio.subprocess.Process) -> None:
+    try:
+        async for chunk in feed:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg exited early; its return code says why
+    except BaseException:
+        # A truncated input must not look like a finished build.
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    finally:
+        with suppress(Exception):
+            await feed.aclose()
+        with suppress(Exception):
+            proc.stdin.close()
+
+
+async def run_ffmpeg(
+    cmd: list[str],
+    job: Job | None = None,
+    step: str = "",
+    feed: AsyncIterator[bytes] | None = None,
+    remux: bool = False,
+) -> tuple[int, str]:
+    """Run an ffmpeg command in a worker slot; returns (returncode, stderr tail).
+
+    With `job`, the slot is taken in the job's priority order and
+    `-progress` output updates its percentage and ETA. `feed` (an async
+    generator) is written to stdin once the process starts; an error from it
+    kills ffmpeg and is re-raised. `remux` runs use the separate remux slots.
+    """
+    job = job or Job("", step, PRIORITY_BACKGROUND)
+    cmd = [cmd[0], "-hide_banner", "-nostats", "-progress", "pipe:1", *cmd[1:]]
+    gate = _remux_gate if remux else _gate
+    job.state = "waiting"
+    await gate.acquire(job)
+    proc = None
+    feed_task = None
+    try:
+        job.state = "running"
+        job.step = step
+        job.out_time = 0.0
+        job.run_started = time.time()
+        if job.started is None:
+            job.started = job.run_started
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if feed is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=_lower_priority if _NICE and os.name == "posix" else None,
+        )
+        if feed is not None:
+            feed_task = asyncio.create_task(_pump(feed, proc))
+        tail: deque[str] = deque(maxlen=40)
+        stderr_task = asyncio.create_task(_drain(proc.stderr, tail))
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            _parse_progress(job, line.decode(errors="replace"))
+        await stderr_task
+        returncode = await proc.wait()
+        if feed_task is not None:
+            if not feed_task.done():
+                feed_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await feed_task
+        return returncode, "".join(tail)
+    except BaseException:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if feed_task is not None and not feed_task.done():
+            feed_task.cancel()
+        raise
+    finally:
+        gate.release()
+
+
+async def run_probe(cmd: list[str], timeout: float = 60.0, input: bytes | None = None) -> tuple[int, str, str]:
+    """Run ffprobe (cheap, not queued); returns (returncode, stdout, stderr)."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(input), timeout=timeout)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
+def snapshot() -> dict:
+    return {
+        "workers": _WORKERS,
+        "running": _gate.running,
+        "waiting": len(_gate.waiters),
+        "remux_running": _remux_gate.running,
+        "remux_waiting": len(_remux_gate.waiters),
+        "jobs": [job.as_dict() for job in sorted(_jobs.values(), key=lambda j: j.created, reverse=True)],
+    }
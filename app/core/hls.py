@@ -1,24 +1,61 @@
 import asyncio
+import json
 import logging
 import os
 import shutil
 import subprocess
+import time
+from contextlib import aclosing
 from pathlib import Path
 from typing import Optional
 
-from pyrogram import Client
 
-from app.core.config import settings
+from app.core import ffmpeg_jobs
+from app.core.ffmpeg_jobs import PRIORITY_BACKGROUND, PRIORITY_PLAYER
+from app.core.streaming import open_stream
 from app.core.telethon_storage import get_message as tl_get_message, download_media as tl_download_media
+from app.core.user_sessions import user_session
 
 logger = logging.getLogger(__name__)
 
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
 HLS_ROOT = Path("app/static/hls")
 HLS_ROOT.mkdir(parents=True, exist_ok=True)
 
 SEGMENT_TIME = 6
 _hls_tasks: dict[str, asyncio.Task] = {}
 _hls_lock = asyncio.Lock()
+# Feed ffmpeg from the parallel Telegram stream instead of downloading first.
+_STREAM_INGEST = _env_int("HLS_STREAM_INGEST", 1) > 0
+# Enough for ffprobe to see the streams of an MKV or faststart MP4.
+_PROBE_HEAD_BYTES = 8 * 1024 * 1024
+# Codecs hls.js plays from MPEG-TS without re-encoding.
+COPY_VIDEO = {"h264"}
+COPY_AUDIO = {"aac"}
+# 8-bit 4:2:0 H.264 profiles; High 10 / 4:2:2 / 4:4:4 don't play in browsers.
+_COPY_PROFILES = {"Constrained Baseline", "Baseline", "Main", "High"}
+# Transcoded rungs: (height, width, kbps, maxrate kbps); bufsize is 2x maxrate.
+_LADDER = (
+    (1080, 1920, 4500, 5000),
+    (720, 1280, 2500, 3000),
+    (480, 854, 1200, 1500),
+)
+# Build only the top rendition up front; lower ones once the title has had
+# HLS_RENDITION_VIEWS player views.
+_LAZY_RENDITIONS = _env_int("HLS_LAZY_RENDITIONS", 1) > 0
+_RENDITION_VIEWS = max(0, _env_int("HLS_RENDITION_VIEWS", 5))
+# Retry delay after a failed rendition build.
+_RENDITION_RETRY_SEC = 600.0
+_views: dict[str, int] = {}
+_rendition_tasks: dict[tuple[str, int], asyncio.Task] = {}
+_rendition_failed: dict[tuple[str, int], float] = {}
 
 
 def hls_dir(item_id: str) -> Path:
@@ -38,8 +75,34 @@ def hls_url_for(item_id: str) -> str:
     return f"/static/hls/{item_id}/index.m3u8"
 
 
+def _playlist_complete(path: Path) -> bool:
+    """True once ffmpeg has closed the EVENT playlist at `path`."""
+    try:
+        with open(path, "rb") as fh:
+            fh.seek(max(0, fh.seek(0, os.SEEK_END) - 64))
+            return b"#EXT-X-ENDLIST" in fh.read()
+    except OSError:
+        return False
+
+
 def is_hls_ready(item_id: str) -> bool:
-    return playlist_path(item_id).exists() or master_playlist_path(item_id).exists()
+    """The build has finished. Builds write EVENT playlists as they go, so a
+    playlist on disk isn't enough: every local variant must be closed."""
+    master = master_playlist_path(item_id)
+    try:
+        lines = master.read_text().splitlines()
+    except OSError:
+        return _playlist_complete(playlist_path(item_id))
+    variants = [line for line in lines if line and not line.startswith("#")]
+    return bool(variants) and all(_playlist_complete(hls_dir(item_id) / v) for v in variants)
+
+
+def hls_status(item_id: str) -> dict:
+    job = ffmpeg_jobs.get_job(str(item_id))
+    return {
+        "ready": is_hls_ready(str(item_id)),
+        "job": job.as_dict() if job else None,
+    }
 
 
 def _ffmpeg_available() -> bool:
@@ -53,7 +116,13 @@ def _is_video(name: str, mime_type: Optional[str]) -> bool:
     return lower.endswith((".mp4", ".mkv", ".webm", ".mov", ".avi", ".mpeg", ".mpg"))
 
 
-async def ensure_hls(item, chat_id: str, user_session_string: Optional[str] = None) -> None:
+async def ensure_hls(
+    item,
+    chat_id: str,
+    user_session_string: Optional[str] = None,
+    priority: int = PRIORITY_PLAYER,
+) -> None:
+    """Queue an HLS build; player pages go ahead of background prepares."""
     if not item or not item.parts:
         return
     if not _is_video(item.name, item.mime_type):
@@ -64,14 +133,20 @@ async def ensure_hls(item, chat_id: str, user_session_string: Optional[str] = No
 
     item_id = str(item.id)
     if is_hls_ready(item_id):
+        if priority == PRIORITY_PLAYER:
+            _count_view(item_id)
         return
 
     async with _hls_lock:
         existing = _hls_tasks.get(item_id)
         if existing and not existing.done():
+            job = ffmpeg_jobs.get_job(item_id)
+            if job:
+                job.bump(priority)
             return
+        job = ffmpeg_jobs.new_job(item_id, item.name or item_id, priority)
         _hls_tasks[item_id] = asyncio.create_task(
-            _build_hls(item, chat_id, user_session_string)
+            _build_hls(item, chat_id, user_session_string, job)
         )
 
 
@@ -80,47 +155,258 @@ async def _download_source(item, chat_id: str, user_session_string: Optional[str
     if chat_id == "me":
         if not user_session_string:
             raise RuntimeError("Missing user session for Saved Messages download.")
-        client = Client(
-            name=f"hls_dl_{item.id}",
-            api_id=settings.API_ID,
-            api_hash=settings.API_HASH,
-            session_string=user_session_string,
-            in_memory=True
-        )
-        await client.connect()
-        try:
+        async with user_session(user_session_string) as client:
             msg = await client.get_messages("me", msg_id)
             await client.download_media(msg, file_name=str(dest_path))
-        finally:
-            await client.disconnect()
     else:
         msg = await tl_get_message(msg_id)
         await tl_download_media(msg, str(dest_path))
 
 
-async def _run_ffmpeg(cmd: list[str]) -> subprocess.CompletedProcess:
-    return await asyncio.to_thread(
-        subprocess.run,
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    )
+async def _run_ffmpeg(cmd: list[str], job: ffmpeg_jobs.Job, step: str, feed=None) -> subprocess.CompletedProcess:
+    returncode, stderr = await ffmpeg_jobs.run_ffmpeg(cmd, job, step, feed=feed)
+    return subprocess.CompletedProcess(cmd, returncode, "", stderr)
 
 
-async def _has_audio(source_path: Path) -> bool:
+async def _probe_source(source: str, head: Optional[bytes] = None) -> Optional[dict]:
+    """Codec, size and bitrate of the first video/audio streams of `source`
+    (or of `head` piped in), or None if ffprobe can't read them, e.g. from a
+    head whose moov box sits at the end."""
     cmd = [
         "ffprobe", "-v", "error",
-        "-select_streams", "a",
-        "-show_entries", "stream=index",
-        "-of", "csv=p=0",
-        str(source_path)
+        "-show_entries",
+        "format=duration,bit_rate:stream=codec_type,codec_name,profile,width,height,bit_rate:stream_tags=BPS",
+        "-of", "json",
+        "-i", "pipe:0" if head is not None else source,
+    ]
+    try:
+        returncode, stdout, _ = await ffmpeg_jobs.run_probe(cmd, input=head)
+        info = json.loads(stdout or "{}")
+    except Exception:
+        return None
+    streams = info.get("streams") or []
+    video = next((st for st in streams if st.get("codec_type") == "video"), None)
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+    if returncode != 0 or video is None:
+        return None
+    fmt = info.get("format") or {}
+    # MKV carries stream bitrates only as BPS tags; else take the container's.
+    video_bitrate = _int(video.get("bit_rate")) or _int((video.get("tags") or {}).get("BPS"))
+    if not video_bitrate and _int(fmt.get("bit_rate")):
+        video_bitrate = max(0, _int(fmt.get("bit_rate")) - (128_000 if audio else 0)) or None
+    try:
+        duration = float(fmt.get("duration") or 0) or None
+    except ValueError:
+        duration = None
+    return {
+        "duration": duration,
+        "has_audio": audio is not None,
+        "audio_codec": audio.get("codec_name") if audio else None,
+        "video_codec": video.get("codec_name"),
+        "profile": video.get("profile"),
+        "width": _int(video.get("width")),
+        "height": _int(video.get("height")),
+        "video_bitrate": video_bitrate,
+    }
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(value) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def _ladder(info: dict) -> list[dict]:
+    """Renditions for `info`, best first.
+
+    A browser-playable source is copied as the top rendition; otherwise the
+    top is transcoded at the source size (at most 1080p). Lower rungs are
+    only added well below the top, and no rung exceeds the source bitrate.
+    """
+    height = info.get("height") or 0
+    source_kbps = (info.get("video_bitrate") or 0) // 1000
+
+    def rung(box, kbps, maxrate):
+        if source_kbps and source_kbps < kbps:
+            maxrate = maxrate * source_kbps // kbps
+            kbps = source_kbps
+        return {"copy": False, "box": box, "kbps": kbps, "maxrate": maxrate}
+
+    if info.get("video_codec") in COPY_VIDEO and info.get("profile") in _COPY_PROFILES:
+        rungs = [{"copy": True}]
+        top = height or _LADDER[0][0]
+    elif not height or height > _LADDER[0][0]:
+        h, w, kbps, maxrate = _LADDER[0]
+        rungs = [rung((w, h), kbps, maxrate)]
+        top = h
+    else:
+        # Native size, at the bitrate of the smallest rung that covers it.
+        _, _, kbps, maxrate = min((r for r in _LADDER if r[0] >= height), key=lambda r: r[0])
+        rungs = [rung(None, kbps, maxrate)]
+        top = height
+    for h, w, kbps, maxrate in _LADDER:
+        if h <= top * 0.85:
+            rungs.append(rung((w, h), kbps, maxrate))
+    return rungs
+
+
+def _scale_filter(box: tuple[int, int]) -> str:
+    w, h = box
+    return f"scale=w={w}:h={h}:force_original_aspect_ratio=decrease:force_divisible_by=2"
+
+
+def _video_args(idx: int, rung: dict, info: dict, copy_top: bool) -> list[str]:
+    """Codec options for output video stream `idx`."""
+    if rung["copy"]:
+        # Not used for encoding; hlsenc leaves a variant without a bitrate
+        # out of master.m3u8.
+        kbps = (info.get("video_bitrate") or 0) // 1000 or _LADDER[0][2]
+        return [f"-c:v:{idx}", "copy", f"-b:v:{idx}", f"{kbps}k"]
+    # Keyframes on a shared grid (the copied rendition's, else every segment)
+    # and no scene-cut keyframes keep segments aligned across renditions,
+    # including ones built later.
+    keyframes = "source" if copy_top else f"expr:gte(t,n_forced*{SEGMENT_TIME})"
+    return [
+        f"-c:v:{idx}", "libx264", "-preset", "veryfast",
+        f"-b:v:{idx}", f"{rung['kbps']}k", f"-maxrate:v:{idx}", f"{rung['maxrate']}k",
+        f"-bufsize:v:{idx}", f"{rung['maxrate'] * 2}k",
+        f"-force_key_frames:v:{idx}", keyframes, "-sc_threshold", "0",
     ]
-    result = await _run_ffmpeg(cmd)
-    return bool((result.stdout or "").strip())
 
 
-async def _build_hls(item, chat_id: str, user_session_string: Optional[str]) -> None:
+def _audio_args(info: dict) -> list[str]:
+    return ["-c:a", "copy" if info.get("audio_codec") in COPY_AUDIO else "aac", "-b:a", "128k"]
+
+
+def _multi_variant_cmd(source: str, folder: Path, info: dict, rungs: list[dict]) -> list[str]:
+    """One ffmpeg run writing `rungs` as v0..vN plus master.m3u8."""
+    has_audio = info["has_audio"]
+    for idx in range(len(rungs)):
+        (folder / f"v{idx}").mkdir(exist_ok=True)
+    copy_top = rungs[0]["copy"]
+    scaled = [idx for idx, r in enumerate(rungs) if not r["copy"] and r["box"]]
+    cmd = ["ffmpeg", "-y", "-i", source]
+    if scaled:
+        parts = []
+        if len(scaled) > 1:
+            parts.append("[0:v]split=%d%s" % (len(scaled), "".join(f"[s{idx}]" for idx in scaled)))
+        for idx in scaled:
+            src = f"[s{idx}]" if len(scaled) > 1 else "[0:v]"
+            parts.append(f"{src}{_scale_filter(rungs[idx]['box'])}[v{idx}out]")
+        cmd += ["-filter_complex", ";".join(parts)]
+    for idx in range(len(rungs)):
+        cmd += ["-map", f"[v{idx}out]" if idx in scaled else "0:v:0"]
+    if has_audio:
+        # Duplicate audio stream for each rendition
+        for _ in rungs:
+            cmd += ["-map", "0:a:0?"]
+
+    for idx, r in enumerate(rungs):
+        cmd += _video_args(idx, r, info, copy_top)
+    if has_audio:
+        cmd += _audio_args(info)
+        var_map = " ".join(f"v:{idx},a:{idx}" for idx in range(len(rungs)))
+    else:
+        var_map = " ".join(f"v:{idx}" for idx in range(len(rungs)))
+
+    cmd += [
+        "-f", "hls",
+        "-hls_time", str(SEGMENT_TIME),
+        "-hls_list_size", "0",
+        # EVENT playlists are valid to play while the build is still running.
+        "-hls_playlist_type", "event",
+        "-hls_flags", "independent_segments",
+        "-hls_segment_filename", str(folder / "v%v/seg_%05d.ts"),
+        "-master_pl_name", "master.m3u8",
+        "-var_stream_map", var_map,
+        str(folder / "v%v/index.m3u8")
+    ]
+    return cmd
+
+
+def _build_rungs(info: dict) -> list[dict]:
+    """Rungs encoded by the main build: all of them, or just the top when
+    lower renditions are built on demand."""
+    rungs = _ladder(info)
+    return rungs[:1] if _LAZY_RENDITIONS else rungs
+
+
+def _clear_variants(folder: Path) -> None:
+    """Drop output of a failed multi-variant run so it isn't served."""
+    master_playlist_path(folder.name).unlink(missing_ok=True)
+    (folder / "ladder.json").unlink(missing_ok=True)
+    for variant in folder.glob("v[0-9]*"):
+        shutil.rmtree(variant, ignore_errors=True)
+
+
+async def _stream_ingest(
+    item,
+    chat_id: str,
+    user_session_string: Optional[str],
+    job: ffmpeg_jobs.Job,
+    folder: Path,
+) -> bool:
+    """Multi-variant build fed from the parallel Telegram stream.
+
+    ffmpeg reads stdin while the bytes are also written to `source`, so
+    segments (and master.m3u8) appear during the download. Returns False when
+    the container can't be read sequentially or ffmpeg fails; `source` is
+    kept whenever the download itself completed.
+    """
+    plan = await open_stream(item, session_string=user_session_string, download=True)
+    plan.stats.background = True
+    part_path = folder / "source.part"
+    complete = False
+    try:
+        size = plan.file_size
+        if not size:
+            return False
+        job.state = "downloading"
+        job.size = size
+        head = bytearray()
+        async with aclosing(plan.iter_range(0, min(size, _PROBE_HEAD_BYTES) - 1)) as chunks:
+            async for chunk in chunks:
+                head += chunk
+        info = await _probe_source("pipe:0", bytes(head))
+        if not info:
+            return False
+        job.duration = info["duration"]
+        if not info["video_bitrate"] and info["duration"]:
+            # A piped head has no container bitrate; estimate it from the size.
+            info["video_bitrate"] = max(0, int(size * 8 / info["duration"]) - (128_000 if info["has_audio"] else 0)) or None
+
+        async def feed():
+            nonlocal complete
+            with open(part_path, "wb") as fh:
+                await asyncio.to_thread(fh.write, head)
+                job.downloaded = len(head)
+                yield bytes(head)
+                if len(head) < size:
+                    async with aclosing(plan.iter_range(len(head), size - 1)) as chunks:
+                        async for chunk in chunks:
+                            await asyncio.to_thread(fh.write, chunk)
+                            job.downloaded += len(chunk)
+                            yield chunk
+            complete = job.downloaded == size
+
+        _save_ladder(folder, info)
+        cmd = _multi_variant_cmd("pipe:0", folder, info, _build_rungs(info))
+        result = await _run_ffmpeg(cmd, job, "multi-variant (streaming)", feed=feed())
+        if complete:
+            os.replace(part_path, folder / "source")
+        if result.returncode == 0 and complete and master_playlist_path(folder.name).exists():
+            return True
+        logger.warning(f"HLS streaming multi-variant failed for {item.name}: {result.stderr[:300]}")
+        return False
+    finally:
+        await plan.close()
+        if not complete:
+            part_path.unlink(missing_ok=True)
+
+
+async def _build_hls(item, chat_id: str, user_session_string: Optional[str], job: ffmpeg_jobs.Job) -> None:
+    ok = False
     try:
         folder = hls_dir(str(item.id))
         folder.mkdir(parents=True, exist_ok=True)
@@ -128,67 +414,42 @@ async def _build_hls(item, chat_id: str, user_session_string: Optional[str]) ->
         playlist = folder / "index.m3u8"
         master_playlist = folder / "master.m3u8"
 
+        if not source_path.exists() and _STREAM_INGEST:
+            try:
+                if await _stream_ingest(item, chat_id, user_session_string, job, folder):
+                    ok = True
+                    return
+            except Exception as e:
+                logger.warning(f"HLS stream ingest failed for {item.name}: {e}")
+            _clear_variants(folder)
+
         if not source_path.exists():
+            job.state = "downloading"
             await _download_source(item, chat_id, user_session_string, source_path)
 
-        if playlist.exists() or master_playlist.exists():
+        if is_hls_ready(str(item.id)):
+            ok = True
             return
-
-        # Multi-bitrate HLS (creates quality options)
-        try:
-            (folder / "v0").mkdir(exist_ok=True)
-            (folder / "v1").mkdir(exist_ok=True)
-            (folder / "v2").mkdir(exist_ok=True)
-
-            has_audio = await _has_audio(source_path)
-            # Map 3 video renditions (1080p/720p/480p) with optional audio
-            filter_complex = (
-                "[0:v]split=3[v1][v2][v3];"
-                "[v1]scale=w=1920:h=1080:force_original_aspect_ratio=decrease[v1out];"
-                "[v2]scale=w=1280:h=720:force_original_aspect_ratio=decrease[v2out];"
-                "[v3]scale=w=854:h=480:force_original_aspect_ratio=decrease[v3out]"
-            )
-            cmd = [
-                "ffmpeg", "-y",
-                "-i", str(source_path),
-                "-filter_complex", filter_complex,
-                "-map", "[v1out]",
-                "-map", "[v2out]",
-                "-map", "[v3out]",
-            ]
-            if has_audio:
-                # Duplicate audio stream for each rendition
-                cmd += ["-map", "0:a:0?", "-map", "0:a:0?", "-map", "0:a:0?"]
-
-            cmd += [
-                "-c:v:0", "libx264", "-preset", "veryfast", "-b:v:0", "4500k", "-maxrate:v:0", "5000k", "-bufsize:v:0", "10000k",
-                "-c:v:1", "libx264", "-preset", "veryfast", "-b:v:1", "2500k", "-maxrate:v:1", "3000k", "-bufsize:v:1", "6000k",
-                "-c:v:2", "libx264", "-preset", "veryfast", "-b:v:2", "1200k", "-maxrate:v:2", "1500k", "-bufsize:v:2", "3000k",
-            ]
-            if has_audio:
-                cmd += [
-                    "-c:a", "aac", "-b:a", "128k"
-                ]
-                var_map = "v:0,a:0 v:1,a:1 v:2,a:2"
-            else:
-                var_map = "v:0 v:1 v:2"
-
-            cmd += [
-                "-f", "hls",
-                "-hls_time", str(SEGMENT_TIME),
-                "-hls_list_size", "0",
-                "-hls_flags", "independent_segments",
-                "-hls_segment_filename", str(folder / "v%v/seg_%05d.ts"),
-                "-master_pl_name", "master.m3u8",
-                "-var_stream_map", var_map,
-                str(folder / "v%v/index.m3u8")
-            ]
-            result = await _run_ffmpeg(cmd)
-            if result.returncode == 0 and master_playlist.exists():
-                return
-            logger.warning(f"HLS multi-variant failed for {item.name}: {result.stderr[:300]}")
-        except Exception as e:
-            logger.warning(f"HLS multi-variant error for {item.name}: {e}")
+        info = await _probe_source(str(source_path))
+        job.duration = info["duration"] if info else None
+
+        # Multi-bitrate HLS (creates quality options). Without a probe the
+        # ladder can't know about audio, so the single-rendition build below
+        # (which keeps ffmpeg's default streams) is used instead.
+        if info is None:
+            logger.warning(f"HLS probe failed for {item.name}; building a single rendition")
+        else:
+            try:
+                _save_ladder(folder, info)
+                cmd = _multi_variant_cmd(str(source_path), folder, info, _build_rungs(info))
+                result = await _run_ffmpeg(cmd, job, "multi-variant")
+                if result.returncode == 0 and master_playlist.exists():
+                    ok = True
+                    return
+                logger.warning(f"HLS multi-variant failed for {item.name}: {result.stderr[:300]}")
+            except Exception as e:
+                logger.warning(f"HLS multi-variant error for {item.name}: {e}")
+            _clear_variants(folder)
 
         segment_pattern = str(folder / "seg_%05d.ts")
         cmd = [
@@ -198,13 +459,15 @@ async def _build_hls(item, chat_id: str, user_session_string: Optional[str]) ->
             "-f", "hls",
             "-hls_time", str(SEGMENT_TIME),
             "-hls_list_size", "0",
+            "-hls_playlist_type", "event",
             "-hls_flags", "independent_segments",
             "-hls_segment_filename", segment_pattern,
             str(playlist)
         ]
 
-        result = await _run_ffmpeg(cmd)
-        if result.returncode != 0:
+        result = await _run_ffmpeg(cmd, job, "copy")
+        ok = result.returncode == 0
+        if not ok:
             logger.warning(f"HLS copy failed for {item.name}: {result.stderr[:300]}")
             # Fallback to transcode (CPU heavy but more compatible)
             cmd = [
@@ -217,12 +480,150 @@ async def _build_hls(item, chat_id: str, user_session_string: Optional[str]) ->
                 "-f", "hls",
                 "-hls_time", str(SEGMENT_TIME),
                 "-hls_list_size", "0",
+                "-hls_playlist_type", "event",
                 "-hls_flags", "independent_segments",
                 "-hls_segment_filename", segment_pattern,
                 str(playlist)
             ]
-            result = await _run_ffmpeg(cmd)
-            if result.returncode != 0:
+            result = await _run_ffmpeg(cmd, job, "transcode")
+            ok = result.returncode == 0
+            if not ok:
                 logger.error(f"HLS transcode failed for {item.name}: {result.stderr[:300]}")
+                job.error = result.stderr[-300:]
     except Exception as e:
         logger.error(f"HLS build error for {getattr(item, 'name', 'item')}: {e}")
+        job.error = str(e)
+    finally:
+        job.finish(ok, job.error)
+
+
+# --- Lazy renditions -----------------------------------------------------
+# The main build encodes only the top rendition. Once the title is popular
+# enough the lower rungs are transcoded from the kept source, and each is
+# added to master.m3u8 only when complete: players load VOD level playlists
+# once, so a level listed early would be stuck on whatever it got first.
+
+def _save_ladder(folder: Path, info: dict) -> None:
+    (folder / "ladder.json").write_text(json.dumps({"info": info, "rungs": _ladder(info)}))
+
+
+def _load_ladder(folder: Path) -> Optional[dict]:
+    try:
+        return json.loads((folder / "ladder.json").read_text())
+    except Exception:
+        return None
+
+
+def _rung_resolution(info: dict, box: list[int]) -> tuple[int, int]:
+    w, h = box
+    src_w, src_h = info.get("width"), info.get("height")
+    if not src_w or not src_h:
+        return w, h
+    scale = min(w / src_w, h / src_h)
+    return int(src_w * scale) // 2 * 2, int(src_h * scale) // 2 * 2
+
+
+def _publish_rendition(folder: Path, idx: int, ladder: dict) -> None:
+    """Add built rendition `idx` to master.m3u8."""
+    path = master_playlist_path(folder.name)
+    lines = path.read_text().rstrip("\n").split("\n")
+    uri = f"v{idx}/index.m3u8"
+    if uri in lines:
+        return
+    info = ladder["info"]
+    rung = ladder["rungs"][idx]
+    audio_kbps = 128 if info.get("has_audio") else 0
+    w, h = _rung_resolution(info, rung["box"])
+    lines += [
+        f"#EXT-X-STREAM-INF:BANDWIDTH={(rung['maxrate'] + audio_kbps) * 1000},RESOLUTION={w}x{h}",
+        uri,
+    ]
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def _rendition_cmd(source: str, out: Path, info: dict, rung: dict, copy_top: bool) -> list[str]:
+    cmd = ["ffmpeg", "-y", "-i", source, "-map", "0:v:0", "-vf", _scale_filter(rung["box"])]
+    if info.get("has_audio"):
+        cmd += ["-map", "0:a:0?"]
+    cmd += _video_args(0, rung, info, copy_top)
+    if info.get("has_audio"):
+        cmd += _audio_args(info)
+    cmd += [
+        "-f", "hls",
+        "-hls_time", str(SEGMENT_TIME),
+        "-hls_list_size", "0",
+        "-hls_playlist_type", "vod",
+        "-hls_flags", "independent_segments",
+        "-hls_segment_filename", str(out / "seg_%05d.ts"),
+        str(out / "index.m3u8"),
+    ]
+    return cmd
+
+
+async def _build_rendition(folder: Path, idx: int, ladder: dict, job: ffmpeg_jobs.Job) -> None:
+    ok = False
+    # Built aside and moved into place whole, so v{idx} is only ever complete.
+    work = folder / f"v{idx}.part"
+    try:
+        shutil.rmtree(work, ignore_errors=True)
+        work.mkdir()
+        info = ladder["info"]
+        job.duration = info.get("duration")
+        cmd = _rendition_cmd(str(folder / "source"), work, info, ladder["rungs"][idx], ladder["rungs"][0]["copy"])
+        result = await _run_ffmpeg(cmd, job, f"rendition v{idx}")
+        ok = result.returncode == 0 and (work / "index.m3u8").exists()
+        if ok:
+            shutil.rmtree(folder / f"v{idx}", ignore_errors=True)
+            os.replace(work, folder / f"v{idx}")
+            _publish_rendition(folder, idx, ladder)
+        else:
+            logger.warning(f"HLS rendition v{idx} failed for {folder.name}: {result.stderr[:300]}")
+            job.error = result.stderr[-300:]
+    except Exception as e:
+        logger.warning(f"HLS rendition v{idx} error for {folder.name}: {e}")
+        job.error = str(e)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        if not ok:
+            _rendition_failed[(folder.name, idx)] = time.monotonic()
+        job.finish(ok, job.error)
+
+
+def request_rendition(item_id: str, idx: int, priority: int = PRIORITY_PLAYER) -> bool:
+    """Queue lower rendition `idx` of a finished build unless it exists or is
+    already queued; False if there is no such rendition."""
+    folder = hls_dir(item_id)
+    ladder = _load_ladder(folder)
+    if not ladder or not 0 < idx < len(ladder["rungs"]) or not (folder / "source").exists():
+        return False
+    # Renditions are added to master.m3u8, which ffmpeg owns until it is done.
+    if not is_hls_ready(item_id):
+        return False
+    if (folder / f"v{idx}" / "index.m3u8").exists():
+        return True
+    key = (folder.name, idx)
+    running = _rendition_tasks.get(key)
+    if running and not running.done():
+        job = ffmpeg_jobs.get_job(f"{item_id}/v{idx}")
+        if job:
+            job.bump(priority)
+        return True
+    failed = _rendition_failed.get(key)
+    if failed is not None and time.monotonic() - failed < _RENDITION_RETRY_SEC:
+        return True
+    job = ffmpeg_jobs.new_job(f"{item_id}/v{idx}", f"{item_id} v{idx}", priority)
+    _rendition_tasks[key] = asyncio.create_task(_build_rendition(folder, idx, ladder, job))
+    return True
+
+
+def _count_view(item_id: str) -> None:
+    if not _LAZY_RENDITIONS or not _RENDITION_VIEWS:
+        return
+    views = _views.get(item_id, 0) + 1
+    _views[item_id] = views
+    if views == _RENDITION_VIEWS:
+        ladder = _load_ladder(hls_dir(item_id))
+        for idx in range(1, len(ladder["rungs"]) if ladder else 0):
+            request_rendition(item_id, idx, PRIORITY_BACKGROUND)
@@ -0,0 +1,381 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import secrets
+import shutil
+import time
+from contextlib import aclosing
+from pathlib import Path
+from typing import Optional
+
+from app.core import ffmpeg_jobs
+from app.core.container_index import find_keyframes
+from app.core.ffmpeg_jobs import PRIORITY_BACKGROUND, PRIORITY_PLAYER
+from app.core.hls import COPY_AUDIO, COPY_VIDEO, SEGMENT_TIME, _ffmpeg_available, _is_video, hls_dir
+from app.core.streaming import open_stream, parallel_conf, parse_range, resolve_chat_id
+
+logger = logging.getLogger(__name__)
+
+# Just-in-time HLS: keyframe times are read once from the container index and
+# a complete VOD playlist is published straight away; each segment is
+# stream-copied on first request from only the bytes it needs, then cached.
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+_JIT_ENABLED = _env_int("HLS_JIT", 1) > 0
+# Retry delay after a failed keyframe probe (Telegram errors etc.).
+_PROBE_COOLDOWN_SEC = 600.0
+_SEGMENT_TIMEOUT_SEC = 120.0
+
+_probing: dict[str, float] = {}
+_segment_tasks: dict[tuple[str, int], tuple[asyncio.Task, ffmpeg_jobs.Job]] = {}
+
+
+def jit_dir(item_id: str) -> Path:
+    return hls_dir(item_id) / "jit"
+
+
+def jit_url_for(item_id: str) -> str:
+    return f"/hls/jit/{item_id}/index.m3u8"
+
+
+def jit_playlist_path(item_id: str) -> Path:
+    return jit_dir(item_id) / "index.m3u8"
+
+
+def is_jit_ready(item_id: str) -> bool:
+    return jit_playlist_path(item_id).exists()
+
+
+def is_jit_segment_cached(item_id: str, index: int) -> bool:
+    return _segment_path(item_id, index).exists()
+
+
+def _segment_path(item_id: str, index: int) -> Path:
+    return jit_dir(item_id) / f"seg_{index:05d}.ts"
+
+
+class _SourceServer:
+    """Loopback HTTP range server over the stream engine, so ffmpeg can seek
+    into a Telegram file and read only what a segment needs."""
+
+    def __init__(self):
+        self.server: asyncio.AbstractServer | None = None
+        self.port = 0
+        self.token = secrets.token_urlsafe(16)
+        self.items: dict[str, object] = {}
+        self._lock = asyncio.Lock()
+
+    async def url_for(self, item) -> str:
+        async with self._lock:
+            if self.server is None:
+                self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+                self.port = self.server.sockets[0].getsockname()[1]
+        self.items[str(item.id)] = item
+        return f"http://127.0.0.1:{self.port}/{self.token}/{item.id}"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        plan = None
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=30)
+            lines = request.decode("latin-1").split("\r\n")
+            method, path, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(":")
+                if key:
+                    headers[key.strip().lower()] = value.strip()
+            parts = path.strip("/").split("/")
+            item = self.items.get(parts[1]) if len(parts) == 2 and parts[0] == self.token else None
+            if item is None or method not in ("GET", "HEAD"):
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            plan = await open_stream(item)
+            plan.stats.background = True
+            size = plan.file_size
+            range_header = headers.get("range")
+            start, end = parse_range(range_header, size)
+            if start >= size:
+                writer.write(
+                    f"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */{size}\r\n"
+                    "Content-Length: 0\r\nConnection: close\r\n\r\n".encode()
+                )
+                return
+            head = [
+                "HTTP/1.1 206 Partial Content" if range_header else "HTTP/1.1 200 OK",
+                f"Content-Length: {end - start + 1}",
+                "Content-Type: application/octet-stream",
+                "Accept-Ranges: bytes",
+                "Connection: close",
+            ]
+            if range_header:
+                head.append(f"Content-Range: bytes {start}-{end}/{size}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+            # ffmpeg asks for open-ended ranges and hangs up once it has what
+            # it needs; reading one stripe at a time (on the engine's grid)
+            # keeps that from pulling several stripes it will never read.
+            stripe = parallel_conf()[1]
+            pos = start if method == "GET" else end + 1
+            while pos <= end:
+                piece_end = min(end, (pos // stripe + 1) * stripe - 1)
+                async with aclosing(plan.iter_range(pos, piece_end)) as chunks:
+                    async for chunk in chunks:
+                        writer.write(chunk)
+                        await writer.drain()
+                pos = piece_end + 1
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass  # ffmpeg hangs up whenever it seeks
+        except Exception as e:
+            logger.debug("JIT source request failed: %s", e)
+        finally:
+            if plan is not None:
+                await plan.close()
+            writer.close()
+
+
+_source_server = _SourceServer()
+
+
+def _cut_segments(keyframes: list[float], duration: float) -> list[tuple[float, float]]:
+    """(start, duration) per segment, cut at keyframes >= SEGMENT_TIME apart."""
+    keyframes = [t for t in keyframes if 0 <= t < duration]
+    if not keyframes:
+        return []
+    starts = [0.0]
+    for t in keyframes[1:]:
+        if t - starts[-1] >= SEGMENT_TIME and duration - t >= 1.0:
+            starts.append(t)
+    ends = starts[1:] + [duration]
+    return [(round(start, 6), round(end - start, 6)) for start, end in zip(starts, ends)]
+
+
+def _write_playlist(item_id: str, segments: list[tuple[float, float]]) -> None:
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{math.ceil(max(d for _, d in segments))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for idx, (_, dur) in enumerate(segments):
+        lines.append(f"#EXTINF:{dur:.3f},")
+        lines.append(f"/hls/jit/{item_id}/seg_{idx:05d}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    path = jit_playlist_path(item_id)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def _load_index(item_id: str) -> Optional[dict]:
+    try:
+        return json.loads((jit_dir(item_id) / "index.json").read_text())
+    except Exception:
+        return None
+
+
+def _save_index(item_id: str, index: dict) -> None:
+    folder = jit_dir(item_id)
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / "index.json").write_text(json.dumps(index))
+
+
+async def _probe_codecs(url: str) -> tuple[Optional[str], Optional[str]]:
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name",
+        "-of", "json",
+        url,
+    ]
+    returncode, stdout, _ = await ffmpeg_jobs.run_probe(cmd)
+    if returncode != 0:
+        raise RuntimeError("ffprobe failed")
+    video = audio = None
+    for stream in json.loads(stdout or "{}").get("streams") or []:
+        if stream.get("codec_type") == "video" and video is None:
+            video = stream.get("codec_name")
+        elif stream.get("codec_type") == "audio" and audio is None:
+            audio = stream.get("codec_name")
+    return video, audio
+
+
+async def _build_index(item) -> None:
+    item_id = str(item.id)
+    plan = await open_stream(item)
+    plan.stats.background = True
+    try:
+        async def read(offset: int, length: int) -> bytes:
+            end = min(plan.file_size, offset + length) - 1
+            buf = bytearray()
+            async with aclosing(plan.iter_range(offset, end)) as chunks:
+                async for chunk in chunks:
+                    buf += chunk
+            return bytes(buf)
+
+        found = await find_keyframes(read, plan.file_size)
+    finally:
+        await plan.close()
+    if not found:
+        _save_index(item_id, {"eligible": False, "reason": "no keyframe index"})
+        return
+    video, audio = await _probe_codecs(await _source_server.url_for(item))
+    if video not in COPY_VIDEO:
+        _save_index(item_id, {"eligible": False, "reason": f"video codec {video}"})
+        return
+    keyframes, duration = found
+    segments = _cut_segments(keyframes, duration)
+    if not segments:
+        _save_index(item_id, {"eligible": False, "reason": "no keyframes"})
+        return
+    _save_index(item_id, {
+        "eligible": True,
+        "duration": duration,
+        "segments": segments,
+        "audio": None if audio is None else ("copy" if audio in COPY_AUDIO else "aac"),
+    })
+    _write_playlist(item_id, segments)
+
+
+def schedule_jit_index(item) -> None:
+    """Probe `item` for JIT HLS in the background; cheap to call on every render."""
+    if not _JIT_ENABLED or not item or not item.parts or not _is_video(item.name, item.mime_type):
+        return
+    if resolve_chat_id(item) == "me" or not _ffmpeg_available():
+        return
+    item_id = str(item.id)
+    if (jit_dir(item_id) / "index.json").exists():
+        return
+    now = time.monotonic()
+    last = _probing.get(item_id)
+    if last is not None and now - last < _PROBE_COOLDOWN_SEC:
+        return
+    _probing[item_id] = now
+
+    async def _run():
+        try:
+            await _build_index(item)
+        except Exception as e:
+            logger.warning(f"JIT HLS probe failed for {item.name}: {e}")
+
+    asyncio.create_task(_run())
+
+
+def jit_hls_url(item) -> str:
+    """JIT playlist URL for `item`, or "" while it is still being probed."""
+    item_id = str(item.id)
+    if is_jit_ready(item_id):
+        return jit_url_for(item_id)
+    schedule_jit_index(item)
+    return ""
+
+
+async def _make_segment(item, index: int, index_data: dict, job: ffmpeg_jobs.Job) -> Path:
+    """Stream-copy segment `index` into the cache.
+
+    Input seeking only lands on *some* keyframe at or before the target, and
+    `-t` cuts on decode time, so ffmpeg reads from a little before the start
+    and the segment muxer splits exactly at the segment's two keyframes.
+    Its split times count from the seek point, even with `-copyts`.
+    """
+    item_id = str(item.id)
+    path = _segment_path(item_id, index)
+    start, duration = index_data["segments"][index]
+    end = start + duration
+    seek = max(0.0, start - 0.5)
+    cuts = [t - seek for t in (start, end) if 0 < t < index_data["duration"] - 0.01]
+    audio = index_data.get("audio")
+    work = jit_dir(item_id) / f".seg_{index:05d}"
+    work.mkdir(parents=True, exist_ok=True)
+    cmd = [
+        "ffmpeg", "-y",
+        "-ss", f"{seek:.3f}",
+        "-t", f"{end - seek + 1:.3f}",
+        "-i", await _source_server.url_for(item),
+        "-map", "0:v:0",
+    ]
+    if audio:
+        cmd += ["-map", "0:a:0"]
+        cmd += ["-c:a", "copy"] if audio == "copy" else ["-c:a", "aac", "-b:a", "128k"]
+    cmd += [
+        "-c:v", "copy",
+        # Source timestamps keep consecutive segments continuous.
+        "-copyts",
+        "-muxdelay", "0",
+        "-muxpreload", "0",
+        "-f", "segment",
+        "-segment_format", "mpegts",
+        "-segment_time_delta", "0.05",
+    ]
+    if cuts:
+        cmd += ["-segment_times", ",".join(f"{t:.6f}" for t in cuts)]
+    else:
+        cmd += ["-segment_time", str(int(duration) + 3600)]
+    cmd.append(str(work / "piece_%d.ts"))
+    piece = work / ("piece_1.ts" if start > 0 else "piece_0.ts")
+    try:
+        returncode, stderr = await asyncio.wait_for(
+            ffmpeg_jobs.run_ffmpeg(cmd, job, "segment", remux=True),
+            timeout=_SEGMENT_TIMEOUT_SEC,
+        )
+        if returncode != 0 or not piece.exists():
+            raise RuntimeError(f"segment remux failed: {stderr[-300:]}")
+        os.replace(piece, path)
+        return path
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def _segment_task(item, index: int, index_data: dict, priority: int) -> asyncio.Task:
+    key = (str(item.id), index)
+    running = _segment_tasks.get(key)
+    if running is not None:
+        task, job = running
+        job.bump(priority)
+        return task
+    job = ffmpeg_jobs.Job(f"{key[0]}:{index}", f"{item.name} #{index}", priority)
+    task = asyncio.create_task(_make_segment(item, index, index_data, job))
+    _segment_tasks[key] = (task, job)
+    task.add_done_callback(lambda _t: _segment_tasks.pop(key, None))
+    return task
+
+
+async def jit_segment(item, index: int, ticket=None) -> Optional[Path]:
+    """Path of segment `index`, remuxed now if it isn't cached yet; also
+    starts on the next segment so sequential playback finds it ready.
+
+    An admission `ticket` is held until the remux finishes, even if the
+    player hangs up first.
+    """
+    try:
+        item_id = str(item.id)
+        index_data = _load_index(item_id)
+        if not index_data or not index_data.get("eligible"):
+            return None
+        segments = index_data["segments"]
+        if not 0 <= index < len(segments):
+            return None
+        path = _segment_path(item_id, index)
+        if not path.exists():
+            task = _segment_task(item, index, index_data, PRIORITY_PLAYER)
+            if ticket is not None:
+                task.add_done_callback(lambda _t, ticket=ticket: ticket.release())
+                ticket = None
+            # Shielded: a player that gives up on a segment doesn't waste the remux.
+            path = await asyncio.shield(task)
+        following = index + 1
+        if following < len(segments) and not _segment_path(item_id, following).exists():
+            task = _segment_task(item, following, index_data, PRIORITY_BACKGROUND)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return path
+    finally:
+        if ticket is not None:
+            ticket.release()
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import time
+
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# Request budget per client for API calls (messages, chats, replies).
+# File parts are fetched on media sessions and are not budgeted here.
+_RATE_PER_SEC = max(0.5, _env_float("TG_CLIENT_RPS", 20.0))
+_BURST = max(1.0, _env_float("TG_CLIENT_BURST", 30.0))
+
+
+def flood_wait_seconds(exc: BaseException) -> float | None:
+    """Seconds Telegram asked us to back off, if `exc` is a FloodWait."""
+    name = type(exc).__name__.upper()
+    text = str(exc).upper()
+    if "FLOOD" not in name and "FLOOD_WAIT" not in text:
+        return None
+    for attr in ("value", "seconds", "x"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, (int, float)) and value >= 0:
+            return float(value)
+    return 5.0
+
+
+class ClientLimiter:
+    """Token bucket plus FloodWait deadline for one Telegram client."""
+
+    def __init__(self, label: str, rate: float = _RATE_PER_SEC, burst: float = _BURST):
+        self.label = label
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.flood_until = 0.0
+        self.floods = 0
+        self.calls = 0
+
+    def flood_remaining(self, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.flood_until - now)
+
+    def note_flood(self, seconds: float) -> None:
+        until = time.monotonic() + seconds
+        if until > self.flood_until:
+            self.flood_until = until
+            self.floods += 1
+            logger.warning(f"{self.label} hit FloodWait for {seconds:.0f}s")
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def wait_turn(self, max_flood_wait: float) -> None:
+        """Sleep out a short FloodWait and the request budget.
+
+        A FloodWait longer than `max_flood_wait` is raised straight away so
+        the caller can pick another client instead of stalling.
+        """
+        while True:
+            now = time.monotonic()
+            remaining = self.flood_remaining(now)
+            if remaining > max_flood_wait:
+                raise FloodWait(value=int(remaining) + 1)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.calls += 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def limiter_for(client: Client) -> ClientLimiter:
+    limiter = getattr(client, "_rate_limiter", None)
+    if limiter is None:
+        limiter = ClientLimiter(getattr(client, "name", None) or str(id(client)))
+        try:
+            client._rate_limiter = limiter
+        except Exception:
+            pass
+    return limiter
+
+
+def flood_remaining(client: Client | None) -> float:
+    if client is None:
+        return 0.0
+    limiter = getattr(client, "_rate_limiter", None)
+    return limiter.flood_remaining() if limiter else 0.0
+
+
+def is_throttled(client: Client | None) -> bool:
+    return flood_remaining(client) > 0
+
+
+def note_flood(client: Client, seconds: float) -> None:
+    limiter_for(client).note_flood(seconds)
+
+
+def install_rate_limiter(client: Client | None) -> Client | None:
+    """Route every API call of `client` through its limiter.
+
+    Pyrogram normally sleeps through FloodWaits below `sleep_threshold`
+    without telling anyone. The wrapper asks for them to be raised, records
+    the deadline where the stream scheduler and storage client picker can
+    see it, and then applies the same sleep-or-raise rule itself.
+    """
+    if client is None or getattr(client, "_rate_limited_invoke", False):
+        return client
+    limiter = limiter_for(client)
+    original = client.invoke
+
+    async def invoke(
+        query,
+        retries: int = Session.MAX_RETRIES,
+        timeout: float = Session.WAIT_TIMEOUT,
+        sleep_threshold: float | None = None,
+    ):
+        threshold = client.sleep_threshold if sleep_threshold is None else sleep_threshold
+        while True:
+            await limiter.wait_turn(threshold)
+            try:
+                return await original(query, retries, timeout, 0)
+            except FloodWait as e:
+                wait = flood_wait_seconds(e) or 0.0
+                limiter.note_flood(wait)
+                if wait > threshold:
+                    raise
+
+    client.invoke = invoke
+    client._rate_limited_invoke = True
+    return client
+
+
+def snapshot(clients: list[Client]) -> list[dict]:
+    rows = []
+    seen = set()
+    for client in clients:
+        if client is None or id(client) in seen:
+            continue
+        seen.add(id(client))
+        limiter = limiter_for(client)
+        rows.append({
+            "label": limiter.label,
+            "flood_wait_sec": round(limiter.flood_remaining(), 1),
+            "floods": limiter.floods,
+            "calls": limiter.calls,
+            "tokens": round(limiter.tokens, 1),
+        })
+    return rows
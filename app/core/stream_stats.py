@@ -0,0 +1,163 @@
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# Finished streams kept for the admin view.
+_RECENT_MAX = max(10, _env_int("STREAM_STATS_RECENT", 200))
+# A consumer wait shorter than this is scheduling noise, not a stall.
+_STALL_MIN_SEC = 0.2
+
+
+class StreamStats:
+    """Delivery metrics for one streamed response."""
+
+    def __init__(self, item_id: str, name: str, file_size: int, download: bool = False):
+        self.item_id = item_id
+        self.name = name
+        self.file_size = file_size
+        self.download = download
+        # Cache priming and other server-side reads: listed, not aggregated.
+        self.background = False
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.first_byte: float | None = None
+        self.ended: float | None = None
+        self.bytes = 0
+        self.sources: list[str] = []
+        self.fallbacks: list[dict] = []
+        self.stalls = 0
+        self.stall_sec = 0.0
+        # label -> [stripes, bytes, seconds]
+        self.stripes: dict[str, list] = {}
+
+    def note_bytes(self, nbytes: int) -> None:
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+        self.bytes += nbytes
+
+    def note_source(self, label: str) -> None:
+        if self.fallbacks and self.fallbacks[-1]["to"] is None:
+            self.fallbacks[-1]["to"] = label
+        if not self.sources or self.sources[-1] != label:
+            self.sources.append(label)
+
+    def note_fallback(self, label: str, offset: int, reason: str) -> None:
+        self.fallbacks.append({"from": label, "to": None, "offset": offset, "reason": reason[:160]})
+
+    def note_wait(self, seconds: float) -> None:
+        if seconds >= _STALL_MIN_SEC:
+            self.stalls += 1
+            self.stall_sec += seconds
+
+    def note_stripe(self, label: str, nbytes: int, elapsed: float) -> None:
+        row = self.stripes.setdefault(label, [0, 0, 0.0])
+        row[0] += 1
+        row[1] += nbytes
+        row[2] += elapsed
+
+    def as_dict(self) -> dict:
+        now = self.ended or time.monotonic()
+        elapsed = max(now - self.started, 1e-6)
+        return {
+            "item_id": self.item_id,
+            "name": self.name,
+            "download": self.download,
+            "background": self.background,
+            "started_at": round(self.started_at, 3),
+            "ttfb_ms": round((self.first_byte - self.started) * 1000) if self.first_byte else None,
+            "duration_sec": round(elapsed, 2),
+            "bytes": self.bytes,
+            "file_size": self.file_size,
+            "mb_per_s": round(self.bytes / elapsed / 1024 / 1024, 2),
+            "sources": list(self.sources),
+            "fallbacks": list(self.fallbacks),
+            "stalls": self.stalls,
+            "stall_sec": round(self.stall_sec, 2),
+            "stripes": _stripe_rows(self.stripes),
+        }
+
+
+def _stripe_rows(rows: dict[str, list]) -> dict:
+    return {
+        label: {"count": n, "bytes": b, "mb_per_s": round(b / s / 1024 / 1024, 2) if s > 0 else None}
+        for label, (n, b, s) in sorted(rows.items())
+    }
+
+
+_current: ContextVar[StreamStats | None] = ContextVar("stream_stats", default=None)
+_active: dict[int, StreamStats] = {}
+_recent: deque[StreamStats] = deque(maxlen=_RECENT_MAX)
+# Totals since startup, per stripe client and per fallback edge.
+_client_totals: dict[str, list] = {}
+_fallback_totals: dict[str, int] = {}
+
+
+def current() -> StreamStats | None:
+    return _current.get()
+
+
+def bind(stats: StreamStats):
+    """Make `stats` the current stream for this task and the tasks it spawns."""
+    _active[id(stats)] = stats
+    return _current.set(stats)
+
+
+def unbind(token) -> None:
+    try:
+        _current.reset(token)
+    except ValueError:
+        # Generator finalised from another context.
+        pass
+
+
+def finish(stats: StreamStats) -> None:
+    if _active.pop(id(stats), None) is None:
+        return
+    stats.ended = time.monotonic()
+    _recent.append(stats)
+    for label, (n, b, s) in stats.stripes.items():
+        row = _client_totals.setdefault(label, [0, 0, 0.0])
+        row[0] += n
+        row[1] += b
+        row[2] += s
+    for fb in stats.fallbacks:
+        edge = f"{fb['from']}->{fb['to'] or 'none'}"
+        _fallback_totals[edge] = _fallback_totals.get(edge, 0) + 1
+
+
+def note_stripe(label: str, nbytes: int, elapsed: float) -> None:
+    stats = _current.get()
+    if stats is not None:
+        stats.note_stripe(label, nbytes, elapsed)
+
+
+def snapshot(limit: int = 50) -> dict:
+    recent = list(_recent)[-limit:]
+    recent.reverse()
+    served = [s for s in _recent if not s.background]
+    ttfbs = sorted(
+        (s.first_byte - s.started) * 1000 for s in served if s.first_byte is not None
+    )
+
+    def _pct(p: float) -> int | None:
+        if not ttfbs:
+            return None
+        return round(ttfbs[min(len(ttfbs) - 1, int(len(ttfbs) * p / 100))])
+
+    return {
+        "active": [s.as_dict() for s in _active.values()],
+        "recent": [s.as_dict() for s in recent],
+        "ttfb_ms": {"p50": _pct(50), "p95": _pct(95), "samples": len(ttfbs)},
+        "stalls": sum(s.stalls for s in served),
+        "clients": _stripe_rows(_client_totals),
+        "fallbacks": dict(sorted(_fallback_totals.items())),
+    }
@@ -0,0 +1,1386 @@
+import asyncio
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import aclosing
+from datetime import datetime
+from typing import AsyncGenerator, Awaitable, Callable, Optional
+
+from pyrogram import Client
+from pyrogram.file_id import FileId
+
+from app.core import telegram_bot as tg
+from app.core.client_scheduler import scheduler
+from app.core.rate_limit import is_throttled
+from app.core.cache import ChunkMap, cache_enabled, file_cache_path, get_chunk_map, is_file_cached, iter_file_mapped, touch_path
+from app.core.telegram_bot import ensure_peer_access, get_storage_chat_id, normalize_chat_id, pick_storage_client
+from app.core.telethon_storage import (
+    download_range as tl_download_range,
+    get_message as tl_get_message,
+    iter_download as tl_iter_download,
+    parallel_senders as tl_parallel_senders,
+)
+from app.core.user_sessions import acquire_user_client, is_session_error, release_user_client
+from app.core.container_index import find_index_ranges
+from app.core import stream_stats
+from app.core.stream_stats import StreamStats
+from app.db.models import FileSystemItem, StreamMeta
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+_PREFETCH_STRIPES = max(0, _env_int("STREAM_PREFETCH_STRIPES", 3))
+_PREFETCH_IDLE_SEC = max(1.0, _env_float("STREAM_PREFETCH_IDLE_SEC", 15.0))
+# Don't re-prime an item's head/index chunks more often than this.
+_PRIME_COOLDOWN_SEC = max(0.0, _env_float("STREAM_PRIME_COOLDOWN_SEC", 600.0))
+# Stripes a parallel stream may hold or fetch ahead of its consumer.
+_MAX_AHEAD_STRIPES = max(1, _env_int("STREAM_MAX_AHEAD_STRIPES", 4))
+_FILE_REF_TTL_SEC = max(30.0, _env_float("STREAM_FILE_REF_TTL_SEC", 1800.0))
+_FILE_REF_MAX = 4096
+
+
+def parallel_conf(download: bool = False) -> tuple[int, int]:
+    workers_key = "DL_WORKERS_DOWNLOAD" if download else "DL_WORKERS"
+    stripe_key = "DL_STRIPE_MB_DOWNLOAD" if download else "DL_STRIPE_MB"
+    try:
+        workers = int(os.getenv(workers_key, "7"))
+        if workers < 1: workers = 1
+        if workers > 8: workers = 8
+    except Exception:
+        workers = 7
+    try:
+        default_stripe = "8" if download else "4"
+        stripe_mb = int(os.getenv(stripe_key, default_stripe))
+        if stripe_mb < 1: stripe_mb = 1
+        if stripe_mb > 32: stripe_mb = 32
+    except Exception:
+        stripe_mb = 8 if download else 4
+    return workers, stripe_mb * 1024 * 1024
+
+
+def _pick_align(size: int, for_download: bool = False) -> int:
+    # Balance seek responsiveness with throughput to reduce buffering.
+    if for_download:
+        if size and size >= 200 * 1024 * 1024:
+            return 1024 * 1024
+        if size and size >= 20 * 1024 * 1024:
+            return 512 * 1024
+        if size and size >= 2 * 1024 * 1024:
+            return 128 * 1024
+        return 4096
+    if size and size >= 200 * 1024 * 1024:
+        return 256 * 1024
+    if size and size >= 20 * 1024 * 1024:
+        return 128 * 1024
+    if size and size >= 2 * 1024 * 1024:
+        return 64 * 1024
+    return 4096
+
+
+def _align_offset(start: int, align: int = 4096) -> tuple[int, int]:
+    if start < 0:
+        start = 0
+    aligned = start - (start % align)
+    skip = start - aligned
+    return aligned, skip
+
+
+def _align_range(start: int, length: int, align: int = 4096) -> tuple[int, int, int]:
+    aligned_start, skip = _align_offset(start, align)
+    aligned_length = length + skip
+    if aligned_length % align != 0:
+        aligned_length = ((aligned_length // align) + 1) * align
+    if aligned_length < align:
+        aligned_length = align
+    return aligned_start, aligned_length, skip
+
+
+def _extract_file_id(msg) -> Optional[str]:
+    if not msg:
+        return None
+    if getattr(msg, "document", None):
+        return msg.document.file_id
+    if getattr(msg, "video", None):
+        return msg.video.file_id
+    if getattr(msg, "audio", None):
+        return msg.audio.file_id
+    if getattr(msg, "photo", None):
+        return msg.photo.file_id
+    return None
+
+
+def _extract_file_size(msg) -> int | None:
+    # Works for both Pyrogram (file_size) and Telethon (size / msg.file.size) messages.
+    if not msg:
+        return None
+    if getattr(msg, "document", None):
+        return getattr(msg.document, "size", None) or getattr(msg.document, "file_size", None)
+    if getattr(msg, "video", None):
+        return getattr(msg.video, "size", None) or getattr(msg.video, "file_size", None)
+    if getattr(msg, "audio", None):
+        return getattr(msg.audio, "size", None) or getattr(msg.audio, "file_size", None)
+    if getattr(msg, "photo", None) and getattr(msg.photo, "sizes", None):
+        sizes = msg.photo.sizes
+        if sizes:
+            return getattr(sizes[-1], "size", None)
+    if getattr(msg, "file", None):
+        return getattr(msg.file, "size", None)
+    return None
+
+
+def parse_range(range_header: str | None, size: int) -> tuple[int, int]:
+    start = 0
+    end = size - 1 if size else 0
+    if range_header:
+        try:
+            range_val = range_header.replace("bytes=", "")
+            parts = range_val.split("-")
+            if parts[0]:
+                start = int(parts[0])
+            if len(parts) > 1 and parts[1]:
+                end = int(parts[1])
+            else:
+                end = size - 1 if size else 0
+            if size and end >= size:
+                end = size - 1
+        except ValueError:
+            start = 0
+            end = size - 1 if size else 0
+    return start, end
+
+
+_MAX_RANGES = 32
+# Ranges closer than this are merged; a separate part costs about as much
+# in multipart headers.
+_RANGE_COALESCE_GAP = 80
+
+
+def parse_ranges(range_header: str | None, size: int) -> list[tuple[int, int]] | None:
+    """RFC 7233 byte ranges of a `size`-byte file, sorted and merged.
+
+    None means the header is absent or malformed and should be ignored
+    (full 200 response); an empty list means no range is satisfiable (416).
+    Handles `a-b`, open-ended `a-` and suffix `-n` specs.
+    """
+    if not range_header or size <= 0:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges: list[tuple[int, int]] = []
+    specs = 0
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        specs += 1
+        first, dash, last = part.partition("-")
+        if not dash:
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                ranges.append((max(0, size - suffix), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if end is None:
+            end = size - 1
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    if not specs or specs > _MAX_RANGES:
+        return None
+    ranges.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1 + _RANGE_COALESCE_GAP:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Per-client cache of what get_messages told us about a message, so range
+# requests and pool workers can start streaming without an RPC. Entries hold
+# a weak reference to their client so ephemeral sessions never match a
+# recycled id().
+_file_refs: OrderedDict[tuple, dict] = OrderedDict()
+_peer_access: OrderedDict[tuple, tuple] = OrderedDict()
+
+
+def _is_file_ref_expired(exc: Exception) -> bool:
+    text = f"{type(exc).__name__} {exc}".upper()
+    return "FILE_REFERENCE" in text or "FILEREFERENCE" in text
+
+
+def _file_dc_id(file_id: str) -> int | None:
+    try:
+        return FileId.decode(file_id).dc_id
+    except Exception:
+        return None
+
+
+def invalidate_file_ref(client: Client, chat_id: int | str, message_id: int) -> None:
+    _file_refs.pop((id(client), str(chat_id), message_id), None)
+
+
+async def _has_peer_access(client: Client, chat_id: int | str) -> bool:
+    key = (id(client), str(chat_id))
+    cached = _peer_access.get(key)
+    now = time.monotonic()
+    if cached and cached[0]() is client and now - cached[1] < _FILE_REF_TTL_SEC:
+        if tg._is_client_connected(client):
+            return True
+    if not await ensure_peer_access(client, chat_id):
+        _peer_access.pop(key, None)
+        return False
+    _peer_access[key] = (weakref.ref(client), now)
+    _peer_access.move_to_end(key)
+    while len(_peer_access) > _FILE_REF_MAX:
+        _peer_access.popitem(last=False)
+    return True
+
+
+async def resolve_file(client: Client, chat_id: int | str, message_id: int, refresh: bool = False) -> dict | None:
+    """Return {"file_id", "size", "dc_id"} for a message as seen by `client`."""
+    key = (id(client), str(chat_id), message_id)
+    now = time.monotonic()
+    entry = _file_refs.get(key)
+    if (
+        entry
+        and not refresh
+        and entry["client"]() is client
+        and now - entry["ts"] < _FILE_REF_TTL_SEC
+    ):
+        _file_refs.move_to_end(key)
+        return entry
+    if not await _has_peer_access(client, chat_id):
+        return None
+    msg = await client.get_messages(chat_id, message_ids=message_id)
+    file_id = _extract_file_id(msg)
+    if not file_id:
+        _file_refs.pop(key, None)
+        return None
+    entry = {
+        "client": weakref.ref(client),
+        "file_id": file_id,
+        "size": _extract_file_size(msg),
+        "dc_id": _file_dc_id(file_id),
+        "ts": now,
+    }
+    _file_refs[key] = entry
+    _file_refs.move_to_end(key)
+    while len(_file_refs) > _FILE_REF_MAX:
+        _file_refs.popitem(last=False)
+    return entry
+
+
+def resolve_chat_id(item) -> int | str:
+    if item.parts and item.parts[0].chat_id:
+        return normalize_chat_id(item.parts[0].chat_id)
+    return normalize_chat_id(get_storage_chat_id() or "me")
+
+
+def pool_clients() -> list[Client]:
+    """Every Telegram client streams may use, without duplicates."""
+    # Read through the module so a reloaded bot pool is picked up.
+    candidates: list[Client] = []
+    if tg.bot_pool:
+        candidates.extend(tg.bot_pool)
+    if tg.bot_client:
+        candidates.append(tg.bot_client)
+    if tg.user_client:
+        candidates.append(tg.user_client)
+    if tg.tg_client:
+        candidates.append(tg.tg_client)
+
+    unique: list[Client] = []
+    seen = set()
+    for client in candidates:
+        key = id(client)
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(client)
+    return unique
+
+
+async def _usable_clients(chat_id: int | str, max_workers: int | None = None) -> list[Client]:
+    """Pool clients that can read `chat_id`, best-first by measured speed.
+
+    Clients are shared between streams; the scheduler caps how many
+    stripes each one runs at a time. Clients serving a FloodWait are left
+    out so the stream runs on the rest instead of waiting on them.
+    """
+    usable: list[Client] = []
+    for client in pool_clients():
+        if is_throttled(client):
+            continue
+        try:
+            if await _has_peer_access(client, chat_id):
+                usable.append(client)
+        except Exception:
+            continue
+    usable = scheduler.rank(usable)
+    if max_workers is not None:
+        usable = usable[:max_workers]
+    return usable
+
+
+async def _pick_primary_client(chat_id: int | str, usable: list[Client]) -> Client | None:
+    if usable:
+        return usable[0]
+    try:
+        return await pick_storage_client(chat_id)
+    except Exception:
+        return None
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+_stripe_flights: dict[tuple, _Flight] = {}
+
+
+async def _single_flight(key: tuple, factory: Callable[[], Awaitable[memoryview]]) -> memoryview:
+    """Run `factory` once per key; concurrent callers share its result.
+
+    The download keeps running while anyone still waits on it and is
+    cancelled when the last waiter goes away.
+    """
+    flight = _stripe_flights.get(key)
+    # A flight whose last waiter left is cancelled but stays registered
+    # until its done-callback runs; joining it would cancel this caller.
+    if flight is None or flight.task.done() or flight.task.cancelling():
+        flight = _Flight(asyncio.create_task(factory()))
+        _stripe_flights[key] = flight
+
+        def _forget(_task, key=key, flight=flight):
+            if _stripe_flights.get(key) is flight:
+                _stripe_flights.pop(key, None)
+
+        flight.task.add_done_callback(_forget)
+    flight.waiters += 1
+    try:
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if flight.waiters <= 0 and not flight.task.done():
+            flight.task.cancel()
+            if _stripe_flights.get(key) is flight:
+                _stripe_flights.pop(key, None)
+
+
+async def _download_stripe(client: Client, file_id: str, offset: int, limit: int, align: int) -> memoryview:
+    request_limit = limit
+    if request_limit % align != 0:
+        request_limit = ((request_limit // align) + 1) * align
+    # Parts are copied once into a buffer sized for the stripe; everything
+    # downstream slices views of it instead of copying again.
+    view = memoryview(bytearray(limit))
+    pos = 0
+    async for part in client.stream_media(file_id, offset=offset, limit=request_limit):
+        if not part:
+            break
+        n = min(len(part), limit - pos)
+        view[pos:pos + n] = memoryview(part)[:n]
+        pos += n
+        if pos >= limit:
+            break
+    if pos < limit:
+        raise RuntimeError(f"Short read in parallel stream (got {pos} of {limit}).")
+    return view.toreadonly()
+
+
+async def _fetch_stripe_from(client: Client, chat_id: int | str, message_id: int, offset: int, limit: int, align: int) -> memoryview:
+    ref = await resolve_file(client, chat_id, message_id)
+    if not ref:
+        raise RuntimeError("Missing file id for parallel stream.")
+    try:
+        return await _download_stripe(client, ref["file_id"], offset, limit, align)
+    except Exception as e:
+        if not _is_file_ref_expired(e):
+            raise
+        ref = await resolve_file(client, chat_id, message_id, refresh=True)
+        if not ref:
+            raise
+        return await _download_stripe(client, ref["file_id"], offset, limit, align)
+
+
+_STRIPE_ATTEMPTS = 3
+# Longest a stripe waits for a free pool client. If every client is gone or
+# in a long FloodWait the stripe fails and the plan falls back to Telethon.
+_ACQUIRE_TIMEOUT_SEC = max(1.0, _env_float("STREAM_ACQUIRE_TIMEOUT_SEC", 15.0))
+# A stripe still running past this percentile of recent stripe latencies
+# (per MB) is duplicated on an idle client; 0 disables hedging.
+_HEDGE_PERCENTILE = min(99.9, max(0.0, _env_float("STREAM_HEDGE_PERCENTILE", 95.0)))
+_HEDGE_MIN_SEC = max(0.05, _env_float("STREAM_HEDGE_MIN_SEC", 0.75))
+_HEDGE_MIN_SAMPLES = 20
+_stripe_sec_per_mb: deque[float] = deque(maxlen=256)
+
+
+def _record_stripe_latency(nbytes: int, elapsed: float) -> None:
+    if nbytes > 0 and elapsed > 0:
+        _stripe_sec_per_mb.append(elapsed * 1024 * 1024 / nbytes)
+
+
+def _hedge_delay(limit: int) -> float | None:
+    if _HEDGE_PERCENTILE <= 0 or len(_stripe_sec_per_mb) < _HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(_stripe_sec_per_mb)
+    k = min(len(ordered) - 1, int(len(ordered) * _HEDGE_PERCENTILE / 100))
+    return max(_HEDGE_MIN_SEC, ordered[k] * limit / (1024 * 1024))
+
+
+async def fetch_stripe(
+    clients: list[Client],
+    chat_id: int | str,
+    message_id: int,
+    offset: int,
+    limit: int,
+    align: int = 4096,
+) -> memoryview:
+    """Download one stripe on the best free client.
+
+    Identical in-flight requests share one download, a straggling attempt
+    is hedged on an idle client, and a failed attempt is retried on
+    whichever client the scheduler picks next.
+    """
+    key = (str(chat_id), message_id, offset, limit)
+
+    async def _attempt(client: Client) -> memoryview:
+        started = time.monotonic()
+        data = b""
+        error: BaseException | None = None
+        try:
+            data = await _fetch_stripe_from(client, chat_id, message_id, offset, limit, align)
+            elapsed = time.monotonic() - started
+            _record_stripe_latency(len(data), elapsed)
+            stream_stats.note_stripe(scheduler.stats_for(client).label, len(data), elapsed)
+            return data
+        except Exception as e:
+            error = e
+            _note_stream_error(chat_id, message_id, e)
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await scheduler.release(client, len(data), time.monotonic() - started, error)
+
+    async def _hedged(client: Client) -> memoryview:
+        # Start on `client`; if it is still running past the hedge delay and
+        # another client is idle, race a duplicate there. First success wins.
+        tasks = {asyncio.create_task(_attempt(client)): (client, time.monotonic())}
+        try:
+            delay = _hedge_delay(limit)
+            if delay is not None:
+                done, _ = await asyncio.wait(set(tasks), timeout=delay)
+                backup = None if done else scheduler.try_acquire_idle(clients, exclude=client)
+                if backup is not None:
+                    scheduler.stats_for(backup).hedges += 1
+                    logger.debug(f"Hedging stripe {offset} of {message_id} on {scheduler.stats_for(backup).label}")
+                    tasks[asyncio.create_task(_attempt(backup))] = (backup, time.monotonic())
+            pending = set(tasks)
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        now = time.monotonic()
+                        for other in pending:
+                            loser, t0 = tasks[other]
+                            scheduler.penalize(loser, limit, now - t0)
+                        if len(tasks) > 1 and tasks[task][0] is not client:
+                            scheduler.stats_for(tasks[task][0]).hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error or RuntimeError("Stripe download failed.")
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _fetch() -> memoryview:
+        last_error: Exception | None = None
+        for _ in range(_STRIPE_ATTEMPTS):
+            client = await scheduler.acquire(clients, timeout=_ACQUIRE_TIMEOUT_SEC)
+            try:
+                return await _hedged(client)
+            except Exception as e:
+                last_error = e
+        raise last_error or RuntimeError("Stripe download failed.")
+
+    return await _single_flight(key, _fetch)
+
+
+class ReadAhead:
+    """Per-viewer window of stripes downloading ahead of sequential playback.
+
+    Streams attach at their first stripe and report each stripe they hand to
+    the client. Once two stripes in a row are consumed, the next
+    STREAM_PREFETCH_STRIPES stripes are fetched in the background. A request
+    that starts anywhere else is a seek and drops the window, and the window
+    is also dropped after STREAM_PREFETCH_IDLE_SEC with no attached stream.
+    """
+
+    def __init__(self, key: tuple, chat_id: int | str, message_id: int, chunk_size: int, eof: int, window: int):
+        self.key = key
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.chunk_size = chunk_size
+        self.eof = eof
+        self.window = window
+        self.align = _pick_align(eof, for_download=False)
+        self.stripes: dict[int, asyncio.Task] = {}
+        self.next_idx: int | None = None
+        self.active = 0
+        self.clients: list[Client] = []
+        self._idle: asyncio.TimerHandle | None = None
+
+    def attach(self, first_idx: int) -> None:
+        self.active += 1
+        if self._idle:
+            self._idle.cancel()
+            self._idle = None
+        if first_idx not in self.stripes and first_idx != self.next_idx:
+            self.cancel_all()
+            self.next_idx = None
+
+    def detach(self) -> None:
+        self.active = max(0, self.active - 1)
+        if self.active == 0 and self._idle is None:
+            self._idle = asyncio.get_running_loop().call_later(_PREFETCH_IDLE_SEC, self._expire)
+
+    def take(self, idx: int) -> Optional[asyncio.Task]:
+        return self.stripes.pop(idx, None)
+
+    def advance(self, idx: int, covered_to: int) -> None:
+        """Record that stripe `idx` was consumed; the current request already
+        fetches everything up to `covered_to`, so only prefetch past it."""
+        sequential = self.next_idx == idx
+        self.next_idx = idx + 1
+        for old in [i for i in self.stripes if i <= idx]:
+            self.stripes.pop(old).cancel()
+        if not sequential or not self.clients:
+            return
+        last_idx = (self.eof - 1) // self.chunk_size
+        for ahead in range(max(idx, covered_to) + 1, min(idx + self.window, last_idx) + 1):
+            if ahead in self.stripes:
+                continue
+            offset = ahead * self.chunk_size
+            limit = min(self.chunk_size, self.eof - offset)
+            task = asyncio.create_task(
+                fetch_stripe(self.clients, self.chat_id, self.message_id, offset, limit, self.align)
+            )
+            # Retrieve failures so they are not reported as unhandled.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.stripes[ahead] = task
+
+    def cancel_all(self) -> None:
+        for task in self.stripes.values():
+            task.cancel()
+        self.stripes.clear()
+
+    def _expire(self) -> None:
+        self._idle = None
+        if self.active:
+            return
+        self.cancel_all()
+        if _read_aheads.get(self.key) is self:
+            _read_aheads.pop(self.key, None)
+
+
+_read_aheads: dict[tuple, ReadAhead] = {}
+
+
+def get_read_ahead(
+    viewer_key: str | None, chat_id: int | str, message_id: int, chunk_size: int, eof: int
+) -> Optional[ReadAhead]:
+    if not viewer_key or _PREFETCH_STRIPES <= 0 or eof <= 0:
+        return None
+    key = (viewer_key, str(chat_id), message_id, chunk_size)
+    ra = _read_aheads.get(key)
+    if ra is None or ra.eof != eof:
+        if ra:
+            ra.cancel_all()
+        ra = ReadAhead(key, chat_id, message_id, chunk_size, eof, _PREFETCH_STRIPES)
+        _read_aheads[key] = ra
+    return ra
+
+
+async def parallel_stream_generator(
+    clients: list[Client],
+    chat_id: int | str,
+    message_id: int,
+    start: int,
+    end: int,
+    chunk_size: int = 512 * 1024,
+    file_size: int | None = None,
+    read_ahead: ReadAhead | None = None,
+    fetch: Callable[[int, int], Awaitable[memoryview]] | None = None,
+    workers: int | None = None,
+):
+    """Yield bytes start..end, downloading grid stripes concurrently in order.
+
+    Stripes come from the Pyrogram pool via fetch_stripe unless `fetch`
+    (offset, limit) is given, in which case `workers` sets the concurrency.
+    """
+    total = end - start + 1
+    if total <= 0:
+        return
+
+    align = _pick_align(total, for_download=False)
+    if chunk_size < align:
+        chunk_size = align
+    # Ensure chunk_size is aligned
+    if chunk_size % align != 0:
+        chunk_size = (chunk_size // align) * align
+        if chunk_size < align:
+            chunk_size = align
+
+    # Stripes sit on a fixed grid (multiples of chunk_size from byte 0) so
+    # concurrent viewers of the same file ask for identical stripes.
+    first_idx = start // chunk_size
+    last_idx = end // chunk_size
+    skip = start - first_idx * chunk_size
+    eof = file_size if file_size and file_size > end else end + 1
+    if read_ahead and read_ahead.chunk_size != chunk_size:
+        read_ahead = None
+
+    # Workers claim stripes in order but never more than `window` past the
+    # one the consumer is waiting on, so a slow HTTP client holds at most
+    # `window` stripes in memory instead of the whole range.
+    window = _MAX_AHEAD_STRIPES
+    next_idx = first_idx
+    consumer_idx = first_idx
+    results: dict[int, memoryview] = {}
+    cond = asyncio.Condition()
+    error: Exception | None = None
+
+    async def worker():
+        nonlocal error, next_idx
+        try:
+            while True:
+                async with cond:
+                    await cond.wait_for(
+                        lambda: next_idx > last_idx
+                        or error is not None
+                        or next_idx < consumer_idx + window
+                    )
+                    if next_idx > last_idx or error is not None:
+                        break
+                    idx = next_idx
+                    next_idx += 1
+                offset = idx * chunk_size
+                limit = min(chunk_size, eof - offset)
+                ahead = read_ahead.take(idx) if read_ahead else None
+                data = None
+                if ahead:
+                    try:
+                        data = await ahead
+                    except asyncio.CancelledError:
+                        if asyncio.current_task().cancelling():
+                            raise
+                        # Read-ahead dropped by another stream of this viewer.
+                        data = None
+                    except Exception:
+                        data = None
+                    if data is not None and len(data) != limit:
+                        data = None
+                if data is None:
+                    if fetch is not None:
+                        data = await fetch(offset, limit)
+                    else:
+                        data = await fetch_stripe(clients, chat_id, message_id, offset, limit, align)
+                async with cond:
+                    results[idx] = data
+                    cond.notify_all()
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # Cancelled from below (a shared download), not by us: the
+            # consumer would otherwise wait on this stripe forever.
+            async with cond:
+                if error is None:
+                    error = RuntimeError("Stripe download was cancelled.")
+                cond.notify_all()
+        except Exception as e:
+            async with cond:
+                if error is None:
+                    error = e
+                cond.notify_all()
+
+    if read_ahead:
+        read_ahead.clients = clients
+        read_ahead.attach(first_idx)
+    tasks = [asyncio.create_task(worker()) for _ in range(min(workers or len(clients), window))]
+    stats = stream_stats.current()
+    sent = 0
+    try:
+        for idx in range(first_idx, last_idx + 1):
+            async with cond:
+                if idx not in results and error is None:
+                    # Consumer is ahead of the downloads: a stall.
+                    waited = time.monotonic()
+                    await cond.wait_for(lambda: idx in results or error is not None)
+                    if stats is not None:
+                        stats.note_wait(time.monotonic() - waited)
+                if error is not None:
+                    raise error
+                data = results.pop(idx)
+                # Freed a slot; let a worker claim the next stripe while
+                # this one is being sent.
+                consumer_idx = idx + 1
+                cond.notify_all()
+            if read_ahead:
+                read_ahead.advance(idx, last_idx)
+            if idx == first_idx and skip:
+                if skip >= len(data):
+                    continue
+                data = data[skip:]
+            remaining = total - sent
+            if remaining <= 0:
+                break
+            if len(data) > remaining:
+                data = data[:remaining]
+            sent += len(data)
+            if data:
+                yield data
+    finally:
+        for task in tasks:
+            task.cancel()
+        if read_ahead:
+            read_ahead.detach()
+
+
+async def telegram_stream_generator(
+    client: Client,
+    chat_id: int | str,
+    message_id: int,
+    offset: int,
+    limit: int | None = None,
+    skip_bytes: int = 0,
+    on_error: Callable[[Exception], None] | None = None,
+):
+    refresh = False
+    for _ in range(2):
+        started = False
+        try:
+            ref = await resolve_file(client, chat_id, message_id, refresh=refresh)
+            if not ref:
+                return
+
+            remaining_skip = skip_bytes
+            async for chunk in client.stream_media(ref["file_id"], offset=offset, limit=limit or 0):
+                if not chunk:
+                    break
+                if remaining_skip:
+                    if len(chunk) <= remaining_skip:
+                        remaining_skip -= len(chunk)
+                        continue
+                    chunk = memoryview(chunk)[remaining_skip:]
+                    remaining_skip = 0
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            if not started and not refresh and _is_file_ref_expired(e):
+                # Cached reference went stale; fetch the message again once.
+                refresh = True
+                continue
+            _note_stream_error(chat_id, message_id, e)
+            if on_error is not None:
+                on_error(e)
+            logger.warning(f"Stream Error: {e}")
+            return
+
+
+# --- Sources -------------------------------------------------------------
+# A source yields the bytes of [start, end] (end=None means "until EOF").
+# It may stop short or raise; StreamPlan resumes from the first missing byte
+# on the next source in its chain.
+
+class PyrogramParallelSource:
+    label = "parallel"
+
+    def __init__(
+        self,
+        clients: list[Client],
+        chat_id: int | str,
+        message_id: int,
+        stripe_size: int,
+        file_size: int = 0,
+        read_ahead: ReadAhead | None = None,
+    ):
+        self.clients = clients
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.stripe_size = stripe_size
+        self.file_size = file_size
+        self.read_ahead = read_ahead
+
+    def usable(self, end: int | None) -> bool:
+        return len(self.clients) > 1 and end is not None
+
+    def iter_range(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        return parallel_stream_generator(
+            self.clients, self.chat_id, self.message_id, start, end,
+            chunk_size=self.stripe_size, file_size=self.file_size, read_ahead=self.read_ahead
+        )
+
+
+class PyrogramSource:
+    label = "pyrogram"
+
+    def __init__(self, client: Client, chat_id: int | str, message_id: int, align: int = 4096):
+        self.client = client
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.align = align
+        # Set once the client hits an auth/connection error, so a pooled
+        # user session is dropped instead of handed to the next viewer.
+        self.broken = False
+
+    def usable(self, end: int | None) -> bool:
+        return self.client is not None
+
+    def _note_error(self, exc: Exception) -> None:
+        if is_session_error(exc):
+            self.broken = True
+
+    async def iter_range(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        if end is None:
+            aligned_offset, skip = _align_offset(start, self.align)
+            aligned_limit = 0
+        else:
+            aligned_offset, aligned_limit, skip = _align_range(start, end - start + 1, self.align)
+        async for chunk in telegram_stream_generator(
+            self.client, self.chat_id, self.message_id, aligned_offset, aligned_limit, skip,
+            on_error=self._note_error,
+        ):
+            yield chunk
+
+
+class TelethonSource:
+    label = "telethon"
+
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+
+    def usable(self, end: int | None) -> bool:
+        return True
+
+    async def iter_range(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        msg = await tl_get_message(self.message_id)
+        # Telethon's limit counts chunks, not bytes; StreamPlan trims the tail.
+        async for chunk in tl_iter_download(msg, offset=start):
+            yield chunk
+
+
+class TelethonParallelSource:
+    """Stripes of the storage message over several Telethon connections."""
+
+    label = "telethon-parallel"
+
+    def __init__(self, message_id: int, stripe_size: int, file_size: int = 0):
+        self.message_id = message_id
+        self.stripe_size = stripe_size
+        self.file_size = file_size
+        self.workers = tl_parallel_senders()
+
+    def usable(self, end: int | None) -> bool:
+        return self.workers > 1 and end is not None
+
+    async def iter_range(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        msg = await tl_get_message(self.message_id)
+
+        async def download(offset: int, limit: int) -> memoryview:
+            started = time.monotonic()
+            data = await tl_download_range(msg, offset, limit)
+            stream_stats.note_stripe("telethon", len(data), time.monotonic() - started)
+            return data
+
+        def fetch(offset: int, limit: int) -> Awaitable[memoryview]:
+            key = ("telethon", self.message_id, offset, limit)
+            return _single_flight(key, lambda: download(offset, limit))
+
+        async with aclosing(parallel_stream_generator(
+            [], None, self.message_id, start, end,
+            chunk_size=self.stripe_size, file_size=self.file_size,
+            fetch=fetch, workers=self.workers
+        )) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+
+class LocalFileSource:
+    label = "cache"
+
+    def __init__(self, path, file_size: int):
+        self.path = path
+        self.file_size = file_size
+
+    def usable(self, end: int | None) -> bool:
+        return True
+
+    async def iter_range(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        if end is None:
+            end = self.file_size - 1
+        async for chunk in iter_file_mapped(self.path, start, end):
+            yield chunk
+
+
+class StreamPlan:
+    """Resolved file plus an ordered chain of sources to read it from."""
+
+    def __init__(self, item, chat_id: int | str, message_id: int, file_size: int, download: bool = False):
+        self.item = item
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.file_size = file_size
+        self.download = download
+        self.sources: list = []
+        self.chunk_map: ChunkMap | None = None
+        self._closers: list[Callable[[], Awaitable[None]]] = []
+        self._closed = False
+        # Optional `await shaper(nbytes)` before each chunk goes out.
+        self.shaper: Callable[[int], Awaitable[None]] | None = None
+        self.stats = StreamStats(str(getattr(item, "id", "")), getattr(item, "name", "") or "", file_size, download)
+
+    def add_closer(self, fn: Callable[[], Awaitable[None]]) -> None:
+        self._closers.append(fn)
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        stream_stats.finish(self.stats)
+        for fn in reversed(self._closers):
+            try:
+                await fn()
+            except Exception as e:
+                logger.debug("Stream cleanup failed: %s", e)
+
+    async def iter_range(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        self.stats.file_size = self.file_size
+        token = stream_stats.bind(self.stats)
+        try:
+            async with aclosing(self._iter_plan(start, end)) as chunks:
+                async for chunk in chunks:
+                    if self.shaper is not None:
+                        await self.shaper(len(chunk))
+                    self.stats.note_bytes(len(chunk))
+                    yield chunk
+        finally:
+            stream_stats.unbind(token)
+
+    async def _iter_plan(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        if end is not None and not self.file_size:
+            end = None
+        cmap = self.chunk_map
+        if cmap is None or end is None or not cmap.valid or cmap.size != self.file_size:
+            async for chunk in self._iter_sources(start, end):
+                yield chunk
+            return
+
+        cs = cmap.chunk_size
+        for first, last, present in cmap.runs(start // cs, end // cs):
+            run_start = max(start, first * cs)
+            run_end = min(end, (last + 1) * cs - 1)
+            if present:
+                async for chunk in self._iter_cached_run(cmap, run_start, run_end):
+                    yield chunk
+            else:
+                async for chunk in self._iter_fetch_run(cmap, first, last, run_start, run_end):
+                    yield chunk
+
+    async def _iter_cached_run(self, cmap: ChunkMap, start: int, end: int) -> AsyncGenerator[bytes, None]:
+        sent = 0
+        self.stats.note_source("chunk-cache")
+        try:
+            async with aclosing(cmap.read(start, end)) as chunks:
+                async for chunk in chunks:
+                    sent += len(chunk)
+                    yield chunk
+        except Exception as e:
+            logger.warning(f"Chunk cache read failed for {cmap.item_id}, using Telegram: {e}")
+            self.stats.note_fallback("chunk-cache", start + sent, str(e))
+            cmap.valid = False
+        if start + sent <= end:
+            async for chunk in self._iter_sources(start + sent, end):
+                yield chunk
+
+    async def _iter_fetch_run(
+        self, cmap: ChunkMap, first: int, last: int, start: int, end: int
+    ) -> AsyncGenerator[bytes, None]:
+        # Fetch whole chunks so every byte pulled from Telegram can be written
+        # back; only the requested slice is yielded to the client.
+        cs = cmap.chunk_size
+        fetch_start = first * cs
+        fetch_end = min(cmap.size, (last + 1) * cs) - 1
+        pos = fetch_start
+        idx = first
+        # Only chunks that straddle source boundaries are copied into
+        # `pending`; aligned ones are written straight from the source view.
+        pending = bytearray()
+        async with aclosing(self._iter_sources(fetch_start, fetch_end)) as chunks:
+            async for chunk in chunks:
+                view = memoryview(chunk)
+                chunk_start = pos
+                pos += len(view)
+                lo = max(start - chunk_start, 0)
+                hi = min(end + 1 - chunk_start, len(view))
+                if lo < hi:
+                    yield view[lo:hi]
+                while view and idx <= last:
+                    length = cmap.chunk_length(idx)
+                    need = length - len(pending)
+                    if len(view) < need:
+                        pending += view
+                        break
+                    if pending:
+                        pending += view[:need]
+                        await cmap.write(idx, pending)
+                        pending = bytearray()
+                    else:
+                        await cmap.write(idx, view[:length])
+                    view = view[need:]
+                    idx += 1
+
+    async def _iter_sources(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        total = (end - start + 1) if end is not None else None
+        if total is not None and total <= 0:
+            return
+        sent = 0
+        for source in self.sources:
+            if not source.usable(end):
+                continue
+            if total is not None and sent >= total:
+                break
+            produced = 0
+            self.stats.note_source(source.label)
+            try:
+                async with aclosing(source.iter_range(start + sent, end)) as chunks:
+                    async for chunk in chunks:
+                        if not chunk:
+                            continue
+                        if total is not None:
+                            remaining = total - sent
+                            if remaining <= 0:
+                                break
+                            if len(chunk) > remaining:
+                                chunk = memoryview(chunk)[:remaining]
+                        sent += len(chunk)
+                        produced += len(chunk)
+                        yield chunk
+            except Exception as e:
+                _note_stream_error(self.chat_id, self.message_id, e)
+                logger.warning(f"{source.label} stream failed at {start + sent}, falling back: {e}")
+                self.stats.note_fallback(source.label, start + sent, str(e) or type(e).__name__)
+                continue
+            if total is None and produced:
+                break
+            if total is not None and sent < total:
+                logger.warning(f"{source.label} stream ended short ({sent} of {total}), falling back")
+                self.stats.note_fallback(source.label, start + sent, "ended short")
+
+    async def iter_and_close(self, start: int, end: int | None) -> AsyncGenerator[bytes, None]:
+        try:
+            async for chunk in self.iter_range(start, end):
+                yield chunk
+        finally:
+            await self.close()
+
+
+# Verified sizes, keyed by item id. A size is probed once, persisted in
+# StreamMeta and reused by every range request until Telegram answers
+# OFFSET_INVALID for that message.
+_stream_meta: dict[str, dict] = {}
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _note_stream_error(chat_id: int | str, message_id: int, exc: Exception) -> None:
+    if "OFFSET_INVALID" in str(exc).upper():
+        invalidate_stream_meta(chat_id, message_id)
+
+
+def invalidate_stream_meta(chat_id: int | str, message_id: int) -> None:
+    stale = [
+        item_id for item_id, meta in _stream_meta.items()
+        if meta["chat_id"] == str(chat_id) and meta["message_id"] == message_id
+    ]
+    for item_id in stale:
+        _stream_meta.pop(item_id, None)
+        logger.info(f"Dropping cached size for {item_id} after OFFSET_INVALID")
+        _spawn(_delete_stream_meta(item_id))
+
+
+async def _delete_stream_meta(item_id: str) -> None:
+    try:
+        await StreamMeta.find(StreamMeta.item_id == item_id).delete()
+    except Exception as e:
+        logger.debug("StreamMeta delete failed for %s: %s", item_id, e)
+
+
+async def _load_stream_meta(item_id: str, chat_id: int | str, message_id: int) -> dict | None:
+    meta = _stream_meta.get(item_id)
+    if meta is None:
+        try:
+            doc = await StreamMeta.find_one(StreamMeta.item_id == item_id)
+        except Exception:
+            doc = None
+        if doc and doc.size > 0:
+            meta = {
+                "chat_id": doc.chat_id,
+                "message_id": doc.message_id,
+                "size": doc.size,
+                "source": doc.source,
+                "verified_at": doc.verified_at,
+                "index_ranges": doc.index_ranges,
+            }
+            _stream_meta[item_id] = meta
+    if meta and meta["chat_id"] == str(chat_id) and meta["message_id"] == message_id:
+        return meta
+    return None
+
+
+async def _persist_stream_meta(item_id: str, meta: dict, item_size: int) -> None:
+    try:
+        doc = await StreamMeta.find_one(StreamMeta.item_id == item_id)
+        if doc is None:
+            doc = StreamMeta(item_id=item_id)
+        doc.chat_id = meta["chat_id"]
+        doc.message_id = meta["message_id"]
+        doc.size = meta["size"]
+        doc.source = meta["source"]
+        doc.verified_at = meta["verified_at"]
+        doc.index_ranges = meta.get("index_ranges")
+        await doc.save()
+        if item_size != meta["size"]:
+            item = await FileSystemItem.get(item_id)
+            if item:
+                await item.set({FileSystemItem.size: meta["size"]})
+    except Exception as e:
+        logger.debug("StreamMeta save failed for %s: %s", item_id, e)
+
+
+async def _probe_size(plan: StreamPlan, client: Client | None) -> None:
+    item_id = str(plan.item.id)
+    meta = await _load_stream_meta(item_id, plan.chat_id, plan.message_id)
+    if meta:
+        plan.file_size = meta["size"]
+        return
+
+    # Probe actual size to avoid OFFSET_INVALID on wrong DB sizes
+    actual_size = None
+    source = "pyrogram"
+    try:
+        if client:
+            ref = await resolve_file(client, plan.chat_id, plan.message_id)
+            actual_size = ref["size"] if ref else None
+    except Exception:
+        actual_size = None
+    if not actual_size and plan.chat_id != "me":
+        source = "telethon"
+        try:
+            msg = await tl_get_message(plan.message_id)
+            actual_size = _extract_file_size(msg)
+        except Exception:
+            actual_size = None
+    if not actual_size:
+        return
+    plan.file_size = actual_size
+    meta = {
+        "chat_id": str(plan.chat_id),
+        "message_id": plan.message_id,
+        "size": actual_size,
+        "source": source,
+        "verified_at": datetime.now(),
+    }
+    _stream_meta[item_id] = meta
+    _spawn(_persist_stream_meta(item_id, meta, plan.item.size or 0))
+
+
+async def open_stream(
+    item,
+    session_string: str | None = None,
+    download: bool = False,
+    viewer_key: str | None = None,
+) -> StreamPlan:
+    """Pick clients for `item` and build its source chain.
+
+    Saved Messages items are read through the owner's pooled session
+    (`session_string`); storage items go local cache -> parallel pool ->
+    single client -> parallel Telethon -> Telethon. `viewer_key` identifies
+    the viewer for sequential read-ahead on the pool path.
+    """
+    chat_id = resolve_chat_id(item)
+    msg_id = item.parts[0].message_id
+    plan = StreamPlan(item, chat_id, msg_id, item.size or 0, download=download)
+    max_workers, stripe_size = parallel_conf(download=download)
+    align = _pick_align(plan.file_size, for_download=download)
+
+    if chat_id == "me":
+        if not session_string:
+            raise RuntimeError("Missing user session for Saved Messages stream.")
+        client = await acquire_user_client(session_string)
+        source = PyrogramSource(client, chat_id, msg_id, align)
+
+        async def _release():
+            await release_user_client(client, broken=source.broken)
+
+        plan.add_closer(_release)
+        try:
+            await _probe_size(plan, client)
+            source.align = _pick_align(plan.file_size, for_download=download)
+            if plan.file_size:
+                plan.chunk_map = await get_chunk_map(str(item.id), plan.file_size)
+        except BaseException as e:
+            # The caller never gets the plan, so nothing else would give
+            # the session lease back.
+            source.broken = source.broken or is_session_error(e)
+            await plan.close()
+            raise
+        plan.sources.append(source)
+        return plan
+
+    try:
+        parallel_clients = await _usable_clients(chat_id, max_workers=max_workers)
+    except Exception:
+        parallel_clients = []
+    primary = await _pick_primary_client(chat_id, parallel_clients)
+    if primary and primary not in parallel_clients:
+        parallel_clients.append(primary)
+
+    await _probe_size(plan, primary)
+    align = _pick_align(plan.file_size, for_download=download)
+
+    item_id = str(item.id)
+    if cache_enabled() and plan.file_size and is_file_cached(item_id, plan.file_size):
+        touch_path(file_cache_path(item_id))
+        plan.sources.append(LocalFileSource(file_cache_path(item_id), plan.file_size))
+    elif plan.file_size:
+        plan.chunk_map = await get_chunk_map(item_id, plan.file_size)
+    if primary:
+        read_ahead = None
+        if viewer_key and not download:
+            read_ahead = get_read_ahead(f"{viewer_key}:{item_id}", chat_id, msg_id, stripe_size, plan.file_size)
+        plan.sources.append(
+            PyrogramParallelSource(parallel_clients, chat_id, msg_id, stripe_size, plan.file_size, read_ahead)
+        )
+        plan.sources.append(PyrogramSource(primary, chat_id, msg_id, align))
+    plan.sources.append(TelethonParallelSource(msg_id, stripe_size, plan.file_size))
+    plan.sources.append(TelethonSource(msg_id))
+    return plan
+
+
+# --- Index priming -------------------------------------------------------
+# Players read the file head and then jump to the moov box / Cues element
+# (often near EOF) before the first frame. Those ranges are learned once per
+# item, kept in StreamMeta and pulled into the chunk cache when a player or
+# share page renders, so both requests are served locally.
+_primed: dict[str, float] = {}
+
+
+async def _index_ranges(plan: StreamPlan) -> list[tuple[int, int]]:
+    item_id = str(plan.item.id)
+    meta = _stream_meta.get(item_id)
+    if meta is not None and meta.get("index_ranges") is not None:
+        return [(start, end) for start, end in meta["index_ranges"]]
+
+    async def read(offset: int, length: int) -> bytes:
+        end = min(plan.file_size, offset + length) - 1
+        buf = bytearray()
+        async with aclosing(plan.iter_range(offset, end)) as chunks:
+            async for chunk in chunks:
+                buf += chunk
+        return bytes(buf)
+
+    ranges = await find_index_ranges(read, plan.file_size)
+    if meta is not None:
+        meta["index_ranges"] = [[start, end] for start, end in ranges]
+        _spawn(_persist_stream_meta(item_id, meta, plan.item.size or 0))
+    return ranges
+
+
+async def prime_stream(item) -> None:
+    """Pull the head and seek index of `item` into the chunk cache."""
+    plan = await open_stream(item)
+    plan.stats.background = True
+    try:
+        cmap = plan.chunk_map
+        if cmap is None or not plan.file_size:
+            # Fully cached already, or no chunk cache to keep the bytes in.
+            return
+        cs = cmap.chunk_size
+        for start, end in await _index_ranges(plan):
+            if all(present for _, _, present in cmap.runs(start // cs, end // cs)):
+                continue
+            async with aclosing(plan.iter_range(start, end)) as chunks:
+                async for _ in chunks:
+                    pass
+    finally:
+        await plan.close()
+
+
+def schedule_stream_prime(item) -> None:
+    """Prime `item` in the background; cheap to call on every page render."""
+    if not cache_enabled() or not item or getattr(item, "is_folder", False) or not item.parts:
+        return
+    if resolve_chat_id(item) == "me":
+        return
+    item_id = str(item.id)
+    now = time.monotonic()
+    last = _primed.get(item_id)
+    if last is not None and now - last < _PRIME_COOLDOWN_SEC:
+        return
+    if len(_primed) > 4096:
+        for key, ts in list(_primed.items()):
+            if now - ts >= _PRIME_COOLDOWN_SEC:
+                _primed.pop(key, None)
+    _primed[item_id] = now
+
+    async def _run():
+        try:
+            await prime_stream(item)
+        except Exception as e:
+            logger.debug("Stream priming failed for %s: %s", item_id, e)
+
+    _spawn(_run())
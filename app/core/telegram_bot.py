@@ -16,6 +16,7 @@ from pyrogram import Client, filters
 from pyrogram.handlers import MessageHandler
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from app.core.config import settings
+from app.core.rate_limit import install_rate_limiter, is_throttled
 from app.db.models import ContentItem, FileSystemItem, FilePart, User, SharedCollection
 from beanie import PydanticObjectId
 from beanie.operators import In
@@ -78,6 +79,9 @@ else:
     )
     bot_client = tg_client
 
+for _client in (tg_client, user_client, bot_client):
+    install_rate_limiter(_client)
+
 # Optional bot pool for parallel streaming/download
 bot_pool: list[Client] = []
 _bot_cycle = None
@@ -1263,7 +1267,9 @@ async def reload_bot_pool(tokens: list[str]):
     """Stop existing pool and start a new one with provided tokens."""
     await _stop_pool()
     for idx, token in enumerate(tokens):
-        bot = Client(f"morganxmystic_pool_{idx}", api_id=settings.API_ID, api_hash=settings.API_HASH, bot_token=token)
+        bot = install_rate_limiter(
+            Client(f"morganxmystic_pool_{idx}", api_id=settings.API_ID, api_hash=settings.API_HASH, bot_token=token)
+        )
         try:
             await bot.start()
             bot_me = await bot.get_me()
@@ -1577,6 +1583,8 @@ async def pick_storage_client(chat_id: int | str) -> Client:
         candidates.append(user_client)
     if tg_client not in candidates:
         candidates.append(tg_client)
+    # Clients serving a FloodWait are tried last.
+    candidates.sort(key=is_throttled)
 
     for client in candidates:
         if not _is_client_connected(client):
@@ -2688,12 +2696,12 @@ async def start_telegram():
             await _stop_pool()
             tokens = _get_pool_tokens()
             for idx, token in enumerate(tokens):
-                bot = Client(
+                bot = install_rate_limiter(Client(
                     f"morganxmystic_pool_{idx}",
                     api_id=settings.API_ID,
                     api_hash=settings.API_HASH,
                     bot_token=token
-                )
+                ))
                 try:
                     await bot.start()
                     bot_me = await bot.get_me()
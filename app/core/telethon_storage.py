@@ -3,7 +3,13 @@ import asyncio
 import logging
 from typing import AsyncGenerator, Optional
 
-from telethon import TelegramClient
+from telethon import TelegramClient, utils
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions.help import GetConfigRequest
+from telethon.tl.functions.upload import GetFileRequest
 from telethon.tl.types import Message
 
 from app.core.config import settings
@@ -12,6 +18,15 @@ _client: TelegramClient | None = None
 _storage_entity = None
 _lock = asyncio.Lock()
 logger = logging.getLogger(__name__)
+
+# Extra MTProto connections per DC used for parallel range downloads.
+_sender_pools: dict[int, asyncio.Queue] = {}
+_sender_lock = asyncio.Lock()
+_dc_auth_keys: dict[int, object] = {}
+# Every live sender, pooled or checked out, so shutdown can close them all.
+_senders: set[MTProtoSender] = set()
+# upload.getFile parts may not cross a 1 MB boundary.
+_FILE_PART = 1024 * 1024
 
 
 def _normalize_target(target: int | str) -> int | str:
@@ -55,6 +70,7 @@ async def get_client() -> TelegramClient:
 
 async def stop_client() -> None:
     global _client, _storage_entity
+    await _close_senders()
     async with _lock:
         client = _client
         _client = None
@@ -176,6 +192,115 @@ async def iter_download(
         yield chunk
 
 
+def parallel_senders() -> int:
+    try:
+        count = int(os.getenv("TL_PARALLEL_SENDERS", "4"))
+    except Exception:
+        count = 4
+    return max(1, min(count, 8))
+
+
+async def _create_sender(client: TelegramClient, dc_id: int) -> MTProtoSender:
+    # Each sender needs its own connection; sharing the client's would
+    # clash on seqno. Other DCs get an exported authorization once and
+    # reuse its key for every further connection.
+    dc = await client._get_dc(dc_id)
+    auth_key = client.session.auth_key if dc_id == client.session.dc_id else _dc_auth_keys.get(dc_id)
+    sender = MTProtoSender(auth_key, loggers=client._log)
+    _senders.add(sender)
+    await sender.connect(client._connection(
+        dc.ip_address,
+        dc.port,
+        dc.id,
+        loggers=client._log,
+        proxy=client._proxy,
+        local_addr=client._local_addr
+    ))
+    if auth_key is None:
+        auth = await client(ExportAuthorizationRequest(dc_id))
+        client._init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+        await sender.send(InvokeWithLayerRequest(LAYER, client._init_request))
+        _dc_auth_keys[dc_id] = sender.auth_key
+    else:
+        client._init_request.query = GetConfigRequest()
+        await sender.send(InvokeWithLayerRequest(LAYER, client._init_request))
+    return sender
+
+
+async def _sender_pool(dc_id: int) -> asyncio.Queue:
+    async with _sender_lock:
+        pool = _sender_pools.get(dc_id)
+        if pool is not None:
+            return pool
+        client = await get_client()
+        pool = asyncio.Queue()
+        for _ in range(parallel_senders()):
+            try:
+                pool.put_nowait(await _create_sender(client, dc_id))
+            except Exception as e:
+                logger.warning("Telethon sender for DC %s failed: %s", dc_id, e)
+                break
+        if pool.empty():
+            raise RuntimeError(f"No Telethon sender available for DC {dc_id}")
+        _sender_pools[dc_id] = pool
+        return pool
+
+
+async def _close_senders() -> None:
+    async with _sender_lock:
+        senders = list(_senders)
+        _senders.clear()
+        _sender_pools.clear()
+        _dc_auth_keys.clear()
+    # Includes senders still checked out by an in-flight download_range.
+    for sender in senders:
+        try:
+            await sender.disconnect()
+        except Exception:
+            pass
+
+
+async def download_range(message: Message, offset: int, limit: int) -> memoryview:
+    """Fetch `limit` bytes at `offset` of the message's file on a pooled sender.
+
+    Concurrent calls run on separate connections to the file's DC, so
+    stripes download in parallel instead of through one iter_download.
+    """
+    dc_id, location = utils.get_input_location(message.media)
+    pool = await _sender_pool(dc_id)
+    sender = await pool.get()
+    try:
+        view = memoryview(bytearray(limit))
+        pos = 0
+        part_offset = offset - offset % _FILE_PART
+        skip = offset - part_offset
+        while pos < limit:
+            result = await sender.send(GetFileRequest(location, offset=part_offset, limit=_FILE_PART))
+            data = memoryview(result.bytes)[skip:]
+            skip = 0
+            n = min(len(data), limit - pos)
+            view[pos:pos + n] = data[:n]
+            pos += n
+            if len(result.bytes) < _FILE_PART:
+                break
+            part_offset += _FILE_PART
+        if pos < limit:
+            raise RuntimeError(f"Short read in Telethon range (got {pos} of {limit}).")
+        return view.toreadonly()
+    except ConnectionError:
+        # Replace a dead connection rather than handing it to the next
+        # stripe; if that fails too the dead one goes back and is retried.
+        try:
+            await sender.disconnect()
+            _senders.discard(sender)
+            sender = await _create_sender(await get_client(), dc_id)
+        except Exception as e:
+            logger.warning("Telethon sender reconnect for DC %s failed: %s", dc_id, e)
+        raise
+    finally:
+        pool.put_nowait(sender)
+
+
 async def forward_message_to(user_id: int, message: Message) -> None:
     client = await get_client()
     await client.forward_messages(user_id, message)
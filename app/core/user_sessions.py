@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from pyrogram import Client
+
+from app.core.config import settings
+from app.core.rate_limit import install_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# Connected per-user sessions for Saved Messages ("me") items.
+_MAX_SESSIONS = max(1, _env_int("USER_SESSION_POOL_MAX", 16))
+_IDLE_SEC = max(10.0, _env_float("USER_SESSION_IDLE_SEC", 300.0))
+_ACQUIRE_TIMEOUT_SEC = 30.0
+
+
+class _Session:
+    __slots__ = ("key", "client", "leases", "last_used", "ready", "broken")
+
+    def __init__(self, key: str, client: Client):
+        self.key = key
+        self.client = client
+        self.leases = 0
+        # Out of the pool; disconnected once the last lease is released.
+        self.broken = False
+        self.last_used = time.monotonic()
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+_sessions: OrderedDict[str, _Session] = OrderedDict()
+_by_client: dict[int, _Session] = {}
+_cond: asyncio.Condition | None = None
+_sweep_handle: asyncio.TimerHandle | None = None
+
+
+def _condition() -> asyncio.Condition:
+    global _cond
+    if _cond is None:
+        _cond = asyncio.Condition()
+    return _cond
+
+
+def _session_key(session_string: str) -> str:
+    return hashlib.sha256(session_string.encode()).hexdigest()[:24]
+
+
+def is_session_error(exc: BaseException) -> bool:
+    """Whether `exc` means the client's connection or authorization is gone."""
+    text = f"{type(exc).__name__} {exc}".upper()
+    return isinstance(exc, (ConnectionError, OSError)) or "AUTH_KEY" in text or "SESSION" in text
+
+
+async def _disconnect(entry: _Session) -> None:
+    _by_client.pop(id(entry.client), None)
+    try:
+        await entry.client.disconnect()
+    except Exception as e:
+        logger.debug("User session disconnect failed: %s", e)
+
+
+def _evict_candidates(now: float, need_room: bool) -> list[_Session]:
+    """Idle sessions past USER_SESSION_IDLE_SEC, plus the LRU one if the pool is full."""
+    evict = [
+        entry for entry in _sessions.values()
+        if entry.leases == 0 and entry.ready.done() and now - entry.last_used >= _IDLE_SEC
+    ]
+    if need_room and not evict and len(_sessions) >= _MAX_SESSIONS:
+        for entry in _sessions.values():
+            if entry.leases == 0 and entry.ready.done():
+                evict.append(entry)
+                break
+    for entry in evict:
+        _sessions.pop(entry.key, None)
+    return evict
+
+
+def _schedule_sweep() -> None:
+    global _sweep_handle
+    if _sweep_handle is not None:
+        return
+    loop = asyncio.get_running_loop()
+
+    def _run():
+        global _sweep_handle
+        _sweep_handle = None
+        loop.create_task(_sweep())
+
+    _sweep_handle = loop.call_later(_IDLE_SEC, _run)
+
+
+async def _sweep() -> None:
+    for entry in _evict_candidates(time.monotonic(), need_room=False):
+        await _disconnect(entry)
+    if any(entry.leases == 0 for entry in _sessions.values()):
+        _schedule_sweep()
+
+
+async def acquire_user_client(session_string: str) -> Client:
+    """Lease a connected client for `session_string`, reusing a pooled one.
+
+    At most USER_SESSION_POOL_MAX sessions stay connected; when the pool is
+    full the least recently used idle one is dropped, and if every session
+    is in use the caller waits for one to be released.
+    """
+    if not session_string:
+        raise RuntimeError("Missing user session.")
+    key = _session_key(session_string)
+    cond = _condition()
+    deadline = time.monotonic() + _ACQUIRE_TIMEOUT_SEC
+    evicted: list[_Session] = []
+    creator = False
+    async with cond:
+        while True:
+            entry = _sessions.get(key)
+            if entry is None:
+                evicted.extend(_evict_candidates(time.monotonic(), need_room=True))
+                if len(_sessions) < _MAX_SESSIONS:
+                    client = Client(
+                        f"user_{key[:8]}",
+                        api_id=settings.API_ID,
+                        api_hash=settings.API_HASH,
+                        session_string=session_string,
+                        in_memory=True,
+                        no_updates=True,
+                    )
+                    entry = _Session(key, install_rate_limiter(client))
+                    _sessions[key] = entry
+                    _by_client[id(client)] = entry
+                    creator = True
+            if entry is not None:
+                entry.leases += 1
+                entry.last_used = time.monotonic()
+                _sessions.move_to_end(key)
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError("Too many active user sessions; try again shortly.")
+            try:
+                await asyncio.wait_for(cond.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+    for old in evicted:
+        await _disconnect(old)
+
+    if creator:
+        try:
+            await entry.client.connect()
+            entry.ready.set_result(True)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                entry.ready.set_exception(e)
+            else:
+                entry.ready.set_exception(RuntimeError("User session connect was cancelled."))
+            entry.ready.exception()  # mark retrieved; waiters still get it
+            await _release(entry, broken=True)
+            raise
+    else:
+        try:
+            await asyncio.shield(entry.ready)
+        except BaseException:
+            await release_user_client(entry.client)
+            raise
+    return entry.client
+
+
+async def _release(entry: _Session, broken: bool) -> None:
+    """Give back one lease. A broken session leaves the pool at once so new
+    callers reconnect, but other streams may still be using the client, so
+    it is only disconnected when the last lease goes."""
+    cond = _condition()
+    async with cond:
+        entry.leases = max(0, entry.leases - 1)
+        entry.last_used = time.monotonic()
+        if broken:
+            entry.broken = True
+            if _sessions.get(entry.key) is entry:
+                _sessions.pop(entry.key, None)
+        close = entry.broken and entry.leases == 0
+        cond.notify_all()
+    if close:
+        await _disconnect(entry)
+    elif not entry.broken:
+        _schedule_sweep()
+
+
+async def release_user_client(client: Client, broken: bool = False) -> None:
+    entry = _by_client.get(id(client))
+    if entry is None or entry.client is not client:
+        return
+    await _release(entry, broken)
+
+
+@asynccontextmanager
+async def user_session(session_string: str) -> AsyncIterator[Client]:
+    """`async with user_session(s) as client:` around a pooled client."""
+    client = await acquire_user_client(session_string)
+    broken = False
+    try:
+        yield client
+    except BaseException as e:
+        broken = is_session_error(e)
+        raise
+    finally:
+        await release_user_client(client, broken=broken)
+
+
+async def close_user_sessions() -> None:
+    global _sweep_handle
+    if _sweep_handle is not None:
+        _sweep_handle.cancel()
+        _sweep_handle = None
+    entries = list(_sessions.values())
+    _sessions.clear()
+    for entry in entries:
+        await _disconnect(entry)
+
+
+def pool_snapshot() -> dict:
+    now = time.monotonic()
+    return {
+        "max": _MAX_SESSIONS,
+        "live": len(_sessions),
+        "leased": sum(1 for entry in _sessions.values() if entry.leases),
+        "idle_sec": [round(now - entry.last_used, 1) for entry in _sessions.values()],
+    }
@@ -476,6 +476,21 @@ class MassContentState(Document):
             [("normalized_title", 1), ("content_type", 1)],
         ]
 
+
+class StreamMeta(Document):
+    item_id: str = Field(unique=True)
+    chat_id: str = ""
+    message_id: int = 0
+    size: int = 0
+    source: str = ""  # pyrogram | telethon
+    verified_at: datetime = Field(default_factory=datetime.now)
+    # Head and moov/Cues byte ranges; None until the container is inspected.
+    index_ranges: Optional[List[List[int]]] = None
+    model_config = ConfigDict(extra='allow')
+
+    class Settings:
+        name = "stream_meta"
+
 async def init_db():
     client = AsyncIOMotorClient(
         settings.MONGO_URI,
@@ -509,5 +524,6 @@ async def init_db():
             AppDeviceSession,
             FileFetcherSettings,
             MassContentState,
+            StreamMeta,
         ],
     )
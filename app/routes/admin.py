@@ -40,6 +40,11 @@ from app.routes.content import (
 from app.core.mailer import build_email_html, send_email_via_site_settings
 from app.core.config import settings
 from app.core.telegram_bot import pool_status, reload_bot_pool, speed_test, _get_pool_tokens
+from app.core import admission, ffmpeg_jobs, stream_stats
+from app.core.client_scheduler import scheduler
+from app.core.rate_limit import snapshot as rate_limit_snapshot
+from app.core.streaming import pool_clients
+from app.core.user_sessions import pool_snapshot as user_pool_snapshot
 from app.utils.file_utils import format_size
 
 router = APIRouter()
@@ -3371,6 +3376,22 @@ async def admin_speed_test(request: Request):
         result = {"ok": False, "error": str(e)}
     return await _render_main_settings(request, user, speed_result=result)
 
+@router.get("/admin/stream-stats")
+async def admin_stream_stats(request: Request, limit: int = 50):
+    """Per-stream TTFB, MB/s, fallbacks and stalls, plus pool and HLS job state."""
+    user = await get_current_user(request)
+    if not _is_admin(user):
+        raise HTTPException(403)
+    return {
+        "ok": True,
+        "streams": stream_stats.snapshot(limit=max(1, min(limit, 500))),
+        "scheduler": scheduler.snapshot(),
+        "rate_limits": rate_limit_snapshot(pool_clients()),
+        "user_sessions": user_pool_snapshot(),
+        "admission": admission.snapshot(),
+        "hls_jobs": ffmpeg_jobs.snapshot(),
+    }
+
 @router.post("/admin/tmdb/refresh")
 async def admin_refresh_tmdb(request: Request):
     user = await get_current_user(request)
@@ -22,6 +22,7 @@ from app.core.config import settings
 from app.core.content_store import build_content_groups
 from app.core.telegram_bot import tg_client, user_client, get_pool_client, get_storage_chat_id, ensure_peer_access, get_storage_client, pick_storage_client, normalize_chat_id
 from app.core.telethon_storage import send_file as tl_send_file, get_message as tl_get_message, iter_download as tl_iter_download, download_media as tl_download_media, delete_message as tl_delete_message
+from app.core.user_sessions import user_session
 from app.utils.file_utils import format_size, get_icon_for_mime
 from starlette.background import BackgroundTask
 
@@ -441,7 +442,7 @@ async def download_item_recursive(bot_client, item, base_path, user_session_stri
                     from_storage = True
                 chat_id = normalize_chat_id(chat_id)
                 if chat_id == "me" and user_session_string:
-                    async with Client("downloader", api_id=settings.API_ID, api_hash=settings.API_HASH, session_string=user_session_string, in_memory=True) as app:
+                    async with user_session(user_session_string) as app:
                         msg = await app.get_messages("me", message_ids=item.parts[0].message_id)
                         file_id = None
                         if msg.document: file_id = msg.document.file_id
@@ -975,19 +976,12 @@ async def rename_item(request: Request, item_id: str = Form(...), new_name: str
         chat_id = get_storage_chat_id() or "me"
         from_storage = True
     chat_id = normalize_chat_id(chat_id)
-    use_ephemeral = False
-    if chat_id == "me":
-        client = Client("renamer", api_id=settings.API_ID, api_hash=settings.API_HASH, session_string=user.session_string, in_memory=True)
-        await client.connect()
-        use_ephemeral = True
-    else:
-        client = None
-        if from_storage:
-            chat_id = normalize_chat_id(get_storage_chat_id())
+    if chat_id != "me" and from_storage:
+        chat_id = normalize_chat_id(get_storage_chat_id())
 
     old_msg_id = item.parts[0].message_id
-    try:
-        if chat_id == "me":
+    if chat_id == "me":
+        async with user_session(user.session_string) as client:
             msg = await client.send_document(
                 chat_id="me",
                 document=item.parts[0].telegram_file_id,
@@ -1001,35 +995,32 @@ async def rename_item(request: Request, item_id: str = Form(...), new_name: str
             except Exception:
                 pass
 
-            if msg.document:
-                item.size = msg.document.file_size
-                item.mime_type = msg.document.mime_type or item.mime_type
-                item.parts[0].telegram_file_id = msg.document.file_id
-                item.parts[0].message_id = msg.id
-                item.parts[0].chat_id = None
-        else:
-            old_msg = await tl_get_message(old_msg_id)
-            msg = await tl_send_file(
-                old_msg,
-                file_name=new_name,
-                caption="Renamed via MorganXMystic"
-            )
-            await tl_delete_message(old_msg_id)
-
-            msg_size = getattr(msg.file, "size", None) or item.size
-            msg_mime = getattr(msg.file, "mime_type", None) or item.mime_type
-            item.size = msg_size
-            item.mime_type = msg_mime
-            item.parts[0].telegram_file_id = str(msg.id)
+        if msg.document:
+            item.size = msg.document.file_size
+            item.mime_type = msg.document.mime_type or item.mime_type
+            item.parts[0].telegram_file_id = msg.document.file_id
             item.parts[0].message_id = msg.id
-            item.parts[0].chat_id = chat_id
+            item.parts[0].chat_id = None
+    else:
+        old_msg = await tl_get_message(old_msg_id)
+        msg = await tl_send_file(
+            old_msg,
+            file_name=new_name,
+            caption="Renamed via MorganXMystic"
+        )
+        await tl_delete_message(old_msg_id)
 
-        item.name = new_name
-        await item.save()
-        return JSONResponse({"status": "success", "name": new_name})
-    finally:
-        if use_ephemeral and client:
-            await client.disconnect()
+        msg_size = getattr(msg.file, "size", None) or item.size
+        msg_mime = getattr(msg.file, "mime_type", None) or item.mime_type
+        item.size = msg_size
+        item.mime_type = msg_mime
+        item.parts[0].telegram_file_id = str(msg.id)
+        item.parts[0].message_id = msg.id
+        item.parts[0].chat_id = chat_id
+
+    item.name = new_name
+    await item.save()
+    return JSONResponse({"status": "success", "name": new_name})
 
 @router.post("/item/move")
 async def move_item(request: Request, item_id: str = Form(...), target_parent_id: str = Form("")):
@@ -9,7 +9,7 @@ import urllib.parse
 from datetime import datetime
 from typing import List
 from fastapi import APIRouter, Request, HTTPException, Body, Header
-from fastapi.responses import StreamingResponse, RedirectResponse, HTMLResponse, FileResponse, Response
+from fastapi.responses import RedirectResponse, HTMLResponse, FileResponse
 from fastapi.templating import Jinja2Templates
 from starlette.background import BackgroundTask
 from pyrogram import Client
@@ -17,10 +17,13 @@ from beanie.operators import In, Or
 from beanie import PydanticObjectId
 from app.db.models import FileSystemItem, User, SharedCollection, PlaybackProgress, TokenSetting, WatchParty, WatchPartyMember, WatchPartyMessage, UserActivityEvent, SiteSettings
 from app.core.config import settings
-from app.routes.stream import telegram_stream_generator, _align_offset, _align_range, parallel_stream_generator, _get_parallel_clients, _extract_file_size, _pick_align
-from app.core.telegram_bot import tg_client, get_pool_client, get_storage_client, get_storage_chat_id, pick_storage_client, normalize_chat_id, ensure_peer_access
-from app.core.telethon_storage import get_message as tl_get_message, iter_download as tl_iter_download, download_media as tl_download_media
-from app.core.hls import ensure_hls, is_hls_ready, hls_url_for
+from app.routes.stream import stream_item_response
+from app.core.streaming import open_stream, resolve_chat_id, schedule_stream_prime
+from app.core.telegram_bot import get_storage_chat_id, normalize_chat_id
+from app.core.telethon_storage import get_message as tl_get_message, download_media as tl_download_media
+from app.core.hls import ensure_hls, is_hls_ready, hls_url_for, hls_status, PRIORITY_BACKGROUND
+from app.core.hls_jit import jit_hls_url
+from app.core.admission import admit_stream
 from app.utils.file_utils import format_size, get_icon_for_mime
 from app.routes.dashboard import get_current_user
 
@@ -146,41 +149,6 @@ def _is_video_item(item: FileSystemItem) -> bool:
     name = (item.name or "").lower()
     return ("video" in (item.mime_type or "")) or name.endswith((".mp4", ".mkv", ".webm", ".mov", ".avi"))
 
-def _parallel_conf(download: bool = False) -> tuple[int, int]:
-    workers_key = "DL_WORKERS_DOWNLOAD" if download else "DL_WORKERS"
-    stripe_key = "DL_STRIPE_MB_DOWNLOAD" if download else "DL_STRIPE_MB"
-    try:
-        workers = int(os.getenv(workers_key, "7"))
-        if workers < 1: workers = 1
-        if workers > 8: workers = 8
-    except Exception:
-        workers = 7
-    try:
-        default_stripe = "8" if download else "4"
-        stripe_mb = int(os.getenv(stripe_key, default_stripe))
-        if stripe_mb < 1: stripe_mb = 1
-        if stripe_mb > 32: stripe_mb = 32
-    except Exception:
-        stripe_mb = 8 if download else 2
-    return workers, stripe_mb * 1024 * 1024
-
-def _extract_file_size(msg) -> int | None:
-    if not msg:
-        return None
-    if getattr(msg, "document", None):
-        return getattr(msg.document, "size", None) or getattr(msg.document, "file_size", None)
-    if getattr(msg, "video", None):
-        return getattr(msg.video, "size", None) or getattr(msg.video, "file_size", None)
-    if getattr(msg, "audio", None):
-        return getattr(msg.audio, "size", None) or getattr(msg.audio, "file_size", None)
-    if getattr(msg, "photo", None) and getattr(msg.photo, "sizes", None):
-        sizes = msg.photo.sizes
-        if sizes:
-            return getattr(sizes[-1], "size", None)
-    if getattr(msg, "file", None):
-        return getattr(msg.file, "size", None)
-    return None
-
 async def _get_link_token() -> str:
     token = await TokenSetting.find_one(TokenSetting.key == "link_token")
     if token and token.value:
@@ -543,8 +511,12 @@ async def public_view(request: Request, token: str):
                     await ensure_hls(active_item, storage_chat_id)
                     if is_hls_ready(str(active_item.id)):
                         active_hls = hls_url_for(str(active_item.id))
+                    else:
+                        active_hls = jit_hls_url(active_item)
                 except Exception as e:
                     logger.warning(f"HLS prep failed for shared folder item: {e}")
+        if active_item and not active_hls:
+            schedule_stream_prime(active_item)
 
         return templates.TemplateResponse("shared_folder.html", {
             "request": request,
@@ -650,8 +622,12 @@ async def public_view(request: Request, token: str):
                     await ensure_hls(active_item, storage_chat_id)
                     if is_hls_ready(str(active_item.id)):
                         active_hls = hls_url_for(str(active_item.id))
+                    else:
+                        active_hls = jit_hls_url(active_item)
                 except Exception as e:
                     logger.warning(f"HLS prep failed for shared collection item: {e}")
+        if active_item and not active_hls:
+            schedule_stream_prime(active_item)
 
         return templates.TemplateResponse("shared_folder.html", {
             "request": request,
@@ -686,8 +662,12 @@ async def public_view(request: Request, token: str):
                     await ensure_hls(item, storage_chat_id)
                     if is_hls_ready(str(item.id)):
                         active_hls = hls_url_for(str(item.id))
+                    else:
+                        active_hls = jit_hls_url(item)
                 except Exception as e:
                     logger.warning(f"HLS prep failed for shared item: {e}")
+        if not active_hls:
+            schedule_stream_prime(item)
         return templates.TemplateResponse("shared.html", {
             "request": request,
             "site": site,
@@ -775,8 +755,12 @@ async def watch_party_view(request: Request, token: str):
                     await ensure_hls(active_item, storage_chat_id)
                     if is_hls_ready(str(active_item.id)):
                         active_hls = hls_url_for(str(active_item.id))
+                    else:
+                        active_hls = jit_hls_url(active_item)
                 except Exception as e:
                     logger.warning(f"HLS prep failed for watch party item: {e}")
+        if active_item and not active_hls:
+            schedule_stream_prime(active_item)
 
         if viewer_name:
             await _log_activity(
@@ -831,8 +815,12 @@ async def watch_party_view(request: Request, token: str):
                 await ensure_hls(item, storage_chat_id)
                 if is_hls_ready(str(item.id)):
                     active_hls = hls_url_for(str(item.id))
+                else:
+                    active_hls = jit_hls_url(item)
             except Exception as e:
                 logger.warning(f"HLS prep failed for watch party item: {e}")
+    if item and not active_hls:
+        schedule_stream_prime(item)
 
     if viewer_name:
         await _log_activity(
@@ -867,203 +855,32 @@ async def public_view_with_user(token: str, username: str):
 async def public_stream_by_id(item_id: str, request: Request, range: str = Header(None), download: bool = False):
     await _validate_link_token(request)
     item = await FileSystemItem.get(item_id)
-    if not item: raise HTTPException(404)
-    if item.parts and item.parts[0].chat_id:
-        chat_id = item.parts[0].chat_id
-        from_storage = False
-    else:
-        chat_id = get_storage_chat_id() or "me"
-        from_storage = True
-    chat_id = normalize_chat_id(chat_id)
+    if not item or not item.parts: raise HTTPException(404)
 
-    file_size = item.size or 0
-    start = 0
-    end = file_size - 1 if file_size else 0
-
-    disposition = "attachment" if download else "inline"
-
-    # Limit parallel clients based on env (download vs stream)
-    max_workers, stripe_size = _parallel_conf(download=download)
-
-    use_ephemeral = False
-    parallel_clients: list[Client] = []
-    release_parallel = None
-    storage_primary: Client | None = None
-    if chat_id == "me":
+    session_string = None
+    if resolve_chat_id(item) == "me":
         owner = await User.find_one(User.phone_number == item.owner_phone)
-        client = Client("pub_stream", api_id=settings.API_ID, api_hash=settings.API_HASH, session_string=owner.session_string, in_memory=True)
-        await client.connect()
-        use_ephemeral = True
-    else:
-        client = None
-        if from_storage:
-            chat_id = normalize_chat_id(get_storage_chat_id())
-        try:
-            if bot_pool:
-                candidate = get_pool_client()
-                if candidate and await ensure_peer_access(candidate, chat_id):
-                    client = candidate
-        except Exception:
-            client = None
-        if not client:
-            try:
-                client = await pick_storage_client(chat_id)
-            except Exception:
-                client = None
-        try:
-            parallel_clients, release_parallel = await _get_parallel_clients(chat_id, max_workers=max_workers)
-        except Exception:
-            parallel_clients = []
-            release_parallel = None
-        if client and client not in parallel_clients:
-            parallel_clients.append(client)
-        storage_primary = client or (parallel_clients[0] if parallel_clients else None)
-
-    msg_id = item.parts[0].message_id
-    # Probe actual size to avoid OFFSET_INVALID on wrong DB sizes
+        if not owner or not owner.session_string:
+            raise HTTPException(404)
+        session_string = owner.session_string
+
+    viewer_key = request.client.host if request.client else None
+    # Per-user limits only for signed-in viewers; the ?u= name is client-chosen.
+    viewer = await get_current_user(request)
+    ticket = admit_stream(request, user_key=viewer.phone_number if viewer else None, inline=not download)
     try:
-        # Prefer telethon (works even if pyrogram session hits rate limits)
-        msg = await tl_get_message(msg_id)
-        actual_size = _extract_file_size(msg)
-        if not actual_size and client and await ensure_peer_access(client, chat_id):
-            msg_pyro = await client.get_messages(chat_id, message_ids=msg_id)
-            actual_size = _extract_file_size(msg_pyro)
-        if actual_size:
-            file_size = actual_size
-            if item.size != actual_size:
-                try:
-                    item.size = actual_size
-                    await item.save()
-                except Exception:
-                    pass
-    except Exception:
-        pass
-
-    def _apply_range(size: int):
-        start_local = 0
-        end_local = size - 1 if size else 0
-        if range:
-            try:
-                range_val = range.replace("bytes=", "")
-                parts = range_val.split("-")
-                if parts[0]:
-                    start_local = int(parts[0])
-                if len(parts) > 1 and parts[1]:
-                    end_local = int(parts[1])
-                else:
-                    end_local = size - 1 if size else 0
-                if size and end_local >= size:
-                    end_local = size - 1
-            except ValueError:
-                start_local = 0
-                end_local = size - 1 if size else 0
-        return start_local, end_local
-
-    start, end = _apply_range(file_size)
-    if file_size:
-        if start >= file_size:
-            return Response(status_code=416, headers={"Content-Range": f"bytes */{file_size}"})
-        if end >= file_size:
-            end = file_size - 1
-    align = _pick_align(file_size, for_download=download)
-
-    if parallel_clients:
-        parallel_clients = parallel_clients[:max_workers]
-
-    async def cleanup():
-        try:
-            if chat_id == "me":
-                sent = 0
-                limit = (end - start + 1) if file_size else None
-                aligned_offset, aligned_limit, skip = _align_range(start, limit or 0, align)
-                async for chunk in telegram_stream_generator(client, chat_id, msg_id, aligned_offset, aligned_limit, skip):
-                    if limit is not None:
-                        remaining = limit - sent
-                        if remaining <= 0:
-                            break
-                        if len(chunk) > remaining:
-                            yield chunk[:remaining]
-                            break
-                        sent += len(chunk)
-                    yield chunk
-            elif storage_primary:
-                limit = (end - start + 1) if file_size else None
-                if parallel_clients and len(parallel_clients) > 1 and file_size:
-                    sent = 0
-                    try:
-                        async for chunk in parallel_stream_generator(parallel_clients, chat_id, msg_id, start, end, chunk_size=stripe_size):
-                            sent += len(chunk)
-                            yield chunk
-                    except Exception as e:
-                        logger.warning(f"Parallel stream failed, falling back: {e}")
-                        resume_start = start + sent
-                        if limit is not None and resume_start <= end:
-                            remaining_total = end - resume_start + 1
-                            aligned_offset, aligned_limit, skip = _align_range(resume_start, remaining_total, align)
-                            sent_fallback = 0
-                            async for chunk in telegram_stream_generator(storage_primary, chat_id, msg_id, aligned_offset, aligned_limit, skip):
-                                remaining = remaining_total - sent_fallback
-                                if remaining <= 0:
-                                    break
-                                if len(chunk) > remaining:
-                                    yield chunk[:remaining]
-                                    break
-                                sent_fallback += len(chunk)
-                                yield chunk
-                            if sent_fallback < remaining_total:
-                                try:
-                                    msg = await tl_get_message(msg_id)
-                                    async for chunk in tl_iter_download(msg, offset=resume_start + sent_fallback, limit=remaining_total - sent_fallback):
-                                        yield chunk
-                                except Exception:
-                                    pass
-                else:
-                    sent = 0
-                    aligned_offset, aligned_limit, skip = _align_range(start, limit or 0, align)
-                    async for chunk in telegram_stream_generator(storage_primary, chat_id, msg_id, aligned_offset, aligned_limit, skip):
-                        if limit is not None:
-                            remaining = limit - sent
-                            if remaining <= 0:
-                                break
-                            if len(chunk) > remaining:
-                                yield chunk[:remaining]
-                                break
-                            sent += len(chunk)
-                        yield chunk
-                    if limit is not None and sent < limit:
-                        try:
-                            msg = await tl_get_message(msg_id)
-                            async for chunk in tl_iter_download(msg, offset=start + sent, limit=limit - sent):
-                                yield chunk
-                        except Exception:
-                            pass
-            else:
-                msg = await tl_get_message(msg_id)
-                limit = (end - start + 1) if file_size else None
-                async for chunk in tl_iter_download(msg, offset=start, limit=limit):
-                    yield chunk
-        finally:
-            try:
-                if release_parallel:
-                    await release_parallel()
-            except Exception:
-                pass
-            if use_ephemeral and client:
-                await client.disconnect()
-
-    headers = {
-        'Content-Disposition': f'{disposition}; filename="{item.name}"',
-        'Accept-Ranges': 'bytes',
-    }
-    if file_size:
-        headers.update({
-            'Content-Range': f'bytes {start}-{end}/{file_size}',
-            'Content-Length': str(max((end - start + 1), 0)),
-        })
-    if item.mime_type:
-        headers['Content-Type'] = item.mime_type
-
-    return StreamingResponse(cleanup(), status_code=206 if range else 200, headers=headers, media_type=item.mime_type)
+        plan = await open_stream(
+            item,
+            session_string=session_string,
+            download=download,
+            viewer_key=viewer_key,
+        )
+    except BaseException:
+        ticket.release()
+        raise
+    ticket.attach(plan)
+    disposition = "attachment" if download else "inline"
+    return await stream_item_response(item, range, plan, disposition=disposition, request=request)
 
 @router.get("/s/resolve_user")
 async def resolve_user(name: str):
@@ -1323,9 +1140,21 @@ async def prepare_public_hls(item_id: str):
     storage_chat_id = normalize_chat_id(get_storage_chat_id() or "me")
     if storage_chat_id == "me":
         return {"status": "unsupported"}
-    await ensure_hls(item, storage_chat_id)
+    await ensure_hls(item, storage_chat_id, priority=PRIORITY_BACKGROUND)
     return {"status": "started"}
 
+@router.get("/s/hls/status/{item_id}")
+async def public_hls_status(item_id: str):
+    item = await FileSystemItem.get(item_id)
+    if not item:
+        raise HTTPException(404)
+    status = hls_status(item_id)
+    if status["job"]:
+        status["job"].pop("error", None)
+    if status["ready"]:
+        status["hls_url"] = hls_url_for(item_id)
+    return status
+
 @router.get("/s/progress/all")
 async def get_public_progress_all(token: str, user: str):
     if not user:
@@ -29,6 +29,7 @@ except RuntimeError:
 from app.core.config import settings
 from app.core.telegram_bot import start_telegram, stop_telegram
 from app.core.telethon_storage import get_client as get_telethon_client, stop_client as stop_telethon_client
+from app.core.user_sessions import close_user_sessions
 from app.db.models import init_db
 from app.routes import auth, content, dashboard, stream, admin, share, app_client, advance_mass_content, file_fetcher
 
@@ -196,6 +197,7 @@ async def lifespan(app: FastAPI):
     try:
         yield
     finally:
+        await _safe_shutdown("User sessions", close_user_sessions)
         await _safe_shutdown("Telegram", stop_telegram)
         await _safe_shutdown("Telethon", stop_telethon_client)
 
@@ -281,4 +283,13 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
     # Enable auto-reload only when explicitly requested.
     reload = os.getenv("RELOAD", "").lower() in ("1", "true", "yes")
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=reload)
+    # Client IPs (stream admission, read-ahead) come from X-Forwarded-For only
+    # when the peer is a trusted proxy.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=reload,
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+    )
@@ -0,0 +1,18 @@
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+
+# Settings needs these; nothing here talks to Telegram or Mongo.
+for _name, _value in {
+    "API_ID": "1",
+    "API_HASH": "test",
+    "BOT_TOKEN": "1:test",
+    "MONGO_URI": "mongodb://127.0.0.1:1",
+    "SECRET_KEY": "test",
+    "ADMIN_PHONE": "+0",
+}.items():
+    os.environ.setdefault(_name, _value)
@@ -0,0 +1,143 @@
+import asyncio
+from contextlib import suppress
+
+from app.core import streaming
+
+
+def test_single_flight_not_joined_after_cancel():
+    """A request arriving right after the last waiter left a stripe must
+    start a new download, not join (and inherit) the cancelled one."""
+
+    async def scenario():
+        key = ("test", 1, 0)
+
+        async def slow():
+            await asyncio.sleep(10)
+            return memoryview(b"stale")
+
+        async def fast():
+            return memoryview(b"fresh")
+
+        first = asyncio.create_task(streaming._single_flight(key, slow))
+        await asyncio.sleep(0)
+        first.cancel()
+        with suppress(asyncio.CancelledError):
+            await first
+        result = await asyncio.wait_for(streaming._single_flight(key, fast), 5)
+        assert bytes(result) == b"fresh"
+
+    asyncio.run(scenario())
+
+
+def test_seeking_viewers_with_cache_finish(tmp_path):
+    """Seeking viewers drop and re-request the same fixed-grid stripes; this
+    workload used to hang on a cancelled shared stripe download."""
+    import stream_bench
+
+    args = stream_bench.parse_args([
+        "--size-mb", "48", "--viewers", "3", "--verify",
+        "--latency-ms", "10", "--bandwidth", "60",
+        "--cache", str(tmp_path / "cache"),
+        "--workload", "seek", "--seeks", "8",
+    ])
+    report = asyncio.run(asyncio.wait_for(stream_bench._run(args), 60))
+    assert report["mismatches"] == 0
+    assert set(report["statuses"]) == {"206"}
+
+
+def test_parallel_stream_fails_when_a_stripe_download_is_cancelled():
+    """A CancelledError from a stripe fetch (not aimed at the worker) must
+    end the stream with an error instead of leaving the consumer waiting."""
+
+    async def scenario():
+        chunk = 64 * 1024
+
+        async def fetch(offset, limit):
+            if offset >= chunk:
+                raise asyncio.CancelledError()
+            return memoryview(bytes(limit))
+
+        received = 0
+        gen = streaming.parallel_stream_generator(
+            [], 0, 0, 0, 4 * chunk - 1, chunk_size=chunk, file_size=4 * chunk, fetch=fetch, workers=2
+        )
+        try:
+            async for data in gen:
+                received += len(data)
+        except RuntimeError:
+            return received
+        raise AssertionError("stream finished without the cancelled stripe")
+
+    received = asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert received < 4 * 64 * 1024
+
+
+def test_parallel_stream_refetches_cancelled_read_ahead():
+    """A read-ahead stripe cancelled by another stream of the same viewer is
+    downloaded again instead of failing the worker."""
+
+    async def scenario():
+        chunk = 64 * 1024
+
+        class CancelledReadAhead:
+            chunk_size = chunk
+            clients = None
+
+            def attach(self, idx):
+                pass
+
+            def detach(self):
+                pass
+
+            def advance(self, idx, covered_to):
+                pass
+
+            def take(self, idx):
+                task = asyncio.ensure_future(asyncio.sleep(10))
+                task.cancel()
+                return task
+
+        async def fetch(offset, limit):
+            return memoryview(bytes([offset // chunk]) * limit)
+
+        out = bytearray()
+        async for data in streaming.parallel_stream_generator(
+            [], 0, 0, 0, 4 * chunk - 1, chunk_size=chunk, file_size=4 * chunk,
+            read_ahead=CancelledReadAhead(), fetch=fetch, workers=2,
+        ):
+            out += data
+        return bytes(out)
+
+    out = asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert out == b"".join(bytes([i]) * 64 * 1024 for i in range(4))
+
+
+def test_plan_falls_back_when_no_pool_client_frees_up(monkeypatch):
+    """Stripes must not wait forever for pool clients that are all gone;
+    the plan moves on to the next source."""
+
+    class GoneClient:
+        is_connected = False
+
+    class BytesSource:
+        label = "fallback"
+
+        def usable(self, end):
+            return True
+
+        async def iter_range(self, start, end):
+            yield bytes(end - start + 1)
+
+    monkeypatch.setattr(streaming, "_ACQUIRE_TIMEOUT_SEC", 0.2)
+    size = 256 * 1024
+    item = type("Item", (), {"id": "gone-pool", "name": "gone.mp4"})()
+
+    async def scenario():
+        plan = streaming.StreamPlan(item, 1, 1, size)
+        plan.sources = [
+            streaming.PyrogramParallelSource([GoneClient(), GoneClient()], 1, 1, 64 * 1024, size),
+            BytesSource(),
+        ]
+        return sum([len(chunk) async for chunk in plan.iter_and_close(0, size - 1)])
+
+    assert asyncio.run(asyncio.wait_for(scenario(), 10)) == size
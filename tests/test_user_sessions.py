@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import streaming, user_sessions
+
+
+class FakeClient:
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.connected = False
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(user_sessions, "Client", FakeClient)
+    monkeypatch.setattr(user_sessions, "install_rate_limiter", lambda client: client)
+    monkeypatch.setattr(user_sessions, "_sessions", type(user_sessions._sessions)())
+    monkeypatch.setattr(user_sessions, "_by_client", {})
+    monkeypatch.setattr(user_sessions, "_cond", None)
+    monkeypatch.setattr(user_sessions, "_sweep_handle", None)
+    return user_sessions
+
+
+def test_broken_session_stays_connected_for_other_leases(pool):
+    async def scenario():
+        first = await pool.acquire_user_client("session-a")
+        second = await pool.acquire_user_client("session-a")
+        assert first is second
+
+        await pool.release_user_client(first, broken=True)
+        assert first.connected  # the other stream still holds it
+        fresh = await pool.acquire_user_client("session-a")
+        assert fresh is not first
+
+        await pool.release_user_client(second)
+        assert not first.connected
+        await pool.release_user_client(fresh)
+        assert fresh.connected
+        await pool.close_user_sessions()
+
+    asyncio.run(scenario())
+
+
+def test_open_stream_releases_lease_when_setup_fails(pool, monkeypatch):
+    async def failing_probe(plan, client):
+        raise RuntimeError("probe failed")
+
+    monkeypatch.setattr(streaming, "_probe_size", failing_probe)
+    item = SimpleNamespace(id="item", size=10, parts=[SimpleNamespace(chat_id="me", message_id=1)])
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await streaming.open_stream(item, session_string="session-b")
+        (entry,) = pool._sessions.values()
+        assert entry.leases == 0
+        await pool.close_user_sessions()
+
+    asyncio.run(scenario())
+
+
+def test_stream_drops_session_after_auth_error(pool, monkeypatch):
+    async def no_probe(plan, client):
+        plan.file_size = 0
+
+    async def revoked(client, chat_id, message_id, refresh=False):
+        raise RuntimeError("[401 AUTH_KEY_UNREGISTERED]")
+
+    monkeypatch.setattr(streaming, "_probe_size", no_probe)
+    monkeypatch.setattr(streaming, "resolve_file", revoked)
+    item = SimpleNamespace(id="item", size=10, parts=[SimpleNamespace(chat_id="me", message_id=1)])
+
+    async def scenario():
+        plan = await streaming.open_stream(item, session_string="session-c")
+        client = plan.sources[0].client
+        assert [chunk async for chunk in plan.iter_and_close(0, None)] == []
+        assert not client.connected
+        assert not pool._sessions
+        await pool.close_user_sessions()
+
+    asyncio.run(scenario())
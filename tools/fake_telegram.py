@@ -0,0 +1,164 @@
+"""Fake Pyrogram / Telethon storage backend for offline stream benchmarks.
+
+Every fake client serves one local file as if it were the storage message,
+with per-request latency, a per-connection bandwidth cap and random errors
+or FloodWaits, so the real stream engine (pool scheduling, hedging,
+fallback chain, chunk cache) can be exercised without Telegram.
+"""
+import asyncio
+import mmap
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+
+from pyrogram.errors import FloodWait
+from telethon.errors import FloodWaitError
+
+PART_SIZE = 1024 * 1024
+STORAGE_CHAT_ID = -1001234567890
+MESSAGE_ID = 4242
+FILE_ID = "bench-file-id"
+
+
+@dataclass
+class Profile:
+    """Behaviour of one fake connection."""
+
+    latency: float = 0.08  # seconds before the first byte of each request
+    bandwidth_mbps: float = 6.0  # MB/s per request (0 = unlimited)
+    error_rate: float = 0.0  # chance a request fails with an RPC error
+    flood_rate: float = 0.0  # chance a request fails with a FloodWait
+    flood_seconds: int = 5
+
+
+class FakeFile:
+    def __init__(self, path: Path, seed: int | None = None):
+        self.path = Path(path)
+        self._fh = open(self.path, "rb")
+        self.data = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.data)
+        self.rng = random.Random(seed)
+
+    def close(self) -> None:
+        self.data.close()
+        self._fh.close()
+
+    async def parts(self, profile: Profile, offset: int, limit: int, flood_exc):
+        """Yield up to `limit` bytes at `offset` in 1 MB parts, paced by `profile`."""
+        await asyncio.sleep(profile.latency)
+        roll = self.rng.random()
+        if roll < profile.flood_rate:
+            raise flood_exc(profile.flood_seconds)
+        if roll < profile.flood_rate + profile.error_rate:
+            raise RuntimeError("[500 INTERNAL] injected by fake backend")
+        end = self.size if not limit else min(self.size, offset + limit)
+        pos = offset
+        while pos < end:
+            n = min(PART_SIZE, end - pos)
+            if profile.bandwidth_mbps > 0:
+                await asyncio.sleep(n / (profile.bandwidth_mbps * 1024 * 1024))
+            yield self.data[pos:pos + n]
+            pos += n
+
+
+def _pyrogram_flood(seconds: int) -> Exception:
+    return FloodWait(value=seconds)
+
+
+def _telethon_flood(seconds: int) -> Exception:
+    return FloodWaitError(request=None, capture=seconds)
+
+
+class FakePyrogramClient:
+    """Just the Client surface the stream path uses."""
+
+    def __init__(self, name: str, fake: FakeFile, profile: Profile):
+        self.name = name
+        self.fake = fake
+        self.profile = profile
+        self.is_connected = True
+        self.requests = 0
+        self.bytes = 0
+
+    async def get_chat(self, chat_id):
+        await asyncio.sleep(self.profile.latency)
+        return SimpleNamespace(id=chat_id)
+
+    async def get_messages(self, chat_id, message_ids=None):
+        await asyncio.sleep(self.profile.latency)
+        media = SimpleNamespace(file_id=FILE_ID, file_size=self.fake.size)
+        return SimpleNamespace(id=message_ids, document=media, video=None, audio=None, photo=None)
+
+    async def stream_media(self, file_id, offset: int = 0, limit: int = 0):
+        # Byte offset/limit, the way app.core.streaming calls it.
+        self.requests += 1
+        async for part in self.fake.parts(self.profile, offset, limit, _pyrogram_flood):
+            self.bytes += len(part)
+            yield part
+
+
+class FakeTelethon:
+    """Stand-ins for the app.core.telethon_storage functions streaming uses."""
+
+    def __init__(self, fake: FakeFile, profile: Profile, senders: int = 4):
+        self.fake = fake
+        self.profile = profile
+        self.senders = senders
+        self.requests = 0
+        self.bytes = 0
+
+    async def get_message(self, message_id: int):
+        await asyncio.sleep(self.profile.latency)
+        return SimpleNamespace(id=message_id, file=SimpleNamespace(size=self.fake.size))
+
+    async def iter_download(self, message, offset: int = 0, limit=None, chunk_size=None):
+        self.requests += 1
+        async for part in self.fake.parts(self.profile, offset, 0, _telethon_flood):
+            self.bytes += len(part)
+            yield part
+
+    async def download_range(self, message, offset: int, limit: int) -> memoryview:
+        self.requests += 1
+        buf = bytearray()
+        async for part in self.fake.parts(self.profile, offset, limit, _telethon_flood):
+            buf += part
+        self.bytes += len(buf)
+        return memoryview(bytes(buf))
+
+    def parallel_senders(self) -> int:
+        return self.senders
+
+
+def install(
+    fake: FakeFile,
+    pool: list[Profile],
+    telethon: Profile | None = None,
+    telethon_senders: int = 4,
+) -> tuple[list[FakePyrogramClient], FakeTelethon | None]:
+    """Point the stream engine at fake clients instead of Telegram.
+
+    `pool` gives one profile per Pyrogram pool client (empty = Telethon
+    only); `telethon=None` makes the Telethon fallback fail outright.
+    """
+    from app.core import streaming
+    from app.core import telegram_bot as tg
+
+    clients = [FakePyrogramClient(f"fake_{idx}", fake, profile) for idx, profile in enumerate(pool)]
+    tg.bot_pool = list(clients)
+    tg.bot_client = None
+    tg.user_client = None
+    tg.tg_client = clients[0] if clients else None
+
+    backend = FakeTelethon(fake, telethon, telethon_senders) if telethon else None
+    if backend:
+        streaming.tl_get_message = backend.get_message
+        streaming.tl_iter_download = backend.iter_download
+        streaming.tl_download_range = backend.download_range
+        streaming.tl_parallel_senders = backend.parallel_senders
+    else:
+        async def _unavailable(*_args, **_kwargs):
+            raise RuntimeError("Telethon disabled in benchmark")
+        streaming.tl_get_message = _unavailable
+        streaming.tl_parallel_senders = lambda: 1
+    return clients, backend
@@ -0,0 +1,362 @@
+"""Offline benchmark for the streaming routes.
+
+Runs range-request workloads against the real FastAPI app (middleware,
+/stream/data route, admission, stream engine) with Telegram replaced by
+tools/fake_telegram.py, and reports throughput, TTFB percentiles and memory.
+
+    python tools/stream_bench.py --size-mb 256 --pool 4 --viewers 8 --workload play
+    python tools/stream_bench.py --workload seek --seeks 20 --range-mb 2 --error-rate 0.05
+    python tools/stream_bench.py --pool 0 --telethon-senders 4   # Telethon-only path
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+
+# Settings needs these; nothing here talks to Telegram or Mongo.
+for _name, _value in {
+    "API_ID": "1",
+    "API_HASH": "bench",
+    "BOT_TOKEN": "1:bench",
+    "MONGO_URI": "mongodb://127.0.0.1:1",
+    "SECRET_KEY": "bench",
+    "ADMIN_PHONE": "+0",
+}.items():
+    os.environ.setdefault(_name, _value)
+
+MB = 1024 * 1024
+
+
+@dataclass
+class Result:
+    viewer: int
+    range_header: str
+    status: int = 0
+    ttfb: float | None = None
+    duration: float = 0.0
+    bytes: int = 0
+    mismatch: bool = False
+    error: str = ""
+
+
+@dataclass
+class Sampler:
+    baseline_mb: float = 0.0
+    peak_mb: float = 0.0
+    samples: list = field(default_factory=list)
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / MB
+    except Exception:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def _sample_memory(sampler: Sampler, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        rss = _rss_mb()
+        sampler.peak_mb = max(sampler.peak_mb, rss)
+        sampler.samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.1)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _make_file(size_mb: int) -> Path:
+    fd, name = tempfile.mkstemp(prefix="stream-bench-", suffix=".bin")
+    with os.fdopen(fd, "wb") as fh:
+        for _ in range(size_mb):
+            fh.write(os.urandom(MB))
+    return Path(name)
+
+
+def _percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _setup_app(fake, args):
+    from fake_telegram import MESSAGE_ID, STORAGE_CHAT_ID, Profile, install
+    from app.core.config import settings
+
+    settings.CACHE_ENABLED = bool(args.cache)
+    if args.cache:
+        settings.CACHE_DIR = args.cache
+
+    profile = Profile(
+        latency=args.latency_ms / 1000,
+        bandwidth_mbps=args.bandwidth,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds,
+    )
+    pool = [profile] * args.pool
+    if args.slow_clients:
+        slow = Profile(**{**profile.__dict__, "bandwidth_mbps": args.bandwidth / args.slow_factor})
+        pool = [slow] * args.slow_clients + pool[args.slow_clients:]
+    telethon = profile if args.telethon_senders > 0 else None
+    clients, telethon_backend = install(fake, pool, telethon, max(1, args.telethon_senders))
+
+    import main
+    from app.routes import stream as stream_routes
+
+    phones = [f"bench{idx}" for idx in range(args.viewers)]
+    item = SimpleNamespace(
+        id="bench-item",
+        name="bench.mp4",
+        size=fake.size,
+        mime_type="video/mp4",
+        owner_phone=phones[0],
+        collaborators=phones,
+        created_at=datetime(2024, 1, 1),
+        parts=[SimpleNamespace(chat_id=STORAGE_CHAT_ID, message_id=MESSAGE_ID)],
+    )
+
+    class _Items:
+        @staticmethod
+        async def get(item_id):
+            return item if item_id == item.id else None
+
+    async def _current_user(request):
+        phone = request.cookies.get("user_phone")
+        if not phone:
+            return None
+        return SimpleNamespace(phone_number=phone, session_string=None, role="user")
+
+    stream_routes.FileSystemItem = _Items
+    stream_routes.get_current_user = _current_user
+    return main.app, item, clients, telethon_backend
+
+
+async def _request(app, fake, path: str, viewer: int, range_header: str, verify: bool) -> Result:
+    result = Result(viewer=viewer, range_header=range_header)
+    headers = [
+        (b"host", b"bench"),
+        (b"cookie", f"user_phone=bench{viewer}".encode()),
+        (b"range", range_header.encode()),
+    ]
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": headers,
+        "client": (f"10.0.{viewer // 250}.{viewer % 250 + 1}", 40000 + viewer),
+        "server": ("bench", 80),
+    }
+    done = asyncio.Event()
+    requested = False
+    pos = 0
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal pos
+        if message["type"] == "http.response.start":
+            result.status = message["status"]
+            for key, value in message.get("headers", []):
+                if key == b"content-range" and value.startswith(b"bytes ") and b"-" in value:
+                    pos = int(value[6:].split(b"-")[0])
+        elif message["type"] == "http.response.body":
+            body = message.get("body", b"")
+            if body:
+                if result.ttfb is None:
+                    result.ttfb = time.monotonic() - started
+                if verify and result.status == 206 and fake.data[pos:pos + len(body)] != body:
+                    result.mismatch = True
+                pos += len(body)
+                result.bytes += len(body)
+            if not message.get("more_body", False):
+                done.set()
+
+    started = time.monotonic()
+    try:
+        await app(scope, receive, send)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        done.set()
+    result.duration = time.monotonic() - started
+    return result
+
+
+async def _viewer(app, fake, path: str, viewer: int, args, rng: random.Random) -> list[Result]:
+    results = []
+    size = fake.size
+    mode = args.workload
+    if mode == "mixed":
+        mode = "play" if viewer % 2 == 0 else "seek"
+    if mode == "play":
+        start = 0
+        end = size - 1 if not args.read_mb else min(size, args.read_mb * MB) - 1
+        header = f"bytes={start}-" if end == size - 1 else f"bytes={start}-{end}"
+        results.append(await _request(app, fake, path, viewer, header, args.verify))
+        return results
+    span = max(1, int(args.range_mb * MB))
+    for _ in range(args.seeks):
+        start = rng.randrange(0, max(1, size - span))
+        end = min(size, start + span) - 1
+        results.append(await _request(app, fake, path, viewer, f"bytes={start}-{end}", args.verify))
+    return results
+
+
+async def _run(args) -> dict:
+    from fake_telegram import FakeFile
+
+    path = Path(args.file) if args.file else _make_file(args.size_mb)
+    fake = FakeFile(path, seed=args.seed)
+    try:
+        app, item, clients, telethon_backend = _setup_app(fake, args)
+        from app.core import stream_stats
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        sampler = Sampler(baseline_mb=_rss_mb())
+        stop = asyncio.Event()
+        sampler_task = asyncio.create_task(_sample_memory(sampler, stop))
+        rng = random.Random(args.seed)
+        url = f"/stream/data/{item.id}"
+
+        started = time.monotonic()
+        per_viewer = await asyncio.gather(*[
+            _viewer(app, fake, url, idx, args, random.Random(rng.random()))
+            for idx in range(args.viewers)
+        ])
+        wall = time.monotonic() - started
+
+        stop.set()
+        await sampler_task
+        py_peak = tracemalloc.get_traced_memory()[1] / MB if args.tracemalloc else None
+        if args.tracemalloc:
+            tracemalloc.stop()
+        # Let plan closers and background tasks finish before reading stats.
+        await asyncio.sleep(0.2)
+
+        results = [r for rows in per_viewer for r in rows]
+        ok = [r for r in results if r.status in (200, 206) and not r.error]
+        ttfbs = [r.ttfb * 1000 for r in ok if r.ttfb is not None]
+        total_bytes = sum(r.bytes for r in results)
+        stats = stream_stats.snapshot(limit=0)
+        statuses: dict[str, int] = {}
+        for r in results:
+            statuses[str(r.status or r.error or "none")] = statuses.get(str(r.status or r.error or "none"), 0) + 1
+        return {
+            "workload": args.workload,
+            "viewers": args.viewers,
+            "file_mb": round(fake.size / MB, 1),
+            "requests": len(results),
+            "statuses": statuses,
+            "mismatches": sum(1 for r in results if r.mismatch),
+            "wall_sec": round(wall, 2),
+            "bytes": total_bytes,
+            "aggregate_mb_per_s": round(total_bytes / wall / MB, 2) if wall > 0 else None,
+            "per_request_mb_per_s": round(
+                sum(r.bytes / r.duration for r in ok if r.duration > 0) / len(ok) / MB, 2
+            ) if ok else None,
+            "ttfb_ms": {
+                "p50": _round(_percentile(ttfbs, 50)),
+                "p95": _round(_percentile(ttfbs, 95)),
+                "p99": _round(_percentile(ttfbs, 99)),
+                "max": _round(max(ttfbs) if ttfbs else None),
+            },
+            "memory_mb": {
+                "rss_start": round(sampler.baseline_mb, 1),
+                "rss_peak": round(sampler.peak_mb, 1),
+                "python_peak": _round(py_peak, 1),
+            },
+            "stalls": stats["stalls"],
+            "fallbacks": stats["fallbacks"],
+            "stripes": stats["clients"],
+            "backend_requests": {
+                **{client.name: client.requests for client in clients},
+                **({"telethon": telethon_backend.requests} if telethon_backend else {}),
+            },
+        }
+    finally:
+        fake.close()
+        if not args.file:
+            path.unlink(missing_ok=True)
+
+
+def _round(value, digits: int = 0):
+    if value is None:
+        return None
+    return round(value, digits) if digits else round(value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    src = parser.add_argument_group("file")
+    src.add_argument("--file", help="serve this file instead of random data")
+    src.add_argument("--size-mb", type=int, default=128, help="size of the generated random file")
+    load = parser.add_argument_group("workload")
+    load.add_argument("--workload", choices=("play", "seek", "mixed"), default="play",
+                      help="play: one sequential read per viewer; seek: random ranges; mixed: half each")
+    load.add_argument("--viewers", type=int, default=4, help="concurrent viewers")
+    load.add_argument("--read-mb", type=int, default=0, help="bytes read per play request (0 = whole file)")
+    load.add_argument("--seeks", type=int, default=10, help="ranges per seeking viewer")
+    load.add_argument("--range-mb", type=float, default=2.0, help="size of each seek range")
+    load.add_argument("--verify", action="store_true", help="check every byte against the source file")
+    backend = parser.add_argument_group("fake Telegram")
+    backend.add_argument("--pool", type=int, default=4, help="Pyrogram pool clients (0 = Telethon only)")
+    backend.add_argument("--telethon-senders", type=int, default=4, help="Telethon connections (0 disables Telethon)")
+    backend.add_argument("--latency-ms", type=float, default=80.0, help="per-request latency")
+    backend.add_argument("--bandwidth", type=float, default=6.0, help="MB/s per connection (0 = unlimited)")
+    backend.add_argument("--slow-clients", type=int, default=0, help="pool clients running at bandwidth/slow-factor")
+    backend.add_argument("--slow-factor", type=float, default=8.0)
+    backend.add_argument("--error-rate", type=float, default=0.0, help="chance a request raises an RPC error")
+    backend.add_argument("--flood-rate", type=float, default=0.0, help="chance a request raises FloodWait")
+    backend.add_argument("--flood-seconds", type=int, default=5)
+    run = parser.add_argument_group("run")
+    run.add_argument("--cache", help="enable the chunk cache in this directory")
+    run.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak (slower)")
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--json", action="store_true", help="print the report as JSON only")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    args.viewers = max(1, args.viewers)
+    report = asyncio.run(_run(args))
+    if args.json:
+        print(json.dumps(report))
+        return
+    width = max(len(key) for key in report)
+    for key, value in report.items():
+        print(f"{key:<{width}}  {value}")
+
+
+if __name__ == "__main__":
+    main()